@@ -4,11 +4,8 @@ import onmt
 import onmt.Markdown
 import torch
 import argparse
-import math
-import numpy
 import os, sys
-from onmt.ModelConstructor import build_model, build_language_model
-from copy import deepcopy
+from onmt.utils import average_checkpoints, load_checkpoint
 
 
 parser = argparse.ArgumentParser(description='translate.py')
@@ -17,7 +14,7 @@ onmt.Markdown.add_md_help_argument(parser)
 parser.add_argument('-models', required=True,
                     help='Path to model .pt file')
 parser.add_argument('-lm', action='store_true',
-                    help='Language model (default is seq2seq model')
+                    help='Language model (unused: the state dicts are averaged directly)')
 parser.add_argument('-output', default='model.averaged',
                     help="""Path to output averaged model""")
 parser.add_argument('-gpu', type=int, default=-1,
@@ -25,26 +22,17 @@ parser.add_argument('-gpu', type=int, default=-1,
 parser.add_argument('-top', type=int, default=5,
                     help="Device to run on")
 parser.add_argument('-method', default='mean',
-                    help="method to average: mean|gmean")
-
-def custom_build_model(opt, dict, lm=False):
-
-    if not lm:
-        model = build_model(opt, dict)
-    else:
-        model = build_language_model(opt,   dict)
-
-    return model
+                    help="method to average: mean|gmean|ema")
+parser.add_argument('-ema_decay', type=float, default=0.9,
+                    help="""Decay of the ema method: the weight of a checkpoint is decay^k,
+                    k being the number of checkpoints after it""")
+parser.add_argument('-no_mmap', action='store_true',
+                    help="""Load the checkpoints one after the other instead of memory-mapping them""")
 
 def main():
     
     opt = parser.parse_args()
     
-    opt.cuda = opt.gpu > -1
-
-    if opt.cuda:
-        torch.cuda.set_device(opt.gpu)
-    
     # opt.model should be a string of models, split by |
 
     models = list()
@@ -59,84 +47,24 @@ def main():
 
     print(models)
 
-    n_models = len(models)
-
-    print("Loading main model from %s ..." % models[0])
-    checkpoint = torch.load(models[0], map_location=lambda storage, loc: storage)
-
-    if 'optim' in checkpoint:
-        del checkpoint['optim']
-
-    main_checkpoint = checkpoint
+    print("Saving best model to %s" % opt.output + ".top")
 
-    # best_checkpoint = {
-    #     'model': deepcopy(main_checkpoint['model']),
-    #     'dicts': main_checkpoint['dicts'],
-    #     'opt': main_checkpoint['opt'],
-    #     'epoch': -1,
-    #     'iteration': -1,
-    #     'batchOrder': None,
-    #     'optim': None
-    # }
-    best_checkpoint = main_checkpoint
+    # the best checkpoint is saved without its optimizer state
+    best_checkpoint, _ = load_checkpoint(models[0], mmap=not opt.no_mmap)
 
-    print("Saving best model to %s" % opt.output + ".top")
+    if 'optim' in best_checkpoint:
+        del best_checkpoint['optim']
 
     torch.save(best_checkpoint, opt.output + ".top")
+    del best_checkpoint
 
+    # the parameters are averaged key by key from the state dicts: no model is built
+    model_state_dict, checkpoint = average_checkpoints(models, method=opt.method, ema_decay=opt.ema_decay,
+                                                       mmap=not opt.no_mmap)
     model_opt = checkpoint['opt']
     dicts = checkpoint['dicts']
 
-    print(model_opt.layers)
-
-    main_model = custom_build_model(model_opt, checkpoint['dicts'], lm=opt.lm)
-
-    main_model.load_state_dict(checkpoint['model'])
-
-    if opt.cuda:
-        main_model = main_model.cuda()
-
-    for i in range(1, len(models)):
-
-        model = models[i]
-        print("Loading model from %s ..." % models[i])
-        checkpoint = torch.load(model, map_location=lambda storage, loc: storage)
-
-        model_opt = checkpoint['opt']
-
-        # delete optim information to save GPU memory
-        if 'optim' in checkpoint:
-            del checkpoint['optim']
-
-        current_model = custom_build_model(model_opt, checkpoint['dicts'], lm=opt.lm)
-
-        current_model.load_state_dict(checkpoint['model'])
-
-        if opt.cuda:
-            current_model = current_model.cuda()
-
-        if opt.method == 'mean':
-            # Sum the parameter values
-            for (main_param, param) in zip(main_model.parameters(), current_model.parameters()):
-                main_param.data.add_(param.data)
-        elif opt.method == 'gmean':
-            # Take the geometric mean of parameter values
-            for (main_param, param) in zip(main_model.parameters(), current_model.parameters()):
-                main_param.data.mul_(param.data)
-        else:
-            raise NotImplementedError
-
-    # Normalizing
-    if opt.method == 'mean':
-        for main_param in main_model.parameters():
-            main_param.data.div_(n_models)
-    elif opt.method == 'gmean':
-        for main_param in main_model.parameters():
-            main_param.data.pow_(1. / n_models)
-
     # Saving
-    model_state_dict = main_model.state_dict()
-
     save_checkpoint = {
         'model': model_state_dict,
         'dicts': dicts,
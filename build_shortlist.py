@@ -0,0 +1,140 @@
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+import numpy as np
+
+
+parser = argparse.ArgumentParser(description='build_shortlist.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-data', required=True,
+                    help='Path to the training data (the -save_data of preprocess.py)')
+parser.add_argument('-data_format', default='raw',
+                    help='Format of the data: raw|bin (as in preprocess.py)')
+parser.add_argument('-output', required=True,
+                    help='Path to the output shortlist table')
+parser.add_argument('-k', type=int, default=100,
+                    help='Number of target candidates kept for each source word')
+parser.add_argument('-chunk_size', type=int, default=10000000,
+                    help='Number of word pairs collected before they are merged into the counts')
+parser.add_argument('-report_every', type=int, default=100000,
+                    help='Report the progress every N sentences')
+
+
+def load_data(opt):
+
+    if opt.data_format == 'raw':
+        dataset = torch.load(opt.data + ".train.pt")
+        return dataset['train']['src'], dataset['train']['tgt'], dataset['dicts']
+    elif opt.data_format == 'bin':
+        from onmt.data_utils.IndexedDataset import MMapIndexedDataset
+
+        dicts = torch.load(opt.data + ".dict.pt")
+        train_path = opt.data + '.train'
+        return MMapIndexedDataset(train_path + '.src'), MMapIndexedDataset(train_path + '.tgt'), dicts
+    else:
+        raise NotImplementedError
+
+
+def merge_counts(keys, counts, new_keys):
+    """Add the occurrences of new_keys to the sorted (keys, counts)"""
+    keys = np.concatenate([keys, new_keys])
+    counts = np.concatenate([counts, np.ones(len(new_keys), dtype=np.int64)])
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def count_cooccurrences(src_data, tgt_data, n_src, n_tgt, opt):
+    """
+    Number of sentence pairs in which each (source word, target word) pair occurs
+    :return: the pairs (as src * n_tgt + tgt), their counts,
+             the number of sentences containing each source / target word
+             and the number of occurrences of each target word
+    """
+    keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    src_count, tgt_count = np.zeros(n_src, dtype=np.int64), np.zeros(n_tgt, dtype=np.int64)
+    tgt_freq = np.zeros(n_tgt, dtype=np.int64)
+    pairs, n_pairs = [], 0
+
+    for i in range(len(src_data)):
+        src = np.unique(np.asarray(src_data[i], dtype=np.int64))
+        tgt_words = np.asarray(tgt_data[i], dtype=np.int64)
+        np.add.at(tgt_freq, tgt_words, 1)
+        tgt = np.unique(tgt_words)
+        src_count[src] += 1
+        tgt_count[tgt] += 1
+
+        pairs.append((src[:, None] * n_tgt + tgt[None, :]).reshape(-1))
+        n_pairs += len(pairs[-1])
+
+        if n_pairs >= opt.chunk_size:
+            keys, counts = merge_counts(keys, counts, np.concatenate(pairs))
+            pairs, n_pairs = [], 0
+
+        if (i + 1) % opt.report_every == 0:
+            print("... %d sentences (%d distinct pairs)" % (i + 1, len(keys)))
+
+    if len(pairs) > 0:
+        keys, counts = merge_counts(keys, counts, np.concatenate(pairs))
+
+    return keys, counts, src_count, tgt_count, tgt_freq
+
+
+def build_table(keys, counts, src_count, tgt_count, k):
+    """
+    Keep the k target words with the highest Dice coefficient 2 * c(s, t) / (c(s) + c(t)) for each source word s.
+    The rows are padded with PAD (which is always part of the shortlist)
+    """
+    n_src, n_tgt = len(src_count), len(tgt_count)
+    src, tgt = keys // n_tgt, keys % n_tgt
+
+    dice = 2. * counts / (src_count[src] + tgt_count[tgt])
+
+    # sort by source word, then by decreasing score
+    order = np.lexsort((-dice, src))
+    src, tgt = src[order], tgt[order]
+
+    # rank of each pair among the pairs of its source word
+    starts = np.searchsorted(src, np.arange(n_src))
+    rank = np.arange(len(src)) - starts[src]
+    keep = rank < k
+
+    table = np.full((n_src, k), onmt.Constants.PAD, dtype=np.int64)
+    table[src[keep], rank[keep]] = tgt[keep]
+
+    return torch.from_numpy(table)
+
+
+def most_frequent(tgt_freq):
+    """
+    The target words (except the special ones) by decreasing number of occurrences:
+    the dictionary is not necessarily sorted by frequency (e.g. joint or loaded vocabularies)
+    """
+    words = np.argsort(-tgt_freq, kind='stable')
+    words = words[words > onmt.Constants.EOS]
+
+    return torch.from_numpy(words.astype(np.int64))
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    src_data, tgt_data, dicts = load_data(opt)
+    n_src, n_tgt = dicts['src'].size(), dicts['tgt'].size()
+
+    print("Counting the co-occurrences in %d sentence pairs ..." % len(src_data))
+    keys, counts, src_count, tgt_count, tgt_freq = count_cooccurrences(src_data, tgt_data, n_src, n_tgt, opt)
+
+    print("Building the table of the %d best target words for %d source words ..." % (opt.k, n_src))
+    table = build_table(keys, counts, src_count, tgt_count, opt.k)
+
+    torch.save({'table': table, 'k': opt.k, 'frequent': most_frequent(tgt_freq)}, opt.output)
+    print("Saved the shortlist table to %s" % opt.output)
+
+
+if __name__ == "__main__":
+    main()
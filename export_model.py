@@ -0,0 +1,52 @@
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+from onmt.ModelConstructor import build_model
+from onmt.modules.Transformer.Export import export_model
+
+
+parser = argparse.ArgumentParser(description='export_model.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.exported',
+                    help="""Prefix of the exported files (.encoder.pt, .decoder.pt and .meta.pt).
+                    The prefix is given to translate.py as -model""")
+parser.add_argument('-max_sent_length', type=int, default=256,
+                    help='Maximum length of the source and target sentences of the exported model')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help="Device to trace on")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    if opt.gpu > -1:
+        torch.cuda.set_device(opt.gpu)
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = torch.load(opt.model, map_location=lambda storage, loc: storage)
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    if model_opt.model != 'transformer' or "src" not in dicts:
+        raise NotImplementedError("Only text Transformer models can be exported")
+
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+
+    if opt.gpu > -1:
+        model = model.cuda()
+
+    print("Exporting the encoder and the decoder step to %s.* ..." % opt.output)
+    export_model(model, opt.output, dicts, model_opt, max_len=opt.max_sent_length)
+
+
+if __name__ == "__main__":
+    main()
@@ -233,11 +233,11 @@ class EnsembleTranslator(object):
         return onmt.Dataset(src_data, tgt_data, sys.maxsize,
                             data_type=self._type, batch_size_sents =self.opt.batch_size)
 
-    def build_target_tokens(self, pred, src, attn):
-        tokens = self.tgt_dict.convertToLabels(pred, onmt.Constants.EOS)
-        tokens = tokens[:-1]  # EOS
+    def build_target_tokens(self, preds):
+        """Convert the hypotheses (list of index sequences) to words in one go"""
+        all_tokens = self.tgt_dict.convertToLabelsBatch(preds, onmt.Constants.EOS)
 
-        return tokens
+        return [tokens[:-1] for tokens in all_tokens]  # EOS
 
     def translate_batch(self, batch):
         
@@ -397,12 +397,9 @@ class EnsembleTranslator(object):
         pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = self.translate_batch(batch)
 
         #  (3) convert indexes to words
-        pred_batch = []
-        for b in range(batch_size):
-            pred_batch.append(
-                [self.build_target_tokens(pred[b][n], src_data[b], attn[b][n])
-                 for n in range(self.opt.n_best)]
-            )
+        n_best = self.opt.n_best
+        tokens = self.build_target_tokens([pred[b][n] for b in range(batch_size) for n in range(n_best)])
+        pred_batch = [tokens[b * n_best:(b + 1) * n_best] for b in range(batch_size)]
 
         return pred_batch, pred_score, pred_length, gold_score, gold_words,allgold_words
 
@@ -419,12 +416,9 @@ class EnsembleTranslator(object):
         pred, pred_score, attn, pred_length, gold_score, gold_words,allgold_words = self.translate_batch(batch)
 
         #  (3) convert indexes to words
-        pred_batch = []
-        for b in range(batch_size):
-            pred_batch.append(
-                [self.build_target_tokens(pred[b][n], src_data[b], attn[b][n])
-                 for n in range(self.opt.n_best)]
-            )
+        n_best = self.opt.n_best
+        tokens = self.build_target_tokens([pred[b][n] for b in range(batch_size) for n in range(n_best)])
+        pred_batch = [tokens[b * n_best:(b + 1) * n_best] for b in range(batch_size)]
 
         return pred_batch, pred_score, pred_length, gold_score, gold_words,allgold_words
 
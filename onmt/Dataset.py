@@ -1,8 +1,8 @@
 from __future__ import division
 
 import math
+import numpy as np
 import torch
-from collections import defaultdict
 import onmt
 from onmt.speech.Augmenter import Augmenter
 
@@ -13,7 +13,8 @@ class Batch(object):
                  src_align_right=False, tgt_align_right=False,
                  reshape_speech=0, augmenter=None):
 
-        self.tensors = defaultdict(lambda: None)
+        # a plain dict (missing keys are handled by get) so that batches can be sent between processes
+        self.tensors = dict()
         self.has_target = False
         self.src_type = src_type
         self.reshape_speech = reshape_speech
@@ -76,7 +77,8 @@ class Batch(object):
         max_length = max(lengths)
         # initialize with batch_size * length first
         if type == "text":
-            tensor = data[0].new(len(data), max_length).fill_(onmt.Constants.PAD)
+            # the data may be stored in a smaller integer type (e.g. int32 views of a memory-mapped file)
+            tensor = torch.LongTensor(len(data), max_length).fill_(onmt.Constants.PAD)
 
             for i in range(len(data)):
                 data_length = data[i].size(0)
@@ -126,11 +128,110 @@ class Batch(object):
         else:
             return None
 
+    def pin_memory(self):
+        for key, tensor in self.tensors.items():
+            self.tensors[key] = tensor.pin_memory()
+        return self
+
     def cuda(self, fp16=False):
         for key, tensor in self.tensors.items():
             if tensor.type() == "torch.FloatTensor" and fp16:
                 self.tensors[key] = tensor.half()
-            self.tensors[key] = self.tensors[key].cuda()
+            # asynchronous when the batch has been pinned
+            self.tensors[key] = self.tensors[key].cuda(non_blocking=True)
+
+def get_sizes(data):
+    """
+    :param data: list of tensors or an indexed dataset
+    :return: the lengths (first dimension) of all items as a numpy array
+    """
+    if hasattr(data, 'sizes') and hasattr(data, 'dim_offsets'):
+        # indexed datasets already store the size of every item in their index
+        return np.asarray(data.sizes)[np.asarray(data.dim_offsets[:-1])].astype(np.int64)
+
+    return np.array([x.size(0) for x in data], dtype=np.int64)
+
+
+def allocate_batch(lengths, batch_size_words, batch_size_sents, multiplier=1, pad_count=True):
+    """
+    Group consecutive sentences into mini-batches
+    :param lengths: numpy array with the length of every sentence
+    :param batch_size_words: maximum number of words in a batch (padding included if pad_count)
+    :param batch_size_sents: maximum number of sentences in a batch
+    :param multiplier: the number of sentences in a batch is cut to a multiple of this value
+    :param pad_count: count the padded size (max length * sentences) instead of the sum of lengths
+    :return: list of batches (lists of sentence indices)
+
+    A batch is closed before the first sentence that makes it oversized. Instead of checking
+    the sentences one by one, the sizes of all candidate batches are computed at once with
+    cumulative max / sum over the following lengths, and the first oversized one is the cut-off.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n_sents = len(lengths)
+    batches = []
+
+    start = 0
+    # the sizes recorded for the sentences of the current batch:
+    # when a batch is cut to fit the multiplier, the sentences carried over to the next batch
+    # keep the sizes recorded for the first sentences of the cut batch (as the sequential version did)
+    cur_sizes = []
+    span = 128
+
+    while True:
+
+        # the next sentence to add
+        first = start + len(cur_sizes)
+        if first >= n_sents:
+            break
+
+        # the sentence making the batch exceed batch_size_sents is the last one to look at
+        limit = start + batch_size_sents if start + batch_size_sents >= first else n_sents
+        limit = min(limit, n_sents)
+
+        last = min(first + span, limit)
+        while True:
+            window = lengths[first:last]
+
+            if pad_count:
+                # size of the batch ending at each sentence of the window: max length * number of sentences
+                sizes = np.maximum.accumulate(window)
+                np.maximum(sizes, max(cur_sizes, default=0), out=sizes)
+                sizes *= np.arange(first - start + 1, last - start + 1)
+            else:
+                sizes = np.cumsum(window) + sum(cur_sizes)
+
+            oversized = np.flatnonzero(sizes > batch_size_words)
+
+            if len(oversized) > 0 or last == limit:
+                break
+            last = min(first + 2 * (last - first), limit)
+
+        if len(oversized) > 0:
+            cut = first + oversized[0]
+        elif limit < n_sents:
+            # the batch already has batch_size_sents sentences
+            cut = limit
+        else:
+            break
+
+        # cut-off the current batch to fit the multiplier
+        current_size = cut - start
+        scaled_size = max(multiplier * (current_size // multiplier), current_size % multiplier)
+
+        # a sentence longer than batch_size_words alone ends up in its own batch
+        if scaled_size > 0:
+            batches.append(list(range(start, start + scaled_size)))
+
+        recorded = cur_sizes + lengths[first:cut].tolist()
+        cur_sizes = recorded[:current_size - scaled_size] + [int(lengths[cut])]
+        start = start + scaled_size
+
+    # catch the last batch
+    if start < n_sents:
+        batches.append(list(range(start, n_sents)))
+
+    return batches
+
 
 class Dataset(object):
     def __init__(self, src_data, tgt_data, batch_size_words,
@@ -157,11 +258,23 @@ class Dataset(object):
         self.sort_by_target = sort_by_target
 
         self.pad_count = True
+
+        # the lengths of all sentences, used to allocate the batches without touching the data
+        self.src_sizes = get_sizes(self.src) if self.src is not None else None
+        self.tgt_sizes = get_sizes(self.tgt) if self.tgt is not None else None
+
         # if self.balance:
         self.allocate_batch()
         self.cur_index = 0
         self.batchOrder = None
 
+        # sharding of the batches between the workers of data parallel training (see set_shard)
+        self.rank = 0
+        self.world_size = 1
+        self.even_shards = True
+        self.generator = None
+        self.full_order = None
+
         if augment:
             self.augmenter = Augmenter()
         else:
@@ -177,65 +290,19 @@ class Dataset(object):
 
     # This function allocates the mini-batches (grouping sentences with the same size)
     def allocate_batch(self):
-            
-        self.batches = []
-        cur_batch = []
-        cur_batch_size = 0
-        cur_batch_sizes = [0]
-        
-        def oversize_(cur_batch):
-
-            if len(cur_batch) == self.batch_size_sents:
-                    return True
 
-            if not self.pad_count:
-                if cur_batch_size + sentence_length > self.batch_size_words:
-                    return True
-            else:
-                if (max(max(cur_batch_sizes), sentence_length)) * (len(cur_batch)+1) > self.batch_size_words:
-                    return True
-            return False
+        if self.tgt is not None and self.src is not None:
+            lengths = np.maximum(self.tgt_sizes - 1, self.src_sizes)
+        elif self.tgt is not None:
+            lengths = self.tgt_sizes - 1
+        else:
+            lengths = self.src_sizes
 
-        i = 0
-        while i < self.fullSize:
+        self.batches = allocate_batch(lengths, self.batch_size_words, self.batch_size_sents,
+                                      multiplier=self.multiplier, pad_count=self.pad_count)
 
-            if self.tgt is not None and self.src is not None:
-                sentence_length = max(self.tgt[i].size(0) - 1, self.src[i].size(0))
-            elif self.tgt is not None:
-                sentence_length = self.tgt[i].size(0) - 1
-            else:
-                sentence_length = self.src[i].size(0)
-
-            oversized = oversize_(cur_batch)
-            # if the current item makes the batch exceed max size
-            # then we create a new batch
-            if oversized:
-
-                # cut-off the current list to fit the multiplier
-                current_size = len(cur_batch)
-                scaled_size = max(
-                    self.multiplier * (current_size // self.multiplier),
-                    current_size % self.multiplier)
-
-                batch_ =  cur_batch[:scaled_size]
-                self.batches.append(batch_) # add this batch into the batch list
-
-                cur_batch = cur_batch[scaled_size:] # reset the current batch
-                cur_batch_sizes = cur_batch_sizes[:-scaled_size]
-                cur_batch_size  = sum(cur_batch_sizes)
-
-            cur_batch.append(i)
-            cur_batch_size += sentence_length
-            cur_batch_sizes.append(sentence_length)
-
-            i = i + 1
-            
-        # catch the last batch
-        if len(cur_batch) > 0:
-            self.batches.append(cur_batch)
-        
         self.num_batches = len(self.batches)
-                
+
     def __getitem__(self, index):
         assert index < self.num_batches, "%d > %d" % (index, self.num_batches)
         
@@ -258,25 +325,51 @@ class Dataset(object):
         return batch
 
     def __len__(self):
-        return self.num_batches
+        # only the batches of this worker when the order is sharded
+        return self.num_batches if self.batchOrder is None else len(self.batchOrder)
+
+    def set_shard(self, rank, world_size, even=True, seed=0):
+        """
+        Only iterate over the part of the batches of one of world_size workers: every order is created
+        for all of the batches (with the same random permutations on all of the workers, from seed)
+        and the worker takes every world_size-th batch from rank.
+        With even shards all of the workers get the same number of batches (the last few ones are dropped)
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.even_shards = even
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def set_order(self, order):
+        """Iterate over the given order of all of the batches (the part of this worker when sharded)"""
+        self.full_order = order
+        if self.world_size > 1:
+            size = len(order) // self.world_size if self.even_shards else None
+            order = order[self.rank::self.world_size][:size]
+        self.batchOrder = order
+        self.cur_index = 0
+
+        return self.batchOrder
 
     # genereate a new batch - order (static)
     def create_order(self, random=True):
         
         if random:
-            self.batchOrder = torch.randperm(self.num_batches)
+            if self.generator is not None:
+                order = torch.randperm(self.num_batches, generator=self.generator)
+            else:
+                order = torch.randperm(self.num_batches)
         else:
-            self.batchOrder = torch.arange(self.num_batches).long()
+            order = torch.arange(self.num_batches).long()
 
-        self.cur_index = 0
-        
-        return self.batchOrder
+        return self.set_order(order)
 
     # return the next batch according to the iterator
     def next(self, curriculum=False, reset=True, split_sizes=1):
 
          # reset iterator if reach data size limit
-        if self.cur_index >= self.num_batches:
+        if self.cur_index >= len(self):
             if reset:
                 self.cur_index = 0
             else: return None
@@ -295,9 +388,14 @@ class Dataset(object):
 
     def shuffle(self):
         data = list(zip(self.src, self.tgt))
-        self.src, self.tgt = zip(*[data[i] for i in torch.randperm(len(data))])
+        if self.generator is not None:
+            # the same permutation on all of the workers
+            permutation = torch.randperm(len(data), generator=self.generator)
+        else:
+            permutation = torch.randperm(len(data))
+        self.src, self.tgt = zip(*[data[i] for i in permutation])
         
     def set_index(self, iteration):
         
-        assert(iteration >= 0 and iteration < self.num_batches)
+        assert(iteration >= 0 and iteration < len(self))
         self.cur_index = iteration
@@ -1,5 +1,7 @@
 import torch
 import re
+import numpy as np
+from functools import lru_cache
 
 
 class Dict(object):
@@ -21,6 +23,30 @@ class Dict(object):
     def size(self):
         return len(self.idxToLabel)
 
+    def __getstate__(self):
+        # the caches are rebuilt on demand
+        state = self.__dict__.copy()
+        state.pop('_lookup_cache', None)
+        state.pop('_label_table', None)
+        return state
+
+    def _clear_caches(self):
+        self.__dict__.pop('_lookup_cache', None)
+        self.__dict__.pop('_label_table', None)
+
+    def _cached_lookup(self, key):
+        "Index of `key` (None if unknown), with an LRU cache for the frequent tokens."
+        lookup = self.__dict__.get('_lookup_cache')
+        if lookup is None:
+            lower, labelToIdx = self.lower, self.labelToIdx
+
+            def _lookup(key):
+                return labelToIdx.get(key.lower() if lower else key)
+
+            lookup = self._lookup_cache = lru_cache(maxsize=65536)(_lookup)
+
+        return lookup(key)
+
     def loadFile(self, filename):
         "Load entries from a file."
         for line in open(filename):
@@ -34,7 +60,6 @@ class Dict(object):
             label = line[:right_space_idx]
             idx = int(line[right_space_idx+1:])
 
-            print(label, idx)
             self.add(label, idx)
 
     def writeFile(self, filename):
@@ -70,8 +95,8 @@ class Dict(object):
         for label in labels:
             self.addSpecial(label)
 
-    def add(self, label, idx=None):
-        "Add `label` in the dictionary. Use `idx` as its index if given."
+    def add(self, label, idx=None, count=1):
+        "Add `label` in the dictionary. Use `idx` as its index if given. `count` is the number of occurrences."
         label = label.lower() if self.lower else label
         if idx is not None:
             self.idxToLabel[idx] = label
@@ -84,10 +109,12 @@ class Dict(object):
                 self.idxToLabel[idx] = label
                 self.labelToIdx[label] = idx
 
+        self._clear_caches()
+
         if idx not in self.frequencies:
-            self.frequencies[idx] = 1
+            self.frequencies[idx] = count
         else:
-            self.frequencies[idx] += 1
+            self.frequencies[idx] += count
 
         return idx
 
@@ -153,3 +180,56 @@ class Dict(object):
                 break
 
         return labels
+
+    def convertToIdxBatch(self, sents, unkWord, bosWord=None, eosWord=None):
+        """
+        Convert a list of label sequences to indices in one go.
+        Return a flat int32 array with all the indices, the offsets of the sequences in it
+        (sequence i is data[offsets[i]:offsets[i+1]]) and the number of unknown labels.
+        """
+        unk = self.lookup(unkWord)
+        prefix = [self.lookup(bosWord)] if bosWord is not None else []
+        suffix = [self.lookup(eosWord)] if eosWord is not None else []
+
+        lengths = np.array([len(sent) for sent in sents], dtype=np.int64) + len(prefix) + len(suffix)
+        offsets = np.zeros(len(sents) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        vec = []
+        n_unk = 0
+        lookup = self._cached_lookup
+        for sent in sents:
+            ids = [lookup(label) for label in sent]
+            n_unk += ids.count(None)
+            vec += prefix
+            vec += [unk if i is None else i for i in ids]
+            vec += suffix
+
+        return np.array(vec, dtype=np.int32), offsets, n_unk
+
+    def convertToLabelsBatch(self, idx, stop=None):
+        """
+        Convert a batch of index sequences (2D tensor / array or list of sequences) to labels.
+        If index `stop` is reached in a sequence, convert it and stop there.
+        """
+        table = self.__dict__.get('_label_table')
+        if table is None:
+            table = self._label_table = np.array([self.idxToLabel.get(i) for i in range(self.size())],
+                                                 dtype=object)
+
+        if torch.is_tensor(idx):
+            idx = idx.cpu().numpy()
+
+        labels = []
+        for seq in idx:
+            if torch.is_tensor(seq):
+                # e.g. the hypotheses of the beam search, possibly on the GPU
+                seq = seq.cpu().numpy()
+            seq = np.asarray(seq, dtype=np.int64)
+            if stop is not None:
+                stops = np.flatnonzero(seq == stop)
+                if len(stops) > 0:
+                    seq = seq[:stops[0] + 1]
+            labels.append(table[seq].tolist())
+
+        return labels
@@ -3,10 +3,14 @@ import onmt.modules
 import torch.nn as nn
 import torch
 import math
-from onmt.ModelConstructor import build_model, build_language_model
+from onmt.ModelConstructor import build_model, build_language_model, quantize_model
+from onmt.ScriptedModel import ScriptedModel
+from onmt.SlimModel import slim_model_exists, load_slim_model
+from onmt.utils import load_checkpoint
 from ae.Autoencoder import Autoencoder
-import torch.nn.functional as F
 import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 model_list = ['transformer', 'stochastic_transformer', 'fusion_network']
 
@@ -24,6 +28,9 @@ class EnsembleTranslator(object):
         self.models = list()
         self.model_types = list()
 
+        if opt.quantize and (opt.cuda or opt.fp16):
+            raise ValueError("Quantized models can only be used on CPU, without -fp16")
+
         # models are string with | as delimiter
         models = opt.model.split("|")
 
@@ -34,45 +41,26 @@ class EnsembleTranslator(object):
         for i, model in enumerate(models):
             if opt.verbose:
                 print('Loading model from %s' % model)
-            checkpoint = torch.load(model,
-                                    map_location=lambda storage, loc: storage)
-
-            model_opt = checkpoint['opt']
-
-            if i == 0:
-                if "src" in checkpoint['dicts']:
-                    self.src_dict = checkpoint['dicts']['src']
-                else:
-                    self._type = "audio"
-                self.tgt_dict = checkpoint['dicts']['tgt']
-
-            # Build model from the saved option
-            # if hasattr(model_opt, 'fusion') and model_opt.fusion == True:
-            #     print("* Loading a FUSION model")
-            #     model = build_fusion(model_opt, checkpoint['dicts'])
-            # else:
-            #     model = build_model(model_opt, checkpoint['dicts'])
-            model = build_model(model_opt, checkpoint['dicts'])
-            model.load_state_dict(checkpoint['model'])
-
-            if model_opt.model in model_list:
-                # if model.decoder.positional_encoder.len_max < self.opt.max_sent_length:
-                #     print("Not enough len to decode. Renewing .. ")
-                #     model.decoder.renew_buffer(self.opt.max_sent_length)
+            if ScriptedModel.exists(model):
+                # model exported by export_model.py: nothing to build
+                if opt.quantize or opt.shortlist:
+                    raise ValueError("Exported models can not be quantized or use a shortlist")
+                model = ScriptedModel(model)
+                model_opt, dicts = model.opt, model.dicts
+                if self.opt.max_sent_length > model.max_len:
+                    # the positions of the exported model are fixed: the translations can not be longer
+                    print("WARNING: the maximum output length is limited to %d by the exported model"
+                          % model.max_len)
+                    self.opt.max_sent_length = model.max_len
                 model.renew_buffer(self.opt.max_sent_length)
-
-            if opt.fp16:
-                model = model.half()
-
-            if opt.cuda:
-                model = model.cuda()
+            elif slim_model_exists(model):
+                # model written by strip_model.py: the weights are memory-mapped
+                model, model_opt, dicts = load_slim_model(model)
+                model = self.prepare_model(model, model_opt)
             else:
-                model = model.cpu()
-
-            model.eval()
+                model, model_opt, dicts = self.build_model(model)
 
-            self.models.append(model)
-            self.model_types.append(model_opt.model)
+            self.add_model(model, model_opt, dicts, i)
 
         # language model
         if opt.lm is not None:
@@ -83,7 +71,10 @@ class EnsembleTranslator(object):
 
             lm_opt = lm_chkpoint['opt']
 
-            lm_model = build_language_model(lm_opt, checkpoint['dicts'])
+            lm_model = build_language_model(lm_opt, dicts)
+
+            if opt.quantize:
+                lm_model = quantize_model(lm_model, opt.quantize)
 
             if opt.fp16:
                 lm_model = lm_model.half()
@@ -97,6 +88,28 @@ class EnsembleTranslator(object):
 
         self.cuda = opt.cuda
         self.ensemble_op = opt.ensemble_op
+        self._stack_buffer = None
+        self._output_buffer = None
+        self._index_buffer = None
+
+        # run each model of the ensemble in its own worker thread, on its own CPU cores
+        self.executors = None
+        if opt.parallel_ensemble and self.n_models > 1:
+            self.executors = self._create_executors()
+
+        # source to target word table for the vocabulary shortlist (see build_shortlist.py)
+        # and the target words by decreasing frequency in the training data
+        self.shortlist_table = None
+        self.shortlist_frequent = None
+        if opt.shortlist:
+            if opt.verbose:
+                print('Loading shortlist table from %s' % opt.shortlist)
+            shortlist = torch.load(opt.shortlist)
+            if 'frequent' not in shortlist:
+                raise ValueError("The shortlist table %s has no target word frequencies, "
+                                 "it has to be rebuilt with build_shortlist.py" % opt.shortlist)
+            self.shortlist_table = shortlist['table'][:, :opt.shortlist_k].contiguous()
+            self.shortlist_frequent = shortlist['frequent'][:opt.shortlist_frequent]
 
         if opt.autoencoder is not None:
             if opt.verbose:
@@ -128,6 +141,146 @@ class EnsembleTranslator(object):
         if opt.verbose:
             print('Done')
 
+    def build_model(self, path):
+        """Build a model from a checkpoint"""
+        checkpoint = load_checkpoint(path)[0]
+
+        model_opt = checkpoint['opt']
+        dicts = checkpoint['dicts']
+
+        # Build model from the saved option
+        # if hasattr(model_opt, 'fusion') and model_opt.fusion == True:
+        #     print("* Loading a FUSION model")
+        #     model = build_fusion(model_opt, checkpoint['dicts'])
+        # else:
+        #     model = build_model(model_opt, checkpoint['dicts'])
+        model = build_model(model_opt, dicts)
+        if checkpoint.get('quantize') is not None:
+            # pre-quantized checkpoint (see quantize_model.py): the model has to be quantized before loading
+            model = quantize_model(model, checkpoint['quantize'])
+        model.load_state_dict(checkpoint['model'])
+
+        if self.opt.ema:
+            # use the moving average of the parameters kept during training
+            from onmt.train_utils.ema import ExponentialMovingAverage
+            if checkpoint.get('ema') is None:
+                raise ValueError("The checkpoint %s has no moving average of the parameters" % path)
+            ema_state = checkpoint['ema']
+            ema = ExponentialMovingAverage(model, decay=ema_state['decay'], interval=ema_state['interval'])
+            ema.load_state_dict(ema_state)
+            ema.copy_to_model()
+            del ema
+
+        model = self.prepare_model(model, model_opt, quantized=checkpoint.get('quantize') is not None)
+
+        return model, model_opt, dicts
+
+    def prepare_model(self, model, model_opt, quantized=False):
+
+        if model_opt.model in model_list:
+            # if model.decoder.positional_encoder.len_max < self.opt.max_sent_length:
+            #     print("Not enough len to decode. Renewing .. ")
+            #     model.decoder.renew_buffer(self.opt.max_sent_length)
+            model.renew_buffer(self.opt.max_sent_length)
+
+        if self.opt.quantize and not quantized:
+            model = quantize_model(model, self.opt.quantize)
+
+        return model
+
+    def add_model(self, model, model_opt, dicts, i):
+        """Put a loaded model on the right device / type and add it to the ensemble"""
+        if i == 0:
+            if "src" in dicts:
+                self.src_dict = dicts['src']
+            else:
+                self._type = "audio"
+            self.tgt_dict = dicts['tgt']
+
+        if self.opt.fp16:
+            model = model.half()
+
+        if self.opt.cuda:
+            model = model.cuda()
+        else:
+            model = model.cpu()
+
+        model.eval()
+
+        self.models.append(model)
+        self.model_types.append(model_opt.model)
+
+    def _create_executors(self):
+        """
+        One single thread executor per model (so that a model always runs in the same thread).
+        The available CPU cores are split between the models, and the intra-op thread count is
+        set to the number of cores of a model (otherwise every model would run all the threads on its cores)
+        """
+        def init_worker(n_threads, cores=None):
+            if cores is not None:
+                # on Linux, pid 0 is the calling thread
+                os.sched_setaffinity(0, cores)
+            # the thread count is shared by all threads in torch: every model has the same number of cores
+            torch.set_num_threads(n_threads)
+
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(torch.get_num_threads()))
+        n_cores = max(1, len(cores) // self.n_models)
+
+        executors = []
+        for k in range(self.n_models):
+            if hasattr(os, 'sched_getaffinity') and len(cores) >= self.n_models:
+                initargs = (n_cores, cores[k * n_cores:(k + 1) * n_cores])
+            else:
+                initargs = (n_cores,)
+            executors.append(ThreadPoolExecutor(max_workers=1, initializer=init_worker, initargs=initargs))
+
+        return executors
+
+    def _run_models(self, function, *args):
+        """
+        Call function(k, *args) for every model k, in parallel if the models have their own workers
+        :return: the list of results
+        """
+        if self.executors is None:
+            return [function(k, *args) for k in range(self.n_models)]
+
+        def run(k):
+            # the gradient mode is set per thread
+            with torch.no_grad():
+                return function(k, *args)
+
+        futures = [self.executors[k].submit(run, k) for k in range(self.n_models)]
+        return [future.result() for future in futures]
+
+    def _build_shortlist(self, batch):
+        """
+        The target words that can be produced for this batch (sorted):
+        the special words, the most frequent words of the training data
+        and the candidates of every source word from the shortlist table
+        """
+        src = batch.get('source')
+        if src.dim() != 2:
+            return None
+
+        special = torch.arange(0, onmt.Constants.EOS + 1).long()
+        src_words = src.data.cpu().contiguous().view(-1)
+        src_words = src_words[src_words.lt(self.shortlist_table.size(0))]
+        candidates = self.shortlist_table.index_select(0, src_words).view(-1)
+
+        shortlist = torch.unique(torch.cat([special, self.shortlist_frequent, candidates]), sorted=True)
+
+        # the special words keep their index: PAD and EOS are found at the same place in the output
+        return shortlist.cuda() if self.cuda else shortlist
+
+    def _set_shortlist(self, shortlist):
+        for model in self.models:
+            model.generator[0].set_shortlist(shortlist)
+        if self.opt.lm:
+            self.lm_model.generator[0].set_shortlist(shortlist)
+
     def init_beam_accum(self):
         self.beam_accum = {
             "predicted_ids": [],
@@ -137,60 +290,47 @@ class EnsembleTranslator(object):
 
     # Combine distributions from different models
     def _combine_outputs(self, outputs):
-
-        if len(outputs) == 1:
+        """
+        Combine the log probabilities of the models, in the log domain:
+            mean: log of the average probability
+            gmean / logSum: normalized geometric mean of the probabilities (average log prob, renormalized)
+            max / min: element-wise max / min of the log probabilities
+        The model outputs are stacked into a buffer and the result is written into another one,
+        both kept between the decoding steps
+        """
+        n_models = len(outputs)
+
+        if n_models == 1:
             return outputs[0]
 
-        if self.ensemble_op == "logSum":
-            output = (outputs[0])
-
-            # sum the log prob
-            for i in range(1, len(outputs)):
-                output += (outputs[i])
-
-            output.div_(len(outputs))
-
-            # output = torch.log(output)
-            output = F.log_softmax(output, dim=-1)
-        elif self.ensemble_op == "mean":
-            output = torch.exp(outputs[0])
-
-            # sum the log prob
-            for i in range(1, len(outputs)):
-                output += torch.exp(outputs[i])
-
-            output.div_(len(outputs))
-            # output = torch.log(output)
-            output = torch.log(output)
+        first = outputs[0]
+        if self._stack_buffer is None or self._stack_buffer.type() != first.type() \
+                or self._stack_buffer.device != first.device:
+            self._stack_buffer = first.new()
+            self._output_buffer = first.new()
+            self._index_buffer = first.new().long()
+
+        # the buffers are resized explicitly (the batch shrinks as the sentences are finished)
+        self._stack_buffer.resize_((n_models,) + first.size())
+        self._index_buffer.resize_(first.size())
+        stacked = torch.stack([outputs[i] for i in range(n_models)], dim=0, out=self._stack_buffer)
+        output = self._output_buffer.resize_as_(first)
+
+        if self.ensemble_op == "mean":
+            # logsumexp subtracts the max over the models: very unlikely words do not underflow to -inf
+            torch.logsumexp(stacked, 0, out=output)
+            output.sub_(math.log(n_models))
+        elif self.ensemble_op in ["gmean", "logSum"]:
+            torch.mean(stacked, 0, out=output)
+            output.sub_(torch.logsumexp(output, -1, keepdim=True))
         elif self.ensemble_op == "max":
-            output = outputs[0]
-
-            for i in range(1, len(outputs)):
-                output = torch.max(output,outputs[i])
-
+            torch.max(stacked, 0, out=(output, self._index_buffer))
         elif self.ensemble_op == "min":
-            output = outputs[0]
-
-            for i in range(1, len(outputs)):
-                output = torch.min(output,outputs[i])
-
-
-        elif self.ensemble_op == 'gmean':
-            output = torch.exp(outputs[0])
-
-            # geometric mean of the probabilities
-            for i in range(1, len(outputs)):
-                output *= torch.exp(outputs[i])
-
-            # have to normalize
-            output.pow_(1.0 / float(len(outputs)))
-            norm_ = torch.norm(output, p=1, dim=-1)
-            output.div_(norm_.unsqueeze(-1))
-
-            output = torch.log(output)
+            torch.min(stacked, 0, out=(output, self._index_buffer))
         else:
             raise ValueError(
-                'Emsemble operator needs to be "mean" or "logSum", the current value is %s' % self.ensemble_op)
+                'Emsemble operator needs to be "mean", "gmean", "logSum", "max" or "min", '
+                'the current value is %s' % self.ensemble_op)
         return output
 
     # Take the average of attention scores
@@ -208,22 +348,24 @@ class EnsembleTranslator(object):
     def build_data(self, src_sents, tgt_sents):
         # This needs to be the same as preprocess.py.
 
-        if self.start_with_bos:
-            src_data = [self.src_dict.convertToIdx(b,
-                                                   onmt.Constants.UNK_WORD,
-                                                   onmt.Constants.BOS_WORD)
-                        for b in src_sents]
-        else:
-            src_data = [self.src_dict.convertToIdx(b,
-                                                   onmt.Constants.UNK_WORD)
-                        for b in src_sents]
+        def split(data, offsets):
+            # one tensor (view) per sentence
+            data = torch.from_numpy(data).long()
+            return [data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+        bos_word = onmt.Constants.BOS_WORD if self.start_with_bos else None
+        src_data, src_offsets, _ = self.src_dict.convertToIdxBatch(src_sents,
+                                                                   onmt.Constants.UNK_WORD,
+                                                                   bos_word)
+        src_data = split(src_data, src_offsets)
 
         tgt_data = None
         if tgt_sents:
-            tgt_data = [self.tgt_dict.convertToIdx(b,
-                                                   onmt.Constants.UNK_WORD,
-                                                   onmt.Constants.BOS_WORD,
-                                                   onmt.Constants.EOS_WORD) for b in tgt_sents]
+            tgt_data, tgt_offsets, _ = self.tgt_dict.convertToIdxBatch(tgt_sents,
+                                                                       onmt.Constants.UNK_WORD,
+                                                                       onmt.Constants.BOS_WORD,
+                                                                       onmt.Constants.EOS_WORD)
+            tgt_data = split(tgt_data, tgt_offsets)
 
         return onmt.Dataset(src_data, tgt_data, sys.maxsize
                             , data_type=self._type,
@@ -242,11 +384,13 @@ class EnsembleTranslator(object):
         return onmt.Dataset(src_data, tgt_data, sys.maxsize,
                             data_type=self._type, batch_size_sents=self.opt.batch_size)
 
-    def build_target_tokens(self, pred, src, attn):
-        tokens = self.tgt_dict.convertToLabels(pred, onmt.Constants.EOS)
-        tokens = tokens[:-1]  # EOS
+    def build_target_tokens(self, preds):
+        """Convert the hypotheses (list of index sequences) to words in one go"""
+        all_tokens = self.tgt_dict.convertToLabelsBatch(preds, onmt.Constants.EOS)
 
-        return tokens
+        # the hypotheses cut at the maximum length have no EOS
+        return [tokens[:-1] if len(tokens) > 0 and tokens[-1] == onmt.Constants.EOS_WORD else tokens
+                for tokens in all_tokens]
 
     def translate_batch(self, batch):
 
@@ -268,18 +412,57 @@ class EnsembleTranslator(object):
 
         #  (3) Start decoding
 
-        # time x batch * beam
-
-        # initialize the beam
-        beam = [onmt.Beam(beam_size, self.opt.cuda) for k in range(batch_size)]
-
-        batch_idx = list(range(batch_size))
+        # The search runs on all sentences at once: the active hypotheses are kept in (batch x beam) tensors,
+        # while the decoder states are (beam * remaining sentences) in beam-major order.
+        # Each step keeps the 2 * beam best extensions: those ending with EOS (among the first beam ones)
+        # are finished and put aside, the beam best others are continued.
+        # A sentence is complete when no active hypothesis can beat its n_best finished ones,
+        # or when it reaches its maximum length; it is then removed from the states.
+        tt = self.tt
+        pad, eos = onmt.Constants.PAD, onmt.Constants.EOS
+        n_best = min(self.opt.n_best, beam_size)
+        normalize = self.opt.normalize
+        alpha = self.alpha
+
+        # maximum output length of each sentence (max_len_a * source length + max_len_b)
+        if self.opt.max_len_a > 0 or self.opt.max_len_b > 0:
+            src_lengths = batch.get('src_length').tolist()
+            max_lengths = [max(1, min(int(self.opt.max_len_a * l + self.opt.max_len_b), self.opt.max_sent_length))
+                           for l in src_lengths]
+        else:
+            max_lengths = [self.opt.max_sent_length] * batch_size
+        max_lengths = tt.LongTensor(max_lengths)
+
+        def length_penalty(score, length):
+            return score / math.pow(length, alpha) if normalize else score
+
+        # at the first step all hypotheses are the same: only the first one is kept
+        scores = tt.FloatTensor(batch_size, beam_size).fill_(-float('inf'))
+        scores[:, 0] = 0
+        tokens = tt.LongTensor(batch_size, beam_size).fill_(onmt.Constants.BOS)
+        # the tokens and attention of the active hypotheses so far
+        seqs, seq_attns = None, None
+
+        # finished hypotheses (score, hyp, attn, length, score used for ranking) of every sentence
+        finalized = [[] for b in range(batch_size)]
+        # the ranking score to beat for every sentence (the n_best-th best finished one)
+        worst_best = [-float('inf')] * batch_size
+        beam_history = [[] for b in range(batch_size)]
+
+        active = tt.LongTensor(list(range(batch_size)))
         remaining_sents = batch_size
 
+        # restrict the output vocabulary to the shortlist of the batch
+        # (the word indices of the output are then positions in the shortlist)
+        shortlist = self._build_shortlist(batch) if self.shortlist_table is not None else None
+        if shortlist is not None:
+            self._set_shortlist(shortlist)
+
         decoder_states = dict()
 
+        states = self._run_models(lambda k: self.models[k].create_decoder_state(batch, beam_size))
         for i in range(self.n_models):
-            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size)
+            decoder_states[i] = states[i]
 
         if self.opt.lm:
             lm_decoder_states = self.lm_model.create_decoder_state(batch, beam_size)
@@ -287,26 +470,25 @@ class EnsembleTranslator(object):
         for i in range(self.opt.max_sent_length):
             # Prepare decoder input.
 
-            # input size: 1 x ( batch * beam )
-            input = torch.stack([b.getCurrentState() for b in beam
-                                 if not b.done]).t().contiguous().view(1, -1)
+            # input size: 1 x ( beam * remaining sentences )
+            input = tokens.t().contiguous().view(1, -1)
 
             decoder_input = input
-            print(input)
 
             # require batch first for everything
             outs = dict()
             attns = dict()
 
+            # run decoding on the models (in parallel with -parallel_ensemble)
+            decoder_outputs = self._run_models(lambda k: self.models[k].step(decoder_input.clone(),
+                                                                             decoder_states[k]))
+
             for k in range(self.n_models):
                 # decoder_hidden, coverage = self.models[k].decoder.step(decoder_input.clone(), decoder_states[k])
 
-                # run decoding on the model
-                decoder_output = self.models[k].step(decoder_input.clone(), decoder_states[k])
-
                 # extract the required tensors from the output (a dictionary)
-                outs[k] = decoder_output['log_prob']
-                attns[k] = decoder_output['coverage']
+                outs[k] = decoder_outputs[k]['log_prob']
+                attns[k] = decoder_outputs[k]['coverage']
 
             # for ensembling models
             out = self._combine_outputs(outs)
@@ -321,55 +503,127 @@ class EnsembleTranslator(object):
                 # out = out + 0.3 * lm_out
 
                 out = lm_out
-            word_lk = out.view(beam_size, remaining_sents, -1) \
-                .transpose(0, 1).contiguous()
-            attn = attn.view(beam_size, remaining_sents, -1) \
-                .transpose(0, 1).contiguous()
-
-            active = []
 
-            for b in range(batch_size):
-                if beam[b].done:
-                    continue
-
-                idx = batch_idx[b]
-                if not beam[b].advance(word_lk.data[idx], attn.data[idx]):
-                    active += [b]
-
-                for j in range(self.n_models):
-                    decoder_states[j].update_beam(beam, b, remaining_sents, idx)
-
-                if self.opt.lm:
-                    lm_decoder_states.update_beam(beam, b, remaining_sents, idx)
+            # remaining sentences x beam x vocab
+            n_words = out.size(-1)
+            word_lk = out.view(beam_size, remaining_sents, -1).transpose(0, 1).contiguous().float()
+            attn = attn.view(beam_size, remaining_sents, -1).transpose(0, 1)
+            word_lk.select(2, pad).fill_(-float('inf'))
+
+            # the sentences reaching their maximum length can only produce EOS
+            at_max = max_lengths.index_select(0, active).le(i + 1)
+            if at_max.any():
+                rows = at_max.nonzero().squeeze(1)
+                eos_lk = word_lk.select(2, eos).index_select(0, rows)
+                word_lk.index_fill_(0, rows, -float('inf'))
+                word_lk.select(2, eos).index_copy_(0, rows, eos_lk)
+
+            # one topk over all the extensions of all the hypotheses of each sentence
+            beam_lk = word_lk + scores.unsqueeze(2)
+            cand_scores, cand_ids = beam_lk.view(remaining_sents, -1).topk(2 * beam_size, 1, True, True)
+
+            # cand_ids is flattened beam x word array, so calculate which
+            # word and beam each score came from
+            cand_prev = cand_ids // n_words
+            cand_words = cand_ids - cand_prev * n_words
+            if shortlist is not None:
+                cand_words = shortlist.index_select(0, cand_words.view(-1)).view_as(cand_words)
+            cand_eos = cand_words.eq(eos)
+
+            # put aside the finished hypotheses
+            finished = cand_eos.narrow(1, 0, beam_size) & cand_scores.narrow(1, 0, beam_size).ne(-float('inf'))
+            if finished.any():
+                for j, c in finished.nonzero().tolist():
+                    b = active[j].item()
+                    prev = cand_prev[j, c].item()
+                    hyp = (seqs[j, prev].tolist() if seqs is not None else []) + [eos]
+                    hyp_attn = attn[j, prev].unsqueeze(0)
+                    if seq_attns is not None:
+                        hyp_attn = torch.cat([seq_attns[j, prev], hyp_attn], 0)
+                    score = cand_scores[j, c].item()
+                    finalized[b].append((score, hyp, hyp_attn, i + 1, length_penalty(score, i + 1)))
+
+                    if len(finalized[b]) >= n_best:
+                        finalized[b].sort(key=lambda h: -h[4])
+                        worst_best[b] = finalized[b][n_best - 1][4]
+
+            # continue the best hypotheses which are not finished
+            cand_scores = cand_scores.masked_fill(cand_eos, -float('inf'))
+            scores, sel = cand_scores.topk(beam_size, 1, True, True)
+            prev_k = cand_prev.gather(1, sel)
+            tokens = cand_words.gather(1, sel)
+
+            attn = attn.gather(1, prev_k.unsqueeze(2).expand(-1, -1, attn.size(2))).unsqueeze(2)
+            if seqs is None:
+                seqs, seq_attns = tokens.unsqueeze(2), attn
+            else:
+                seqs = torch.cat([seqs.gather(1, prev_k.unsqueeze(2).expand_as(seqs)), tokens.unsqueeze(2)], 2)
+                seq_attns = torch.cat([seq_attns.gather(1, prev_k.view(remaining_sents, beam_size, 1, 1)
+                                                        .expand_as(seq_attns)), attn], 2)
 
-            if not active:
+            if self.beam_accum:
+                for j, b in enumerate(active.tolist()):
+                    beam_history[b].append((prev_k[j].tolist(), tokens[j].tolist(), scores[j].tolist()))
+
+            # End condition: the sentence has its n_best finished hypotheses and no active hypothesis
+            # can be better than them (the scores only decrease, the length penalty is bounded by the
+            # maximum length), or no hypothesis is left to continue (all of them scored -inf)
+            if normalize:
+                best_possible = scores[:, 0] / max_lengths.index_select(0, active).float().pow(alpha)
+            else:
+                best_possible = scores[:, 0]
+            n_finalized = tt.LongTensor([len(finalized[b]) for b in active.tolist()])
+            done = n_finalized.ge(n_best) & best_possible.le(tt.FloatTensor(worst_best).index_select(0, active))
+            done = done | scores[:, 0].eq(-float('inf')) | at_max
+            if done.all():
                 break
 
-            # in this section, the sentences that are still active are
-            # compacted so that the decoder is not run on completed sentences
-            active_idx = self.tt.LongTensor([batch_idx[k] for k in active])
-            batch_idx = {beam: idx for idx, beam in enumerate(active)}
+            # one reordering of all the decoder states:
+            # the new hypothesis k of sentence b continues the hypothesis prev_k[b, k]
+            reorder_idx = prev_k.t() * remaining_sents + active.new(list(range(remaining_sents))).unsqueeze(0)
+            keep = None
+
+            if done.any():
+                # in this section, the sentences that are still active are
+                # compacted so that the decoder is not run on completed sentences
+                keep = done.eq(0).nonzero().squeeze(1)
+                active = active.index_select(0, keep)
+                reorder_idx = reorder_idx.index_select(1, keep)
+                scores = scores.index_select(0, keep)
+                tokens = tokens.index_select(0, keep)
+                seqs = seqs.index_select(0, keep)
+                seq_attns = seq_attns.index_select(0, keep)
+                remaining_sents = keep.size(0)
+
+            reorder_idx = reorder_idx.contiguous().view(-1)
 
             for j in range(self.n_models):
-                decoder_states[j].prune_complete_beam(active_idx, remaining_sents)
+                decoder_states[j].reorder_beam(reorder_idx, keep)
 
             if self.opt.lm:
-                lm_decoder_states.prune_complete_beam(active_idx, remaining_sents)
+                lm_decoder_states.reorder_beam(reorder_idx, keep)
 
-            remaining_sents = len(active)
+        if shortlist is not None:
+            self._set_shortlist(None)
 
         #  (4) package everything up
         all_hyp, all_scores, all_attn = [], [], []
-        n_best = self.opt.n_best
         all_lengths = []
 
         for b in range(batch_size):
-            scores, ks = beam[b].sortBest()
 
-            all_scores += [scores[:n_best]]
-            hyps, attn, length = zip(*[beam[b].getHyp(k) for k in ks[:n_best]])
-            all_hyp += [hyps]
-            all_lengths += [length]
+            hyps = sorted(finalized[b], key=lambda h: -h[4])[:n_best]
+            if len(hyps) == 0:
+                # no hypothesis could be finished (e.g. every word excluded by a small shortlist):
+                # empty translation
+                src_len = decoder_states[0].original_src.size(0)
+                hyps = [(-float('inf'), [eos], tt.FloatTensor(1, src_len).zero_(), 1, -float('inf'))]
+            # the n-best list always has the expected size
+            hyps += [hyps[-1]] * (self.opt.n_best - len(hyps))
+
+            all_scores += [torch.FloatTensor([h[0] for h in hyps])]
+            all_hyp += [tuple(h[1] for h in hyps)]
+            all_lengths += [tuple(h[3] for h in hyps)]
             # if(src_data.data.dim() == 3):
             if self.opt.encoder_type == 'audio':
                 valid_attn = decoder_states[0].original_src.narrow(2, 0, 1).squeeze(2)[:, b].ne(onmt.Constants.PAD) \
@@ -377,20 +631,19 @@ class EnsembleTranslator(object):
             else:
                 valid_attn = decoder_states[0].original_src[:, b].ne(onmt.Constants.PAD) \
                     .nonzero().squeeze(1)
-            attn = [a.index_select(1, valid_attn) for a in attn]
+            attn = [h[2].index_select(1, valid_attn) for h in hyps]
             all_attn += [attn]
 
             if self.beam_accum:
                 self.beam_accum["beam_parent_ids"].append(
-                    [t.tolist()
-                     for t in beam[b].prevKs])
+                    [t[0] for t in beam_history[b]])
                 self.beam_accum["scores"].append([
-                                                     ["%4f" % s for s in t.tolist()]
-                                                     for t in beam[b].all_scores][1:])
+                                                     ["%4f" % s for s in t[2]]
+                                                     for t in beam_history[b]])
                 self.beam_accum["predicted_ids"].append(
                     [[self.tgt_dict.getLabel(id)
-                      for id in t.tolist()]
-                     for t in beam[b].nextYs][1:])
+                      for id in t[1]]
+                     for t in beam_history[b]])
 
         torch.set_grad_enabled(True)
 
@@ -408,12 +661,9 @@ class EnsembleTranslator(object):
         pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = self.translate_batch(batch)
 
         #  (3) convert indexes to words
-        pred_batch = []
-        for b in range(batch_size):
-            pred_batch.append(
-                [self.build_target_tokens(pred[b][n], src_data[b], attn[b][n])
-                 for n in range(self.opt.n_best)]
-            )
+        n_best = self.opt.n_best
+        tokens = self.build_target_tokens([pred[b][n] for b in range(batch_size) for n in range(n_best)])
+        pred_batch = [tokens[b * n_best:(b + 1) * n_best] for b in range(batch_size)]
 
         return pred_batch, pred_score, pred_length, gold_score, gold_words, allgold_words
 
@@ -430,12 +680,9 @@ class EnsembleTranslator(object):
         pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = self.translate_batch(batch)
 
         #  (3) convert indexes to words
-        pred_batch = []
-        for b in range(batch_size):
-            pred_batch.append(
-                [self.build_target_tokens(pred[b][n], src_data[b], attn[b][n])
-                 for n in range(self.opt.n_best)]
-            )
+        n_best = self.opt.n_best
+        tokens = self.build_target_tokens([pred[b][n] for b in range(batch_size) for n in range(n_best)])
+        pred_batch = [tokens[b * n_best:(b + 1) * n_best] for b in range(batch_size)]
 
         return pred_batch, pred_score, pred_length, gold_score, gold_words, allgold_words
 
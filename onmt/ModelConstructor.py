@@ -206,4 +206,19 @@ def build_fusion(opt, dicts):
     from onmt.modules.FusionNetwork.Models import FusionNetwork
     model = FusionNetwork(tm_model, lm_model)
 
-    return model
\ No newline at end of file
+    return model
+
+
+def quantize_model(model, dtype='int8'):
+    """
+    Dynamic quantization of the linear layers (attention, feed forward and generator) for inference on CPU:
+    the weights are stored in int8 and the activations are quantized on the fly
+    :return: the quantized copy of the model
+    """
+    if dtype != 'int8':
+        raise NotImplementedError("Only int8 quantization is supported, not %s" % dtype)
+    if not hasattr(torch, 'quantization'):
+        raise NotImplementedError("Dynamic quantization requires PyTorch 1.3 or later")
+
+    model.eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
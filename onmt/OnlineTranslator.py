@@ -28,6 +28,16 @@ class TranslatorParameter(object):
         self.ensemble_op='mean'
         self.autoencoder=None
         self.encoder_type='text'
+        self.lm=None
+        self.normalize=False
+        self.max_len_a=0
+        self.max_len_b=0
+        self.parallel_ensemble=False
+        self.shortlist=None
+        self.shortlist_k=50
+        self.shortlist_frequent=1000
+        self.quantize=None
+        self.ema=False
         
         self.read_file(filename)
 
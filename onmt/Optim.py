@@ -156,6 +156,8 @@ class Optim(object):
     
         params_ = filter(lambda p: p.requires_grad, params)
         self.params = list(params_)  # careful: params may be a generator
+        if self.flat and len(self.params) > 1:
+            self._flatten_parameters()
         #~ self.optimizer = Adam(self.params, lr=self.lr, betas=(self.beta1, self.beta2), eps=1e-9,
                                     #~ weight_decay=self.weight_decay, amsgrad=self.amsgrad)
         if self.method == 'sgd':
@@ -166,7 +168,32 @@ class Optim(object):
         else:
             raise RuntimeError("Invalid optim method: " + self.method)
         print(self.optimizer)
-        
+
+    def _flatten_parameters(self):
+        """
+        Move the parameters and their gradients into two flat buffers: every parameter (and its gradient)
+        becomes a view of the buffers and the optimizer only sees one parameter
+        """
+        data = self.params[0].data
+        if any(p.data.type() != data.type() for p in self.params):
+            raise RuntimeError("Flat parameters need all of the parameters on the same device and of the same type")
+
+        total_size = sum(p.numel() for p in self.params)
+        flat_data = data.new(total_size)
+        flat_grad = data.new(total_size).zero_()
+
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            flat_data[offset:offset+numel].copy_(p.data.view(-1))
+            p.data = flat_data[offset:offset+numel].view_as(p.data)
+            # the gradients are accumulated in place into the views
+            p.grad = flat_grad[offset:offset+numel].view_as(p.data)
+            offset += numel
+
+        self.flat_params = torch.nn.Parameter(flat_data)
+        self.flat_params.grad = flat_grad
+        self.params = [self.flat_params]
     
     def __init__(self, opt):
         self.lr = opt.learning_rate
@@ -188,6 +215,8 @@ class Optim(object):
         self.beta2 = opt.beta2
         self.weight_decay = opt.weight_decay
         self.amsgrad = opt.amsgrad 
+        self.flat = getattr(opt, 'flat_parameters', False)
+        self.flat_params = None
         
             
     def step(self, grad_denom=None):
@@ -247,16 +276,27 @@ class Optim(object):
     def state_dict(self):
         state_dict = self.optimizer.state_dict()
         state_dict['_step'] = self._step
+        state_dict['flat'] = self.flat_params is not None
         return state_dict
         
     def load_state_dict(self, state_dict):
         self._step = state_dict['_step']
         
         state_dict.pop('_step', None)
+        flat = state_dict.pop('flat', False)
+        if flat != (self.flat_params is not None):
+            # the running averages of flat and non flat parameters do not match
+            print("WARNING: the optimizer was saved with%s flat parameters, its state is reset"
+                  % ("" if flat else "out"))
+            return
         self.optimizer.load_state_dict(state_dict)
       
     def zero_grad(self):
-        self.optimizer.zero_grad()
+        if self.flat_params is not None:
+            # the gradients of the parameters are views of the flat gradient: they are kept
+            self.flat_params.grad.data.zero_()
+        else:
+            self.optimizer.zero_grad()
       
 # This version of Adam keeps an fp32 copy of the parameters and
 # does all of the parameter updates in fp32, while still doing the
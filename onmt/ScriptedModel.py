@@ -0,0 +1,131 @@
+import os
+import torch
+from collections import defaultdict
+from onmt.modules.BaseModel import DecoderState
+from onmt.modules.Transformer.Layers import grow_buffer
+from onmt.utils import load_checkpoint
+
+
+class ScriptedDecodingState(DecoderState):
+    """
+    Decoding state of a ScriptedModel: the keys / values of the self-attention of the previous steps
+    (len_tgt x n_layers x beam*B x d_model, preallocated and filled up to length)
+    and the projected source of the context attention (once per sentence)
+    """
+
+    def __init__(self, src, memory, beam_size=1, n_layers=6, model_size=512):
+
+        self.original_src = src
+        self.src = src.t().contiguous()  # batch first for the source mask
+        self.memory = memory
+        self.beam_size = beam_size
+
+        n = src.size(1) * beam_size
+        self.self_k = memory.new(16, n_layers, n, model_size)
+        self.self_v = memory.new(16, n_layers, n, model_size)
+        self.length = 0
+
+    def position(self):
+        return self.src.new(1).fill_(self.length)
+
+    def append(self, new_k, new_v):
+
+        self.self_k = grow_buffer(self.self_k, self.length + 1)
+        self.self_v = grow_buffer(self.self_v, self.length + 1)
+        self.self_k[self.length:self.length + 1].copy_(new_k)
+        self.self_v[self.length:self.length + 1].copy_(new_v)
+        self.length += 1
+
+    def reorder_beam(self, reorder_idx, active_idx=None):
+
+        self.self_k = self.self_k.index_select(2, reorder_idx)
+        self.self_v = self.self_v.index_select(2, reorder_idx)
+
+        if active_idx is not None:
+            self.memory = self.memory.index_select(2, active_idx)
+            self.src = self.src.index_select(0, active_idx)
+
+
+class ScriptedModel(object):
+    """
+    A Transformer exported by export_model.py: a traced encoder and a traced decoder step,
+    loaded without building the model. It has the decoding interface of the models
+    (create_decoder_state and step)
+    """
+
+    def __init__(self, path, map_location='cpu'):
+
+        meta = load_checkpoint(path + '.meta.pt')[0]
+        self.dicts = meta['dicts']
+        self.opt = meta['opt']
+        self.n_layers = meta['n_layers']
+        self.model_size = meta['model_size']
+        self.max_len = meta['max_len']
+
+        self.encoder = torch.jit.load(path + '.encoder.pt', map_location=map_location)
+        self.decoder_step = torch.jit.load(path + '.decoder.pt', map_location=map_location)
+
+    @staticmethod
+    def exists(path):
+        return (
+            os.path.exists(path + '.meta.pt') and
+            os.path.exists(path + '.encoder.pt') and
+            os.path.exists(path + '.decoder.pt')
+        )
+
+    def _apply(self, function):
+        self.encoder = function(self.encoder)
+        self.decoder_step = function(self.decoder_step)
+        return self
+
+    def cuda(self):
+        return self._apply(lambda m: m.cuda())
+
+    def cpu(self):
+        return self._apply(lambda m: m.cpu())
+
+    def half(self):
+        return self._apply(lambda m: m.half())
+
+    def eval(self):
+        return self._apply(lambda m: m.eval())
+
+    def renew_buffer(self, new_len):
+        # the positions are fixed at export time
+        if new_len > self.max_len:
+            raise ValueError("The exported model only supports sequences of %d positions (%d requested), "
+                             "it has to be exported again with a larger -max_sent_length"
+                             % (self.max_len, new_len))
+
+    def decode(self, batch):
+        raise NotImplementedError("Exported models can not score the reference translations")
+
+    def create_decoder_state(self, batch, beam_size=1):
+
+        src = batch.get('source')
+        if src.dim() != 2:
+            raise NotImplementedError("Exported models only support text input")
+
+        if src.size(0) > self.max_len:
+            raise ValueError("Source sentence of %d words: the exported model only supports %d positions, "
+                             "it has to be exported again with a larger -max_sent_length"
+                             % (src.size(0), self.max_len))
+
+        memory = self.encoder(src.t().contiguous())
+
+        return ScriptedDecodingState(src, memory, beam_size=beam_size,
+                                     n_layers=self.n_layers, model_size=self.model_size)
+
+    def step(self, input_t, decoder_state):
+
+        log_prob, coverage, new_k, new_v = self.decoder_step(input_t, decoder_state.position(),
+                                                             decoder_state.self_k[:decoder_state.length],
+                                                             decoder_state.self_v[:decoder_state.length],
+                                                             decoder_state.memory, decoder_state.src)
+        decoder_state.append(new_k, new_v)
+
+        output_dict = defaultdict(lambda: None)
+        output_dict['log_prob'] = log_prob
+        output_dict['coverage'] = coverage
+
+        return output_dict
@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import warnings
+
+import numpy as np
+import torch
+
+from onmt.Dict import Dict
+from onmt.ModelConstructor import build_model
+
+# the tensors are aligned in the blob so that they can be used in place
+ALIGNMENT = 64
+
+
+def slim_model_exists(path):
+    return os.path.exists(path + '.json') and os.path.exists(path + '.bin')
+
+
+def save_slim_model(model, opt, dicts, path):
+    """
+    Write the parameters of a model for inference only:
+        path.bin: the parameters one after the other (raw, aligned)
+        path.json: the model options and the name, type, shape and offset of every parameter
+        path.<name>.dict: the vocabularies (as text, see Dict.writeFile)
+    The buffers (positional encoding, masks) are rebuilt with the model and not saved
+    """
+    tensors = []
+    offset = 0
+    with open(path + '.bin', 'wb') as blob:
+        for name, param in model.named_parameters():
+            array = param.data.cpu().contiguous().numpy()
+            padding = -offset % ALIGNMENT
+            blob.write(b'\0' * padding)
+            offset += padding
+
+            blob.write(array.tobytes())
+            tensors.append({'name': name, 'dtype': array.dtype.name, 'shape': list(array.shape),
+                            'offset': offset, 'size': array.nbytes})
+            offset += array.nbytes
+
+    vocabs = dict()
+    for name in dicts:
+        dicts[name].writeFile(path + '.%s.dict' % name)
+        vocabs[name] = {'lower': dicts[name].lower}
+
+    meta = {'opt': vars(opt), 'tensors': tensors, 'dicts': vocabs}
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=1, default=str)
+
+
+def load_slim_model(path):
+    """
+    Build a model from the files of save_slim_model. The parameters are views of the memory-mapped blob:
+    nothing is copied and processes loading the same model share its pages
+    :return: the model, its options and its vocabularies
+    """
+    with open(path + '.json') as f:
+        meta = json.load(f)
+
+    opt = argparse.Namespace(**meta['opt'])
+
+    dicts = dict()
+    for name, vocab in meta['dicts'].items():
+        dicts[name] = Dict(path + '.%s.dict' % name, lower=vocab['lower'])
+
+    model = build_model(opt, dicts)
+
+    blob = np.memmap(path + '.bin', dtype=np.uint8, mode='r')
+    params = dict(model.named_parameters())
+
+    for entry in meta['tensors']:
+        begin = entry['offset']
+        array = blob[begin:begin + entry['size']].view(np.dtype(entry['dtype'])).reshape(entry['shape'])
+
+        # the mapping is read-only: torch warns about it but the parameters are never written to
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            params[entry['name']].data = torch.from_numpy(array)
+
+    return model, opt, dicts
@@ -0,0 +1,192 @@
+import json
+import logging
+import queue
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class TranslationRequest(object):
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.arrival = time.time()
+        self.future = Future()
+
+
+class TranslationServer(object):
+    """
+    Keeps the models loaded and translates the requests of concurrent clients in batches.
+    The requests arriving within max_latency seconds of the first waiting one are gathered,
+    sorted by length and split into batches of at most max_batch_size sentences.
+    Each request gets its result as soon as its batch is translated.
+    """
+
+    def __init__(self, translator, max_batch_size=32, max_latency=0.01, n_latencies=10000):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        # the dataset built by the translator must hold a whole batch
+        translator.opt.batch_size = max(translator.opt.batch_size, max_batch_size)
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_requests = 0
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tokens):
+        """
+        :param tokens: list of tokens of the source sentence
+        :return: a Future with the list of target tokens
+        """
+        request = TranslationRequest(tokens)
+        if len(tokens) == 0:
+            request.future.set_result([])
+        else:
+            self.queue.put(request)
+        return request.future
+
+    def translate(self, line):
+        return " ".join(self.submit(line.split()).result())
+
+    def _gather(self):
+        # wait for the first request, then for the others within the latency window
+        requests = [self.queue.get()]
+        deadline = requests[0].arrival + self.max_latency
+
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # the requests already waiting are batched together as well (by length)
+        while len(requests) < 4 * self.max_batch_size:
+            try:
+                requests.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return requests
+
+    def _run(self):
+
+        while True:
+            requests = []
+            try:
+                requests = self._gather()
+                requests = sorted(requests, key=lambda r: len(r.tokens))
+
+                for i in range(0, len(requests), self.max_batch_size):
+                    batch = requests[i:i + self.max_batch_size]
+                    self._translate_batch(batch)
+            except Exception as e:
+                # the worker keeps serving: the requests of this round get the error instead of waiting forever
+                logging.error(traceback.format_exc())
+                for r in requests:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+
+    def _translate_batch(self, requests):
+
+        try:
+            pred_batch = self.translator.translate([r.tokens for r in requests], [])[0]
+        except Exception as e:
+            for r in requests:
+                r.future.set_exception(e)
+            return
+
+        now = time.time()
+        with self.lock:
+            self.batch_sizes[len(requests)] += 1
+            self.n_requests += len(requests)
+            for r in requests:
+                self.latencies.append(now - r.arrival)
+
+        for r, pred in zip(requests, pred_batch):
+            r.future.set_result(pred[0])
+
+    def stats(self):
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            batch_sizes = dict(self.batch_sizes)
+            n_requests = self.n_requests
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0.
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {'queue_depth': self.queue.qsize(),
+                'requests': n_requests,
+                'batch_sizes': batch_sizes,
+                'latency_p50': percentile(0.5),
+                'latency_p99': percentile(0.99)}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(server, host='localhost', port=8000):
+    """
+    HTTP interface of a TranslationServer:
+        POST /translate with a JSON body {"text": "..."} returns {"translation": "..."}
+        GET /stats returns the queue depth, the batch size histogram and the p50 / p99 latency (seconds)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, content):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, server.stats())
+            else:
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/translate':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                text = json.loads(self.rfile.read(length).decode('utf-8'))['text']
+            except (ValueError, KeyError, TypeError):
+                self._reply(400, {'error': 'the body must be a JSON object with a "text" field'})
+                return
+
+            try:
+                translation = server.translate(text)
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+
+            self._reply(200, {'translation': translation})
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = _ThreadingHTTPServer((host, port), Handler)
+    print("Serving translations on http://%s:%d" % (host, port))
+    httpd.serve_forever()
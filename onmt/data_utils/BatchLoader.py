@@ -0,0 +1,61 @@
+import torch
+import torch.utils.data
+
+
+def _unwrap(batches):
+    # the DataLoader works with lists of samples: each sample is already a full Batch
+    return batches[0]
+
+
+class _OrderedBatches(torch.utils.data.Dataset):
+    """The batches of a Dataset, indexed by their position in the batch order"""
+
+    def __init__(self, dataset, curriculum=False):
+        self.dataset = dataset
+        self.batch_order = None if curriculum else dataset.batchOrder
+
+    def __getitem__(self, i):
+        index = i if self.batch_order is None else int(self.batch_order[i])
+        return self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class BatchLoader(object):
+    """
+    Iterates over the batches of a Dataset, following its batchOrder and starting from its
+    current index (so resuming with set_index works the same way as with Dataset.next).
+    With num_workers > 0 the batches (collate, speech down-sampling, augmentation) are built
+    by worker processes and a bounded number of them is prepared ahead of time.
+    """
+
+    def __init__(self, dataset, num_workers=0, pin_memory=False, curriculum=False):
+        self.dataset = dataset
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.curriculum = curriculum
+
+    def __len__(self):
+        return len(self.dataset) - self.dataset.cur_index
+
+    def __iter__(self):
+
+        dataset = self.dataset
+
+        if self.num_workers <= 0:
+            for _ in range(dataset.cur_index, len(dataset)):
+                yield dataset.next(curriculum=self.curriculum)[0]
+            return
+
+        loader = torch.utils.data.DataLoader(_OrderedBatches(dataset, curriculum=self.curriculum),
+                                             batch_size=1,
+                                             sampler=list(range(dataset.cur_index, len(dataset))),
+                                             collate_fn=_unwrap,
+                                             num_workers=self.num_workers,
+                                             pin_memory=self.pin_memory)
+
+        for batch in loader:
+            # keep the iterator of the dataset in sync (for saving / resuming)
+            dataset.cur_index += 1
+            yield batch
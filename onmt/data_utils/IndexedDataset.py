@@ -7,6 +7,7 @@
 
 import os
 import struct
+import warnings
 
 import numpy as np
 import torch
@@ -30,7 +31,7 @@ dtypes = {
     3: np.int16,
     4: np.int32,
     5: np.int64,
-    6: np.float,
+    6: np.float32,
     7: np.double,
 }
 
@@ -115,6 +116,63 @@ class IndexedInMemoryDataset(IndexedDataset):
         a = np.empty(tensor_size, dtype=self.dtype)
         np.copyto(a, self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]])
         return torch.from_numpy(a).long()
+
+
+class MMapIndexedDataset(IndexedDataset):
+    """Loader for TorchNet IndexedDataset, memory-maps the files and returns views without copying
+    (processes reading the same files share one page-cached copy)"""
+
+    def __init__(self, path):
+        torch.utils.data.Dataset.__init__(self)
+        self.path = path
+        self.read_index(path)
+        self.read_data(path)
+
+    def read_index(self, path):
+        with open(index_file_path(path), 'rb') as f:
+            magic = f.read(8)
+            assert magic == b'TNTIDX\x00\x00'
+            version = f.read(8)
+            assert struct.unpack('<Q', version) == (1,)
+            code, self.element_size = struct.unpack('<QQ', f.read(16))
+            self.dtype = dtypes[code]
+            self.size, self.s = struct.unpack('<QQ', f.read(16))
+            offset = f.tell()
+
+        # dim_offsets, data_offsets and sizes are stored one after the other
+        index = np.memmap(index_file_path(path), dtype=np.int64, mode='r', offset=offset)
+        self.dim_offsets = index[:self.size + 1]
+        self.data_offsets = index[self.size + 1:2 * self.size + 2]
+        self.sizes = index[2 * self.size + 2:2 * self.size + 2 + self.s]
+
+    def read_data(self, path):
+        if os.path.getsize(data_file_path(path)) == 0:
+            # np.memmap can not map an empty file (dataset without items, or with empty items only)
+            self.buffer = np.empty(0, dtype=self.dtype)
+        else:
+            self.buffer = np.memmap(data_file_path(path), dtype=self.dtype, mode='r')
+
+    def __del__(self):
+        pass
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        a = self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]]
+        if self.dim_offsets[i + 1] - self.dim_offsets[i] > 1:
+            a = a.reshape(self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]])
+
+        # the mapping is read-only: torch warns about it but the tensor is never written to
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            item = torch.from_numpy(a)
+        return item
+
+    def __getstate__(self):
+        # re-map the files instead of pickling their content (e.g. for worker processes)
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
 #~ 
 #~ 
 #~ class IndexedRawTextDataset(IndexedDataset):
@@ -168,7 +226,7 @@ class IndexedDatasetBuilder(object):
         np.int16: 2,
         np.int32: 4,
         np.int64: 8,
-        np.float: 4,
+        np.float32: 4,
         np.double: 8
     }
 
@@ -199,3 +257,56 @@ class IndexedDatasetBuilder(object):
         write_longs(index, self.data_offsets)
         write_longs(index, self.sizes)
         index.close()
+
+
+def merge_indexed_datasets(paths, out_path, order=None):
+    """
+    Write the items of several indexed datasets into one, without loading them in memory
+    :param paths: the prefixes of the datasets to merge (all with the same dtype)
+    :param out_path: the prefix of the merged dataset
+    :param order: iterable of (dataset, item) index pairs giving the order of the items.
+                  By default the datasets are concatenated
+    """
+    shards = [MMapIndexedDataset(path) for path in paths]
+    dtype, element_size = shards[0].dtype, shards[0].element_size
+    n_items = sum(shard.size for shard in shards)
+    n_sizes = sum(shard.s for shard in shards)
+
+    if order is None:
+        order = ((k, i) for k, shard in enumerate(shards) for i in range(shard.size))
+
+    # the index has a fixed size: map it and fill it while the data is written
+    header_size = 48
+    index = np.memmap(index_file_path(out_path), dtype=np.int64, mode='w+',
+                      offset=header_size, shape=(2 * n_items + 2 + n_sizes,))
+    dim_offsets = index[:n_items + 1]
+    data_offsets = index[n_items + 1:2 * n_items + 2]
+    sizes = index[2 * n_items + 2:]
+    dim_offsets[0] = 0
+    data_offsets[0] = 0
+
+    n_dims, n_elements = 0, 0
+    j = -1
+    with open(data_file_path(out_path), 'wb') as data_file:
+        for j, (k, i) in enumerate(order):
+            shard = shards[k]
+            begin, end = shard.data_offsets[i], shard.data_offsets[i + 1]
+            data_file.write(shard.buffer[begin:end].tobytes())
+
+            dim_begin, dim_end = shard.dim_offsets[i], shard.dim_offsets[i + 1]
+            sizes[n_dims:n_dims + dim_end - dim_begin] = shard.sizes[dim_begin:dim_end]
+
+            n_dims += dim_end - dim_begin
+            n_elements += end - begin
+            dim_offsets[j + 1] = n_dims
+            data_offsets[j + 1] = n_elements
+
+    assert j + 1 == n_items
+    index.flush()
+    del index
+
+    with open(index_file_path(out_path), 'r+b') as f:
+        f.write(b'TNTIDX\x00\x00')
+        f.write(struct.pack('<Q', 1))
+        f.write(struct.pack('<QQ', code(dtype), element_size))
+        f.write(struct.pack('<QQ', n_items, n_sizes))
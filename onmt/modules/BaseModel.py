@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import onmt, math
+from collections import OrderedDict
 
 class Generator(nn.Module):
 
@@ -19,12 +20,36 @@ class Generator(nn.Module):
         
         self.linear.bias.data.zero_()
 
-        
+        # the output can be restricted to a subset of the vocabulary (at decoding)
+        self.shortlist = None
+        self.shortlist_weight = None
+        self.shortlist_bias = None
+
+    def set_shortlist(self, shortlist=None):
+        """
+        Restrict the output to the words of shortlist (sorted LongTensor of word indices),
+        the output word i is then the word shortlist[i]. None goes back to the full vocabulary
+        """
+        self.shortlist = shortlist
+        if shortlist is None:
+            self.shortlist_weight, self.shortlist_bias = None, None
+        else:
+            # the rows of the projection are selected once for all the decoding steps
+            weight, bias = self.linear.weight, self.linear.bias
+            if not torch.is_tensor(weight):
+                # dynamically quantized linear: the selected rows are used in float
+                weight, bias = weight().dequantize(), bias()
+            self.shortlist_weight = weight.index_select(0, shortlist)
+            self.shortlist_bias = bias.index_select(0, shortlist)
+
     def forward(self, input, log_softmax=True):
         
         # added float to the end 
         # print(input.size())
-        logits = self.linear(input).float() 
+        if self.shortlist is not None:
+            logits = F.linear(input, self.shortlist_weight, self.shortlist_bias).float()
+        else:
+            logits = self.linear(input).float()
         
         if log_softmax:
             output = F.log_softmax(logits, dim=-1)
@@ -83,6 +108,10 @@ class NMTModel(nn.Module):
         for k,v in model_dict.items():
             if k not in filtered:
                 filtered[k] = v
+
+        # the module versions are needed to load some modules (e.g. the quantized linear layers)
+        filtered = OrderedDict(filtered)
+        filtered._metadata = getattr(state_dict, '_metadata', model_dict._metadata)
         #~
 
         super().load_state_dict(filtered)   
@@ -126,3 +155,7 @@ class DecoderState(object):
     def prune_complete_beam(self, active_idx, remaining_sents):
 
         raise NotImplementedError
+
+    def reorder_beam(self, reorder_idx, active_idx=None):
+
+        raise NotImplementedError
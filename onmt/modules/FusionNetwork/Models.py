@@ -193,4 +193,9 @@ class FusionDecodingState(DecoderState):
         self.tm_state.prune_complete_beam(active_idx, remaining_sents)
         self.lm_state.prune_complete_beam(active_idx, remaining_sents)
 
+    def reorder_beam(self, reorder_idx, active_idx=None):
+
+        self.tm_state.reorder_beam(reorder_idx, active_idx)
+        self.lm_state.reorder_beam(reorder_idx, active_idx)
+
 
@@ -8,6 +8,50 @@ from torch.nn.modules.loss import _Loss
 import numpy
 
 
+class LabelSmoothedCrossEntropy(torch.autograd.Function):
+    """
+    Label smoothed cross entropy computed directly on the logits (rows x vocab_size),
+    summed over the rows whose target is not padding. The log probabilities are not stored:
+    the backward pass recomputes the softmax and returns (softmax - smoothed one-hot) directly.
+    Returns the loss and the (not differentiable) NLL of the targets
+    """
+
+    @staticmethod
+    def forward(ctx, logits, targets, confidence, smoothing_value, padding_idx):
+
+        pad_mask = targets.eq(padding_idx)
+        lse = torch.logsumexp(logits, dim=-1)
+
+        # -log p(target) and -sum_v log p(v) of every row
+        nll = lse - logits.gather(1, targets.unsqueeze(1)).squeeze(1)
+        smooth = lse * logits.size(1) - logits.sum(dim=-1)
+        nll_loss = nll.masked_fill_(pad_mask, 0).sum()
+        smooth_loss = smooth.masked_fill_(pad_mask, 0).sum()
+
+        loss = confidence * nll_loss + smoothing_value * smooth_loss
+
+        ctx.save_for_backward(logits, targets, lse)
+        ctx.confidence, ctx.smoothing_value, ctx.padding_idx = confidence, smoothing_value, padding_idx
+        ctx.mark_non_differentiable(nll_loss)
+
+        return loss, nll_loss
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_nll):
+
+        logits, targets, lse = ctx.saved_tensors
+        confidence, smoothing_value = ctx.confidence, ctx.smoothing_value
+
+        # d loss / d logits = p * (confidence + eps * V) - confidence * onehot(target) - eps
+        grad = logits.sub(lse.unsqueeze(1)).exp_()
+        grad.mul_(confidence + smoothing_value * logits.size(1)).sub_(smoothing_value)
+        grad.scatter_add_(1, targets.unsqueeze(1), grad.new(targets.size(0), 1).fill_(-confidence))
+        grad.masked_fill_(targets.eq(ctx.padding_idx).unsqueeze(1), 0)
+        grad.mul_(grad_loss)
+
+        return grad, None, None, None, None
+
+
 class CrossEntropyLossBase(_Loss):
 
     """
@@ -46,6 +90,13 @@ class CrossEntropyLossBase(_Loss):
         loss_data = nll_loss.data.item()
 
         return loss, loss_data
+
+    def _compute_loss_from_logits(self, logits, targets):
+        """Same loss as _compute_loss, from the logits in one fused function"""
+        loss, nll_loss = LabelSmoothedCrossEntropy.apply(logits, targets.view(-1), self.confidence,
+                                                         self.smoothing_value, self.padding_idx)
+
+        return loss, nll_loss.item()
     
     def forward(self, model_outputs, targets, hiddens, **kwargs):
 
@@ -55,8 +106,33 @@ class CrossEntropyLossBase(_Loss):
 class NMTLossFunc(CrossEntropyLossBase):
     """
     Standard NMT Loss Computation.
+    With shard_size > 0, the generator and the loss are computed (and back-propagated)
+    on shard_size target tokens at a time during training
     """
 
+    def __init__(self, output_size, label_smoothing, shard_size=0):
+        super(NMTLossFunc, self).__init__(output_size, label_smoothing)
+        self.shard_size = shard_size
+
+    def _compute_sharded_loss(self, hiddens, targets, generator, normalizer):
+        """
+        Project, compute the loss and backpropagate shard by shard: only the output distributions
+        of one shard exist at a time. The gradients of the shards are accumulated on the hidden states
+        and then backpropagated through the rest of the network at once
+        """
+        hiddens_ = hiddens.detach().requires_grad_()
+
+        loss_total, loss_data = 0, 0
+        for hidden, target in zip(hiddens_.split(self.shard_size), targets.split(self.shard_size)):
+            loss, data = self._compute_loss_from_logits(generator(hidden, log_softmax=False), target)
+            loss.div(normalizer).backward()
+            loss_total += loss.item()
+            loss_data += data
+
+        hiddens.backward(hiddens_.grad)
+
+        return hiddens.new_tensor(loss_total).float(), loss_data
+
     def forward(self, model_outputs, targets, model=None, backward=False, normalizer=1, **kwargs):
         """
         Compute the loss. Subclass must define this method.
@@ -97,13 +173,20 @@ class NMTLossFunc(CrossEntropyLossBase):
             clean_input = outputs
             clean_targets = targets
 
+        if backward and model is not None and 0 < self.shard_size < clean_input.size(0):
+            loss, loss_data = self._compute_sharded_loss(clean_input, clean_targets,
+                                                         model.generator[0], normalizer)
+
+            return {"loss": loss, "data": loss_data}
+
         if model is not None:
             # the 'first' generator is the decoder softmax one
-            dists = model.generator[0](clean_input)
+            # the log softmax is fused with the loss
+            logits = model.generator[0](clean_input, log_softmax=False)
+            loss, loss_data = self._compute_loss_from_logits(logits, clean_targets)
         else:
             dists = clean_input
-
-        loss, loss_data = self._compute_loss(dists, clean_targets)
+            loss, loss_data = self._compute_loss(dists, clean_targets)
 
         if backward:
             loss.div(normalizer).backward()
@@ -204,7 +287,7 @@ class NMTAndCTCLossFunc(_Loss):
     def __init__(self, output_size, label_smoothing=0.0, ctc_weight = 0.0):
         super(NMTAndCTCLossFunc, self).__init__(output_size)
         self.ctc_weight = ctc_weight
-        self.ce_loss = NMTLossFunc(output_size,label_smoothing)
+        self.ce_loss = NMTLossFunc(output_size, label_smoothing)
         self.ctc_loss = CTCLossFunc(output_size+1,label_smoothing)
 
     def forward(self, model_outputs, targets, model=None, backward=False, normalizer=1, **kwargs):
@@ -0,0 +1,193 @@
+import math
+import torch
+import torch.nn as nn
+import onmt
+from onmt.modules.Transformer.Layers import group_linear
+
+
+def attention(multihead, q, k, v, mask=None):
+    """
+    Multi-head attention on projected inputs, written with traceable operations
+    :param multihead: the MultiHeadAttention module (for the number of heads and the output projection)
+    :param q: len_query x N x d_model, N = beam * B hypotheses in beam-major order
+    :param k, v: len_key x B x d_model (the keys may be given once per sentence)
+    :param mask: B x 1 x len_key or None
+    :return: out (len_query x N x d_model), coverage (N x len_query x len_key)
+    """
+    len_query, n, d = q.size(0), q.size(1), q.size(2)
+    len_key, b = k.size(0), k.size(1)
+    h, d_head = multihead.h, multihead.d_head
+
+    # the queries of the hypotheses of a sentence are grouped (see MultiHeadAttention.step)
+    q = q.contiguous().view(-1, b * h, d_head).transpose(0, 1)
+    k = k.contiguous().view(len_key, b * h, d_head).transpose(0, 1)
+    v = v.contiguous().view(len_key, b * h, d_head).transpose(0, 1)
+
+    q = q * (d_head ** -0.5)
+
+    attns = torch.bmm(q, k.transpose(1, 2)).view(b, h, -1, len_key)
+    if mask is not None:
+        attns = attns.float().masked_fill_(mask.unsqueeze(-3), -float('inf')).type_as(attns)
+    attns = torch.softmax(attns.float(), dim=-1).type_as(attns)
+
+    coverage = torch.mean(attns, dim=1).view(b, len_query, -1, len_key)
+    coverage = coverage.permute(2, 0, 1, 3).contiguous().view(n, len_query, len_key)
+
+    out = torch.bmm(attns.view(b * h, -1, len_key), v)
+    out = out.transpose(0, 1).contiguous().view(len_query, n, d)
+
+    return multihead.fc_concat(out), coverage
+
+
+class ExportedEncoder(nn.Module):
+    """
+    The encoder of a Transformer, followed by the projection of the context into the keys / values
+    of the context attention of every decoder layer (done once per sentence)
+
+    Inputs Shapes:
+        src: batch_size x len_src
+    Outputs Shapes:
+        memory: n_layers x len_src x batch_size x 2*d_model
+    """
+
+    def __init__(self, model):
+        super(ExportedEncoder, self).__init__()
+        encoder = model.encoder
+        if encoder.input_type != 'text' or encoder.time != 'positional_encoding':
+            raise NotImplementedError("Only the Transformer with positional encoding can be exported")
+
+        self.encoder = encoder
+        self.layer_modules = model.decoder.layer_modules
+
+    def forward(self, src):
+
+        # TransformerEncoder.forward without its python logic: the mask and the positions are
+        # computed from src in the trace (not constants of the example) for any shape and padding
+        encoder = self.encoder
+        mask_src = src.eq(onmt.Constants.PAD).unsqueeze(1)
+        emb = encoder.word_lut(src) * math.sqrt(encoder.model_size)
+        emb = emb + encoder.positional_encoder.pos_emb.narrow(0, 0, src.size(1)).unsqueeze(0).type_as(emb)
+        emb = encoder.preprocess_layer(emb)
+
+        context = emb.transpose(0, 1).contiguous()
+        for layer in encoder.layer_modules:
+            context = layer(context, mask_src)
+        context = encoder.postprocess_layer(context)
+
+        memory = [group_linear([layer.multihead_src.fc_key.function.linear,
+                                layer.multihead_src.fc_value.function.linear], context)
+                  for layer in self.layer_modules]
+
+        return torch.stack(memory, 0)
+
+
+class ExportedDecoderStep(nn.Module):
+    """
+    One decoding step of a Transformer with explicit states: the keys / values of the self-attention
+    of the previous steps are inputs, those of the current step are outputs.
+    The hypotheses never contain padding during decoding, so the self-attention is not masked.
+
+    Inputs Shapes:
+        input: 1 x N (N = beam * batch_size, beam-major)
+        position: 1 (index of the current step)
+        self_k, self_v: len_tgt-1 x n_layers x N x d_model
+        memory: n_layers x len_src x batch_size x 2*d_model (from ExportedEncoder)
+        src: batch_size x len_src (for the source mask)
+    Outputs Shapes:
+        log_prob: N x vocab_size
+        coverage: N x len_src (attention of the last layer)
+        new_k, new_v: 1 x n_layers x N x d_model
+    """
+
+    def __init__(self, model):
+        super(ExportedDecoderStep, self).__init__()
+        decoder = model.decoder
+        if decoder.ignore_source or decoder.time != 'positional_encoding':
+            raise NotImplementedError("Only the Transformer with positional encoding can be exported")
+
+        self.model_size = decoder.model_size
+        self.word_lut = decoder.word_lut
+        self.positional_encoder = decoder.positional_encoder
+        self.preprocess_layer = decoder.preprocess_layer
+        self.postprocess_layer = decoder.postprocess_layer
+        self.layer_modules = decoder.layer_modules
+        self.generator = model.generator[0]
+
+    def forward(self, input, position, self_k, self_v, memory, src):
+
+        emb = self.word_lut(input.t()) * math.sqrt(self.model_size)
+        # the position is a tensor so that the traced step works at every time step
+        emb = emb + self.positional_encoder.pos_emb.index_select(0, position).unsqueeze(0).type_as(emb)
+        emb = self.preprocess_layer(emb)
+
+        output = emb.transpose(0, 1).contiguous()
+        mask_src = src.eq(onmt.Constants.PAD).unsqueeze(1)
+
+        new_k, new_v = [], []
+        coverage = None
+        for i, layer in enumerate(self.layer_modules):
+
+            # self attention on the previous steps and the current one
+            query = layer.preprocess_attn(output)
+            multihead = layer.multihead_tgt
+            qkv = group_linear([multihead.fc_query.function.linear, multihead.fc_key.function.linear,
+                                multihead.fc_value.function.linear], query)
+            q, k, v = qkv.chunk(3, dim=-1)
+            new_k.append(k)
+            new_v.append(v)
+            k = torch.cat([self_k.select(1, i), k], 0)
+            v = torch.cat([self_v.select(1, i), v], 0)
+            out, _ = attention(multihead, q, k, v)
+            output = layer.postprocess_attn(out, output)
+
+            # context attention
+            query = layer.preprocess_src_attn(output)
+            multihead = layer.multihead_src
+            c_k, c_v = memory[i].chunk(2, dim=-1)
+            out, coverage = attention(multihead, multihead.fc_query(query), c_k, c_v, mask_src)
+            output = layer.postprocess_src_attn(out, output)
+
+            out = layer.feedforward(layer.preprocess_ffn(output))
+            output = layer.postprocess_ffn(out, output)
+
+        output = self.postprocess_layer(output)
+        log_prob = self.generator(output.squeeze(0))
+
+        return log_prob, coverage.squeeze(1), torch.stack(new_k, 1), torch.stack(new_v, 1)
+
+
+def export_model(model, path, dicts, opt, max_len=256):
+    """
+    Trace the encoder and the decoder step of a Transformer and save them with the vocabularies:
+        path.encoder.pt, path.decoder.pt (TorchScript) and path.meta.pt
+    The positions are limited to max_len (for the source and the target)
+    """
+    model.eval()
+    model.renew_buffer(max_len)
+
+    # examples for tracing: 2 sentences with 2 hypotheses each, at the second step
+    batch_size, beam_size, len_src = 2, 2, 5
+    n_layers, model_size = len(model.decoder.layer_modules), model.decoder.model_size
+    n = batch_size * beam_size
+    src = torch.LongTensor(batch_size, len_src).fill_(onmt.Constants.EOS + 1)
+    src[1, -1] = onmt.Constants.PAD
+    param = next(model.parameters())
+    if param.is_cuda:
+        src = src.cuda()
+
+    with torch.no_grad():
+        encoder = ExportedEncoder(model)
+        traced_encoder = torch.jit.trace(encoder, (src,))
+        memory = encoder(src)
+
+        input = src.new(1, n).fill_(onmt.Constants.EOS + 1)
+        position = src.new(1).fill_(1)
+        self_k = memory.new(1, n_layers, n, model_size).normal_()
+        self_v = memory.new(1, n_layers, n, model_size).normal_()
+        traced_step = torch.jit.trace(ExportedDecoderStep(model), (input, position, self_k, self_v, memory, src))
+
+    traced_encoder.save(path + '.encoder.pt')
+    traced_step.save(path + '.decoder.pt')
+
+    meta = {'dicts': dicts, 'opt': opt, 'n_layers': n_layers, 'model_size': model_size, 'max_len': max_len}
+    torch.save(meta, path + '.meta.pt')
@@ -11,6 +11,10 @@ from onmt.modules.StaticDropout import StaticDropout
 
 def group_linear(linears, input, bias=False):
 
+        if not torch.is_tensor(linears[0].weight):
+            # dynamically quantized linears keep their weights packed: they are applied one by one
+            return torch.cat([linear(input) for linear in linears], dim=-1)
+
         weights = [linear.weight for linear in linears]
 
         weight = torch.cat(weights, dim=0)
@@ -24,6 +28,20 @@ def group_linear(linears, input, bias=False):
         return F.linear(input, weight, bias_)
 
 
+def grow_buffer(buffer, length):
+    """
+    Return a (time first) buffer that can hold at least `length` steps:
+    the capacity is doubled when needed and the content is copied over
+    """
+    capacity = buffer.size(0)
+    if length <= capacity:
+        return buffer
+
+    new_buffer = buffer.new(max(length, 2 * capacity), *buffer.size()[1:])
+    new_buffer[:capacity].copy_(buffer)
+    return new_buffer
+
+
 class XavierLinear(nn.Module):
     
     ''' Simple Linear layer with xavier init '''
@@ -266,17 +284,20 @@ class MultiHeadAttention(nn.Module):
             # proj_value = self.fc_value(value, mask=value_mask)       # batch_size x len_key x h*d_head
             shared_qkv = group_linear([self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear], query)
             proj_query, proj_key, proj_value = shared_qkv.chunk(3, dim=-1)
-            if buffer is not None and 'k' in buffer and 'v' in buffer:
-                proj_key = torch.cat([buffer['k'], proj_key], dim=0) # time first
-                buffer['k'] = proj_key
-                proj_value = torch.cat([buffer['v'], proj_value], dim=0) # time first
-                buffer['v'] = proj_value
-                len_key,  b_ = proj_key.size(0), proj_key.size(1)
-            else:
-                if buffer is None:
-                    buffer = dict()
-                buffer['k'] = proj_key
-                buffer['v'] = proj_value
+            # the keys and values of the previous steps are kept in preallocated buffers (time first)
+            # which are only filled up to the current step: the number of steps is given by the mask
+            len_key = mask.size(-1)
+            if buffer is None:
+                buffer = dict()
+            if 'k' not in buffer or 'v' not in buffer:
+                buffer['k'] = proj_key.new(max(len_key, 16), b, proj_key.size(-1))
+                buffer['v'] = proj_value.new(max(len_key, 16), b, proj_value.size(-1))
+            buffer['k'] = grow_buffer(buffer['k'], len_key)
+            buffer['v'] = grow_buffer(buffer['v'], len_key)
+            buffer['k'][len_key - len_query:len_key].copy_(proj_key)
+            buffer['v'][len_key - len_query:len_key].copy_(proj_value)
+            proj_key = buffer['k'][:len_key]
+            proj_value = buffer['v'][:len_key]
         elif self.share == 2:
             proj_query = self.fc_query(query) # batch_size x len_query x h*d_head
             if buffer is not None and 'c_k' in buffer and 'c_v' in buffer:
@@ -293,26 +314,35 @@ class MultiHeadAttention(nn.Module):
             raise NotImplementedError
 
         q, k, v = proj_query, proj_key, proj_value
+
+        # the keys may be given once per source sentence (batch b_) for the b queries of beam search:
+        # the beam-major queries of the hypotheses of a sentence are then grouped instead of
+        # expanding the keys and values for every hypothesis
+        b_ = k.size(1)
+        beam = b // b_
         
         # prepare the shape for applying softmax
-        q = q.contiguous().view(len_query, b*self.h, self.d_head).transpose(0, 1)
-        k = k.contiguous().view(len_key,   b*self.h, self.d_head).transpose(0, 1)
-        v = v.contiguous().view(len_key,   b*self.h, self.d_head).transpose(0, 1)
+        q = q.contiguous().view(len_query*beam, b_*self.h, self.d_head).transpose(0, 1)
+        k = k.contiguous().view(len_key,   b_*self.h, self.d_head).transpose(0, 1)
+        v = v.contiguous().view(len_key,   b_*self.h, self.d_head).transpose(0, 1)
         
         q = q * (self.d_head**-0.5)
         
         # get dotproduct softmax attns for each head
         attns = torch.bmm(q, k.transpose(1,2))  # batch_size*h x len_query x len_key
         
-        attns = attns.view(b, self.h, len_query, len_key) 
+        attns = attns.view(b_, self.h, len_query*beam, len_key)
         mask_ = mask.unsqueeze(-3)
         # FP16 support: cast to float and back
         attns = attns.float().masked_fill_(mask_, -float('inf')).type_as(attns)
         attns = F.softmax(attns.float(), dim=-1).type_as(attns)
         # return mean attention from all heads as coverage 
-        coverage = torch.mean(attns, dim=1) 
+        coverage = torch.mean(attns, dim=1)
+        if beam > 1:
+            coverage = coverage.view(b_, len_query, beam, len_key).permute(2, 0, 1, 3).contiguous()
+            coverage = coverage.view(b, len_query, len_key)
         attns = self.attn_dropout(attns)
-        attns = attns.view(b*self.h, len_query, len_key)
+        attns = attns.view(b_*self.h, len_query*beam, len_key)
         
         # apply attns on value
         out = torch.bmm(attns, v)      # batch_size*h x len_query x d_head
@@ -1,7 +1,7 @@
 import numpy as np
 import torch, math
 import torch.nn as nn
-from onmt.modules.Transformer.Layers import EncoderLayer, DecoderLayer, PositionalEncoding, variational_dropout, PrePostProcessing
+from onmt.modules.Transformer.Layers import EncoderLayer, DecoderLayer, PositionalEncoding, variational_dropout, PrePostProcessing, grow_buffer
 from onmt.modules.BaseModel import NMTModel, Reconstructor, DecoderState
 import onmt
 from onmt.modules.WordDrop import embedded_dropout
@@ -267,13 +267,10 @@ class TransformerDecoder(nn.Module):
         buffers = decoder_state.attention_buffers
         src = decoder_state.src.transpose(0, 1) if decoder_state.src is not None else None
 
-        if decoder_state.input_seq is None:
-            decoder_state.input_seq = input
-        else:
-            # concatenate the last input to the previous input sequence
-            decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
-        input = decoder_state.input_seq.transpose(0, 1)
-        input_ = input[:,-1].unsqueeze(1)
+        # add the last input to the previous input sequence
+        input_seq = decoder_state.append_input(input)
+        input_ = input.transpose(0, 1)
+        len_tgt = input_seq.size(0)
 
         # output_buffer = list()
 
@@ -285,7 +282,7 @@ class TransformerDecoder(nn.Module):
         """ Adding positional encoding """
         if self.time == 'positional_encoding':
             emb = emb * math.sqrt(self.model_size)
-            emb = self.time_transformer(emb, t=input.size(1))
+            emb = self.time_transformer(emb, t=len_tgt)
         else:
             # prev_h = buffer[0] if buffer is None else None
             # emb = self.time_transformer(emb, prev_h)
@@ -311,11 +308,9 @@ class TransformerDecoder(nn.Module):
         else:
             mask_src = None
 
-        len_tgt = input.size(1)
-        mask_tgt = input.data.eq(onmt.Constants.PAD).unsqueeze(1) + self.mask[:len_tgt, :len_tgt]
-        mask_tgt = torch.gt(mask_tgt, 0)
-        mask_tgt = mask_tgt[:, -1, :].unsqueeze(1)
-        print(mask_tgt)
+        # the last position attends to all previous positions: only the padding is masked
+        # batch_size x 1 x len_tgt
+        mask_tgt = input_seq.t().eq(onmt.Constants.PAD).unsqueeze(1)
 
         output = emb.contiguous()
 
@@ -472,29 +467,56 @@ class TransformerDecodingState(DecoderState):
         self.original_src = src
         if src is not None:
             if src.dim() == 3:
-                self.src = src.narrow(2, 0, 1).squeeze(2).repeat(1, beam_size)
+                self.src = src.narrow(2, 0, 1).squeeze(2)
             else:
-                self.src = src.repeat(1, beam_size)
+                self.src = src
         else:
             self.src = None
 
-        if context is not None:
-            self.context = context.repeat(1, beam_size, 1)
-        else:
-            self.context = None
+        # the source side (src, context and the keys / values of the context attention) is kept once
+        # per sentence: all the hypotheses of a sentence share it
+        self.context = context
         self.beam_size = beam_size
 
         self.input_seq = None
         self.attention_buffers = dict()
         self.model_size = model_size
 
+    # the input sequence is kept in a preallocated buffer (T x B) filled up to input_length
+    @property
+    def input_seq(self):
+        if self.input_buffer is None:
+            return None
+        return self.input_buffer[:self.input_length]
+
+    @input_seq.setter
+    def input_seq(self, input_seq):
+        self.input_buffer = input_seq
+        self.input_length = input_seq.size(0) if input_seq is not None else 0
+
+    def append_input(self, input):
+        """
+        Add the input of the current step (1 x B) to the input sequence
+        :return: the input sequence (T x B)
+        """
+        if self.input_buffer is None:
+            self.input_buffer = input.new(16, input.size(1))
+            self.input_length = 0
+
+        self.input_buffer = grow_buffer(self.input_buffer, self.input_length + input.size(0))
+        self.input_buffer[self.input_length:self.input_length + input.size(0)].copy_(input)
+        self.input_length += input.size(0)
+
+        return self.input_seq
+
     def update_attention_buffer(self, buffer, layer):
 
         self.attention_buffers[layer] = buffer # dict of 2 keys (k, v) : T x B x H
 
     def update_beam(self, beam, b, remaining_sents, idx):
 
-        for tensor in [self.src, self.input_seq]  :
+        # the source side is shared by the hypotheses
+        for tensor in [self.input_seq]  :
 
             if tensor is None:
                 continue
@@ -512,12 +534,43 @@ class TransformerDecodingState(DecoderState):
                 continue
 
             for k in buffer_:
+                if k in ['c_k', 'c_v']:
+                    continue
                 t_, br_, d_ = buffer_[k].size()
                 sent_states = buffer_[k].view(t_, self.beam_size, remaining_sents, d_)[:, :, idx, :]
 
                 sent_states.data.copy_(sent_states.data.index_select(
                             1, beam[b].getCurrentOrigin()))
 
+    def reorder_beam(self, reorder_idx, active_idx=None):
+        """
+        Reorder the states of all hypotheses at once (beam-major: index = k * remaining_sents + b)
+        :param reorder_idx: for every new hypothesis, the index of the hypothesis it continues
+        :param active_idx: the indices of the remaining sentences when sentences are removed.
+               The source side states are kept once per sentence, so they only change then
+        """
+        if self.input_buffer is not None:
+            self.input_buffer = self.input_buffer.index_select(1, reorder_idx)
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+
+            if buffer_ is None:
+                continue
+
+            for k in buffer_:
+                if k in ['c_k', 'c_v']:
+                    if active_idx is not None:
+                        buffer_[k] = buffer_[k].index_select(1, active_idx)
+                else:
+                    buffer_[k] = buffer_[k].index_select(1, reorder_idx)
+
+        if active_idx is not None:
+            if self.context is not None:
+                self.context = self.context.index_select(1, active_idx)
+            if self.src is not None:
+                self.src = self.src.index_select(1, active_idx)
+
     # in this section, the sentences that are still active are
     # compacted so that the decoder is not run on completed sentences
     def prune_complete_beam(self, active_idx, remaining_sents):
@@ -544,7 +597,8 @@ class TransformerDecodingState(DecoderState):
 
         self.context = update_active(self.context)
 
-        self.input_seq = update_active_2d(self.input_seq)
+        # keep the capacity of the input buffer
+        self.input_buffer = update_active_2d(self.input_buffer)
 
         self.src = update_active_2d(self.src)
 
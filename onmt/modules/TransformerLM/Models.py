@@ -135,13 +135,10 @@ class TransformerLMDecoder(nn.Module):
         """
         buffers = decoder_state.attention_buffers
 
-        if decoder_state.input_seq is None:
-            decoder_state.input_seq = input
-        else:
-            # concatenate the last input to the previous input sequence
-            decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
-        input = decoder_state.input_seq.transpose(0, 1)
-        input_ = input[:,-1].unsqueeze(1)
+        # add the last input to the previous input sequence
+        input_seq = decoder_state.append_input(input)
+        input_ = input.transpose(0, 1)
+        len_tgt = input_seq.size(0)
 
         # output_buffer = list()
 
@@ -153,7 +150,7 @@ class TransformerLMDecoder(nn.Module):
         """ Adding positional encoding """
         if self.time == 'positional_encoding':
             emb = emb * math.sqrt(self.model_size)
-            emb = self.time_transformer(emb, t=input.size(1))
+            emb = self.time_transformer(emb, t=len_tgt)
         else:
             # prev_h = buffer[0] if buffer is None else None
             # emb = self.time_transformer(emb, prev_h)
@@ -172,11 +169,9 @@ class TransformerLMDecoder(nn.Module):
         # batch_size x 1 x len_src
 
 
-        len_tgt = input.size(1)
-        mask_tgt = input.data.eq(onmt.Constants.PAD).unsqueeze(1) + self.mask[:len_tgt, :len_tgt]
-        mask_tgt = torch.gt(mask_tgt, 0)
-        mask_tgt = mask_tgt[:, -1, :].unsqueeze(1)
-        # print(mask_tgt)
+        # the last position attends to all previous positions: only the padding is masked
+        # batch_size x 1 x len_tgt
+        mask_tgt = input_seq.t().eq(onmt.Constants.PAD).unsqueeze(1)
 
         output = emb.contiguous()
 
@@ -0,0 +1,202 @@
+"""
+Data parallel training with torch.distributed: one process per worker (GPU or CPU),
+the gradients are summed over the workers with all-reduce (nccl on GPUs, gloo on CPUs)
+"""
+
+import os
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+
+
+def world_size(opt):
+    """Number of training processes over all of the nodes"""
+    if opt.dist_url == 'env://':
+        # set by the launcher of the processes (e.g. torchrun)
+        return int(os.environ.get('WORLD_SIZE', 1))
+    return opt.nnodes * opt.nprocs
+
+
+def local_size(opt):
+    """Number of training processes on this node"""
+    if opt.dist_url == 'env://':
+        return int(os.environ.get('LOCAL_WORLD_SIZE', opt.nprocs))
+    return opt.nprocs
+
+
+def init_distributed(opt, local_rank):
+    """
+    Join the process group of the training processes. With env:// the rank, the world size
+    and the address of the first process are read from the environment (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT), otherwise the process local_rank of node node_rank
+    has the rank node_rank * nprocs + local_rank
+    """
+    backend = opt.dist_backend or ('nccl' if opt.gpus else 'gloo')
+    if opt.dist_url == 'env://':
+        dist.init_process_group(backend=backend, init_method='env://')
+    else:
+        dist.init_process_group(backend=backend, init_method=opt.dist_url,
+                                world_size=world_size(opt), rank=opt.node_rank * opt.nprocs + local_rank)
+
+
+def is_master():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def all_reduce_scalars(*values):
+    """Sum a few numbers over the workers"""
+    tensor = torch.DoubleTensor(values)
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def broadcast_scalars(*values, src=0):
+    """The values of one worker on all of them"""
+    tensor = torch.DoubleTensor(values)
+    if dist.get_backend() == 'nccl':
+        tensor = tensor.cuda()
+    dist.broadcast(tensor, src)
+    return tensor.tolist()
+
+
+def broadcast_parameters(model, src=0):
+    """Copy the parameters and the buffers of the model of one worker to all of the others"""
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+class _Bucket(object):
+    """Gradients of a few parameters, all-reduced together in one buffer"""
+
+    def __init__(self, params):
+        self.params = params
+        self.buffer = params[0].data.new(sum(p.numel() for p in params))
+        self.ready = set()
+        self.handle = None
+
+    def reduce_async(self):
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            if p.grad is None:
+                self.buffer[offset:offset+numel].zero_()
+            else:
+                self.buffer[offset:offset+numel].copy_(p.grad.data.view(-1))
+            offset += numel
+
+        self.handle = dist.all_reduce(self.buffer, async_op=True)
+
+    def wait(self):
+        self.handle.wait()
+
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            grad = self.buffer[offset:offset+numel].view_as(p.data)
+            if p.grad is None:
+                p.grad = grad.clone()
+            else:
+                p.grad.data.copy_(grad)
+            offset += numel
+
+        self.ready.clear()
+        self.handle = None
+
+
+class GradientReducer(object):
+    """
+    Sums the gradients of a model over the workers while the backward pass goes on.
+    The gradients are grouped into buckets of about bucket_size bytes, in the reverse order of the
+    parameters (roughly the order in which the backward pass produces them). Once all of the gradients
+    of a bucket are accumulated the bucket is all-reduced asynchronously; the buckets are always
+    started in the same order so that the collectives match on all of the workers.
+
+    The parameters which may receive their gradient several times during a backward pass (the ones
+    shared by several modules, and late_params) are only reduced once the backward pass is over,
+    as well as all of the parameters without overlap.
+
+    Only the backward passes run with require_sync set are reduced (the last one before an update):
+    synchronize() then waits for all of the buckets.
+    """
+
+    def __init__(self, model, bucket_size=25 * 1024 * 1024, late_params=None, overlap=True):
+
+        params = [p for p in model.parameters() if p.requires_grad]
+        self.require_sync = False
+
+        late = set(id(p) for p in late_params) if late_params is not None else set()
+        uses = defaultdict(int)
+        for module in model.modules():
+            for p in module._parameters.values():
+                if p is not None:
+                    uses[id(p)] += 1
+        late.update(key for key, count in uses.items() if count > 1)
+
+        if not overlap:
+            late.update(id(p) for p in params)
+
+        early_params = [p for p in reversed(params) if id(p) not in late]
+        late_params = [p for p in reversed(params) if id(p) in late]
+
+        self.buckets = self._make_buckets(early_params, bucket_size)
+        self.num_early_buckets = len(self.buckets)
+        self.buckets += self._make_buckets(late_params, bucket_size)
+        self.next_bucket = 0
+
+        # the hooks run once the gradients are accumulated into .grad
+        self._grad_accs = []
+        for i, bucket in enumerate(self.buckets[:self.num_early_buckets]):
+            for p in bucket.params:
+                grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+                grad_acc.register_hook(self._make_hook(p, i))
+                self._grad_accs.append(grad_acc)
+
+    @staticmethod
+    def _make_buckets(params, bucket_size):
+        buckets = []
+        current, size = [], 0
+        for p in params:
+            # a bucket only holds one type of tensors
+            if current and (size >= bucket_size or p.data.type() != current[0].data.type()):
+                buckets.append(_Bucket(current))
+                current, size = [], 0
+            current.append(p)
+            size += p.numel() * p.element_size()
+        if current:
+            buckets.append(_Bucket(current))
+        return buckets
+
+    def _make_hook(self, param, index):
+
+        def hook(*unused):
+            if not self.require_sync:
+                return
+
+            bucket = self.buckets[index]
+            if bucket.handle is not None:
+                raise RuntimeError("A gradient was accumulated after being reduced: "
+                                   "reduce the gradients after the backward pass (-reduce_after_backward)")
+            bucket.ready.add(id(param))
+
+            while self.next_bucket < self.num_early_buckets:
+                bucket = self.buckets[self.next_bucket]
+                if len(bucket.ready) < len(bucket.params):
+                    break
+                bucket.reduce_async()
+                self.next_bucket += 1
+
+        return hook
+
+    def synchronize(self):
+        """Finish the reduction of the gradients (after the last backward pass before an update)"""
+        for bucket in self.buckets[self.next_bucket:]:
+            bucket.reduce_async()
+
+        for bucket in self.buckets:
+            bucket.wait()
+
+        self.next_bucket = 0
+        self.require_sync = False
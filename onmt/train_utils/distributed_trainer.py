@@ -0,0 +1,153 @@
+from __future__ import division
+
+import math
+import time, datetime
+import torch
+import torch.distributed as dist
+import onmt
+from onmt.train_utils.trainer import XETrainer
+from onmt.data_utils.BatchLoader import BatchLoader
+from onmt.multiprocessing.distributed import GradientReducer, all_reduce_scalars, broadcast_scalars, \
+    broadcast_parameters
+
+
+class DistributedXETrainer(XETrainer):
+    """
+    Data parallel training, one trainer per process of the torch.distributed group.
+    Every worker trains on its share of the batches; the gradients are summed over the workers
+    during the backward pass of the last batch before each update (see GradientReducer) so that
+    all of the workers apply the same updates. Only the first worker writes the checkpoints.
+    """
+
+    def __init__(self, model, loss_function, train_data, valid_data, dicts, opt):
+        super().__init__(model, loss_function, train_data, valid_data, dicts, opt)
+
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+        # the same random orders of the batches on all of the workers
+        self.train_data.set_shard(self.rank, self.world_size, seed=opt.seed)
+        self.valid_data.set_shard(self.rank, self.world_size, even=False)
+
+        # with the sharded loss the generator receives its gradients several times per backward pass
+        late_params = self.model.generator.parameters() if opt.max_generator_batches > 0 else None
+        self.reducer = GradientReducer(self.model, bucket_size=opt.bucket_size * 1024 * 1024,
+                                       late_params=late_params, overlap=not opt.reduce_after_backward)
+
+    def synchronize_workers(self):
+        # all of the workers start from the parameters of the first one
+        broadcast_parameters(self.model)
+        # and from its number of updates (for the schedule of the learning rate)
+        self.optim._step = int(broadcast_scalars(self.optim._step)[0])
+        # but they use different dropout masks
+        torch.manual_seed(self.opt.seed + self.rank)
+
+    def save(self, epoch, valid_ppl, batch_order=None, iteration=-1):
+        if self.rank != 0:
+            return
+        # the order of all of the batches, sharded again when resuming
+        if batch_order is not None:
+            batch_order = self.train_data.full_order
+        super().save(epoch, valid_ppl, batch_order=batch_order, iteration=iteration)
+
+    def eval(self, data):
+        total_loss, total_words = self._eval_sums(data)
+        total_loss, total_words = all_reduce_scalars(total_loss, total_words)
+        return total_loss / total_words
+
+    def train_epoch(self, epoch, resume=False, batch_order=None, iteration=0):
+
+        opt = self.opt
+        train_data = self.train_data
+
+        self.optim.zero_grad()
+
+        if opt.extra_shuffle and epoch > opt.curriculum:
+            train_data.shuffle()
+
+        if resume:
+            train_data.set_order(batch_order)
+            train_data.set_index(iteration)
+            print("Resuming from iteration: %d" % iteration)
+        else:
+            # the curriculum keeps the batches sorted
+            train_data.create_order(random=(epoch >= opt.curriculum))
+            iteration = 0
+
+        total_loss, total_words = 0, 0
+        report_loss, report_tgt_words = 0, 0
+        report_src_words = 0
+        start = time.time()
+        n_samples = len(train_data)
+
+        num_accumulated_words = 0
+
+        data_iterator = iter(BatchLoader(train_data, num_workers=opt.num_workers, pin_memory=self.cuda))
+
+        for i in range(iteration, n_samples):
+
+            batch = next(data_iterator)
+            if self.cuda:
+                batch.cuda()
+
+            # the number of target words of the update with this batch, over all of the workers:
+            # it is known before the backward pass, which reduces the gradients if the update follows
+            num_update_words = all_reduce_scalars(num_accumulated_words + batch.tgt_size)[0]
+            update = num_update_words >= opt.batch_size_update * 0.95
+            self.reducer.require_sync = update
+
+            outputs = self.model(batch)
+            targets = batch.get('target_output')
+            outputs['tgt_mask'] = targets.ne(onmt.Constants.PAD)
+
+            loss_dict = self.loss_function(outputs, targets, model=self.model,
+                                           backward=True, normalizer=1)
+            loss_data = loss_dict['data']
+
+            src_size = batch.src_size
+            tgt_size = batch.tgt_size
+            num_accumulated_words += tgt_size
+
+            if update:
+                self.reducer.synchronize()
+                grad_denom = num_update_words if opt.normalize_gradient else 1
+                self.optim.step(grad_denom=grad_denom)
+                if self.ema is not None:
+                    flat_params = self.optim.flat_params
+                    self.ema.update(flat_params=flat_params.data.float() if flat_params is not None else None)
+                self.optim.zero_grad()
+                num_accumulated_words = 0
+                num_updates = self.optim._step
+                if opt.save_every > 0 and num_updates % opt.save_every == -1 % opt.save_every:
+                    valid_ppl = self.validate()
+                    print('Validation perplexity: %g' % valid_ppl)
+
+                    ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
+
+                    self.save(ep, valid_ppl, batch_order=train_data.full_order, iteration=i)
+
+            report_loss += loss_data
+            report_tgt_words += tgt_size
+            report_src_words += src_size
+            total_loss += loss_data
+            total_words += tgt_size
+            optim = self.optim
+
+            if i == 0 or (i % opt.log_interval == -1 % opt.log_interval):
+                # the speed of this worker
+                print(("Epoch %2d, %5d/%5d; ; ppl: %6.2f ; lr: %.7f ; num updates: %7d " +
+                       "%5.0f src tok/s; %5.0f tgt tok/s; %s elapsed") %
+                      (epoch, i+1, len(train_data),
+                       math.exp(report_loss / report_tgt_words),
+                       optim.getLearningRate(),
+                       optim._step,
+                       report_src_words/(time.time()-start),
+                       report_tgt_words/(time.time()-start),
+                       str(datetime.timedelta(seconds=int(time.time() - self.start_time)))))
+
+                report_loss, report_tgt_words = 0, 0
+                report_src_words = 0
+                start = time.time()
+
+        total_loss, total_words = all_reduce_scalars(total_loss, total_words)
+        return total_loss / total_words
@@ -0,0 +1,83 @@
+from contextlib import contextmanager
+
+
+class ExponentialMovingAverage(object):
+    """
+    Shadow copy of the trainable parameters of a model, in one flat fp32 buffer
+    (in the order of model.parameters()), updated after the optimizer steps:
+        shadow = decay * shadow + (1 - decay) * parameters
+    The shadow is only updated every `interval` steps (with the same decay)
+    """
+
+    def __init__(self, model, decay=0.9999, interval=1):
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.decay = decay
+        self.interval = interval
+        self.num_steps = 0
+
+        total_size = sum(p.numel() for p in self.params)
+        self.shadow = self.params[0].data.new(total_size).float()
+        self.buffer = None
+        self._flatten(out=self.shadow)
+
+    def _flatten(self, out):
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            out[offset:offset + numel].copy_(p.data.view(-1))
+            offset += numel
+        return out
+
+    def _copy_to_params(self, flat):
+        offset = 0
+        for p in self.params:
+            numel = p.numel()
+            p.data.copy_(flat[offset:offset + numel].view_as(p.data))
+            offset += numel
+
+    def update(self, flat_params=None):
+        """
+        Called after every optimizer step
+        :param flat_params: the parameters already flattened in fp32 (e.g. the master copy of fp16 training)
+        """
+        self.num_steps += 1
+        if self.num_steps % self.interval != 0:
+            return
+
+        if flat_params is None:
+            if self.buffer is None:
+                self.buffer = self.shadow.new(self.shadow.size())
+            flat_params = self._flatten(out=self.buffer)
+
+        self.shadow.mul_(self.decay).add_(flat_params, alpha=1 - self.decay)
+
+    @contextmanager
+    def average_parameters(self):
+        """Put the shadow parameters into the model (e.g. for validation) and restore them afterwards"""
+        if self.buffer is None:
+            self.buffer = self.shadow.new(self.shadow.size())
+        backup = self._flatten(out=self.buffer)
+        self._copy_to_params(self.shadow)
+        try:
+            yield
+        finally:
+            self._copy_to_params(backup)
+
+    def copy_to_model(self):
+        """Replace the parameters of the model by the shadow ones"""
+        self._copy_to_params(self.shadow)
+
+    def state_dict(self):
+        return {'shadow': self.shadow, 'decay': self.decay,
+                'interval': self.interval, 'num_steps': self.num_steps}
+
+    def load_state_dict(self, state_dict):
+        """Load the shadow and the step count: the decay and the interval (from the options) are kept"""
+        if state_dict['shadow'].numel() != self.shadow.numel():
+            raise ValueError("The EMA shadow does not match the parameters of the model")
+        if state_dict['decay'] != self.decay or state_dict['interval'] != self.interval:
+            print("WARNING: the moving average was kept with decay %g every %d steps, it continues with "
+                  "decay %g every %d steps" % (state_dict['decay'], state_dict['interval'],
+                                               self.decay, self.interval))
+        self.shadow.copy_(state_dict['shadow'])
+        self.num_steps = state_dict['num_steps']
@@ -16,6 +16,7 @@ import numpy as np
 from onmt.multiprocessing.multiprocessing_wrapper import MultiprocessingRunner
 from onmt.ModelConstructor import init_model_parameters
 from onmt.train_utils.trainer import BaseTrainer, XETrainer
+from onmt.data_utils.BatchLoader import BatchLoader
     
 
 class DynamicLossScaler:
@@ -138,7 +139,7 @@ class FP16XETrainer(XETrainer):
 
         # Shuffle mini batch order.
         if resume:
-            train_data.batch_order = batch_order
+            train_data.batchOrder = batch_order
             train_data.set_index(iteration)
             print("Resuming from iteration: %d" % iteration)
         else:
@@ -156,11 +157,13 @@ class FP16XETrainer(XETrainer):
         num_accumulated_sents = 0
         oom_count = 0
         
+        curriculum = (epoch < opt.curriculum)
+        data_iterator = iter(BatchLoader(train_data, num_workers=opt.num_workers,
+                                         pin_memory=True, curriculum=curriculum))
+
         for i in range(iteration, nSamples):
 
-            curriculum = (epoch < opt.curriculum)
-            
-            batch = train_data.next(curriculum=curriculum)[0]
+            batch = next(data_iterator)
             batch.cuda(fp16=self.fp16)
 
             oom = False
@@ -250,6 +253,9 @@ class FP16XETrainer(XETrainer):
                             numel = p.data.numel()
                             p.data.copy_(self.fp32_params.data[offset:offset+numel].view_as(p.data))
                             offset += numel
+
+                        if self.ema is not None:
+                            self.ema.update(flat_params=self.fp32_params.data)
                         
                         self.model.zero_grad()
                         self.optim.zero_grad()
@@ -258,8 +264,7 @@ class FP16XETrainer(XETrainer):
                         num_accumulated_sents = 0
                         num_updates = self.optim._step
                         if opt.save_every > 0 and num_updates % opt.save_every == -1 % opt.save_every :
-                            valid_loss = self.eval(self.valid_data)
-                            valid_ppl = math.exp(min(valid_loss, 100))
+                            valid_ppl = self.validate()
                             print('Validation perplexity: %g' % valid_ppl)
                             
                             ep = float(epoch) - 1. + ((float(i) + 1.) / nSamples)
@@ -312,6 +317,7 @@ class FP16XETrainer(XETrainer):
         if checkpoint is not None:
             print('Loading model and optim from checkpoint at %s' % save_file)
             self.model.load_state_dict(checkpoint['model'])
+            ema_state = checkpoint.get('ema')
             
             if not opt.reset_optim:
                 self.optim.load_state_dict(checkpoint['optim'])
@@ -339,10 +345,12 @@ class FP16XETrainer(XETrainer):
             print('Initializing model parameters')
             init_model_parameters(model, opt)
             resume=False
+            ema_state = None
+
+        self.synchronize_workers()
+        self.create_ema(ema_state)
         
-        
-        valid_loss = self.eval(self.valid_data)
-        valid_ppl = math.exp(min(valid_loss, 100))
+        valid_ppl = self.validate()
         print('Validation perplexity: %g' % valid_ppl)
         #~ 
         self.start_time = time.time()
@@ -358,8 +366,7 @@ class FP16XETrainer(XETrainer):
             print('Train perplexity: %g' % train_ppl)
 
             #  (2) evaluate on the validation set
-            valid_loss = self.eval(self.valid_data)
-            valid_ppl = math.exp(min(valid_loss, 100))
+            valid_ppl = self.validate()
             print('Validation perplexity: %g' % valid_ppl)
             
             
@@ -17,6 +17,8 @@ import numpy as np
 from onmt.multiprocessing.multiprocessing_wrapper import MultiprocessingRunner
 from onmt.ModelConstructor import init_model_parameters
 from onmt.utils import checkpoint_paths
+from onmt.data_utils.BatchLoader import BatchLoader
+from onmt.train_utils.ema import ExponentialMovingAverage
 
 
 
@@ -33,6 +35,7 @@ class BaseTrainer(object):
         
         self.loss_function = loss_function
         self.start_time = 0
+        self.ema = None
         
     def run(self, *args,**kwargs):
         
@@ -53,6 +56,31 @@ class BaseTrainer(object):
         return data
             
 
+    def synchronize_workers(self):
+        """Make the workers start from the same state, once the parameters are initialized or loaded
+        (nothing to do with a single worker)"""
+        pass
+
+    def create_ema(self, ema_state=None):
+        """Start keeping the moving average of the parameters (once they are initialized or loaded)"""
+        if self.opt.ema_decay <= 0:
+            return
+
+        self.ema = ExponentialMovingAverage(self.model, decay=self.opt.ema_decay,
+                                            interval=self.opt.ema_interval)
+        if ema_state is not None:
+            self.ema.load_state_dict(ema_state)
+
+    def validate(self):
+        """Validation perplexity, with the averaged parameters when they are kept"""
+        if self.ema is not None:
+            with self.ema.average_parameters():
+                valid_loss = self.eval(self.valid_data)
+        else:
+            valid_loss = self.eval(self.valid_data)
+
+        return math.exp(min(valid_loss, 100))
+
     def _get_grads(self):
         grads = []
         for name, p in self.model.named_parameters():
@@ -110,7 +138,8 @@ class XETrainer(BaseTrainer):
                 'epoch': epoch,
                 'iteration' : iteration,
                 'batch_order' : batch_order,
-                'optim': optim_state_dict
+                'optim': optim_state_dict,
+                'ema': self.ema.state_dict() if self.ema is not None else None
         }
         
         file_name = '%s_ppl_%.2f_e%.2f.pt' % (opt.save_model, valid_ppl, epoch)
@@ -125,6 +154,11 @@ class XETrainer(BaseTrainer):
             os.remove(save_file)
 
     def eval(self, data):
+        total_loss, total_words = self._eval_sums(data)
+        return total_loss / total_words
+
+    def _eval_sums(self, data):
+        """Sum of the losses and number of target words of the data"""
         total_loss = 0
         total_words = 0
                 
@@ -157,7 +191,7 @@ class XETrainer(BaseTrainer):
                 total_words += batch.tgt_size
 
         self.model.train()
-        return total_loss / total_words
+        return total_loss, total_words
         
     def train_epoch(self, epoch, resume=False, batch_order=None, iteration=0):
         
@@ -166,7 +200,7 @@ class XETrainer(BaseTrainer):
         
         # Clear the gradients of the model
         # self.runner.zero_grad()
-        self.model.zero_grad()
+        self.optim.zero_grad()
 
         if opt.extra_shuffle and epoch > opt.curriculum:
             train_data.shuffle()
@@ -174,7 +208,7 @@ class XETrainer(BaseTrainer):
         # Shuffle mini batch order.
         
         if resume:
-            train_data.batch_order = batch_order
+            train_data.batchOrder = batch_order
             train_data.set_index(iteration)
             print("Resuming from iteration: %d" % iteration)
         else:
@@ -190,12 +224,14 @@ class XETrainer(BaseTrainer):
         counter = 0
         num_accumulated_words = 0
         num_accumulated_sents = 0
+
+        curriculum = (epoch < opt.curriculum)
+        data_iterator = iter(BatchLoader(train_data, num_workers=opt.num_workers,
+                                         pin_memory=self.cuda, curriculum=curriculum))
         
         for i in range(iteration, n_samples):
 
-            curriculum = (epoch < opt.curriculum)
-
-            batch = train_data.next(curriculum=curriculum)[0]
+            batch = next(data_iterator)
             if(self.cuda):
                 batch.cuda()
             
@@ -247,14 +283,17 @@ class XETrainer(BaseTrainer):
                         grad_denom = num_accumulated_words
                     # Update the parameters.
                     self.optim.step(grad_denom=grad_denom)
-                    self.model.zero_grad()
+                    if self.ema is not None:
+                        flat_params = self.optim.flat_params
+                        self.ema.update(flat_params=flat_params.data.float() if flat_params is not None else None)
+                    # (the optimizer keeps the gradients of flat parameters)
+                    self.optim.zero_grad()
                     counter = 0
                     num_accumulated_words = 0
                     num_accumulated_sents = 0
                     num_updates = self.optim._step
                     if opt.save_every > 0 and num_updates % opt.save_every == -1 % opt.save_every :
-                        valid_loss = self.eval(self.valid_data)
-                        valid_ppl = math.exp(min(valid_loss, 100))
+                        valid_ppl = self.validate()
                         print('Validation perplexity: %g' % valid_ppl)
                         
                         ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
@@ -300,6 +339,7 @@ class XETrainer(BaseTrainer):
         if checkpoint is not None:
             print('Loading model and optim from checkpoint at %s' % save_file)
             self.model.load_state_dict(checkpoint['model'])
+            ema_state = checkpoint.get('ema')
             
             if not opt.reset_optim:
                 self.optim.load_state_dict(checkpoint['optim'])
@@ -325,9 +365,12 @@ class XETrainer(BaseTrainer):
             print('Initializing model parameters')
             init_model_parameters(model, opt)
             resume=False
-        
-        valid_loss = self.eval(self.valid_data)
-        valid_ppl = math.exp(min(valid_loss, 100))
+            ema_state = None
+
+        self.synchronize_workers()
+        self.create_ema(ema_state)
+
+        valid_ppl = self.validate()
         print('Validation perplexity: %g' % valid_ppl)
         
         self.start_time = time.time()
@@ -343,8 +386,7 @@ class XETrainer(BaseTrainer):
             print('Train perplexity: %g' % train_ppl)
 
             #  (2) evaluate on the validation set
-            valid_loss = self.eval(self.valid_data)
-            valid_ppl = math.exp(min(valid_loss, 100))
+            valid_ppl = self.validate()
             print('Validation perplexity: %g' % valid_ppl)
 
             self.save(epoch, valid_ppl)
@@ -1,3 +1,4 @@
+import inspect
 import logging, traceback
 import os, re
 import torch
@@ -46,4 +47,121 @@ def checkpoint_paths(path, pattern=r'model_ppl_(\d+).(\d+)\_e(\d+).(\d+).pt'):
             idx = int(m.group(1)) if len(m.groups()) > 0 else i
             entries.append((idx, m.group(0)))
     # return [os.path.join(path, x[1]) for x in sorted(entries, reverse=True)]
-    return [os.path.join(path, x[1]) for x in entries]
\ No newline at end of file
+    return [os.path.join(path, x[1]) for x in entries]
+
+def load_checkpoint(path, mmap=True):
+    """
+    torch.load on the CPU, memory-mapping the file when possible (PyTorch >= 2.1, zip format):
+    the tensors are then only read when they are used
+    :return: the checkpoint and whether it is memory-mapped
+    """
+    map_location = lambda storage, loc: storage
+    # the checkpoints hold the options and the dictionaries as well as the tensors:
+    # they are fully unpickled (PyTorch >= 2.6 only loads the tensors by default)
+    kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    if mmap:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True, **kwargs), True
+        except (TypeError, RuntimeError):
+            # older PyTorch (no mmap argument) or checkpoint in the legacy format
+            pass
+
+    return torch.load(path, map_location=map_location, **kwargs), False
+
+
+def average_checkpoints(paths, method='mean', ema_decay=0.9, mmap=True):
+    """
+    Average the model parameters (and floating point buffers) of several checkpoints,
+    directly from their state dicts, with float64 accumulators:
+        mean: arithmetic mean
+        gmean: geometric mean of the absolute values, with the sign of the product
+        ema: weighted mean with the weights decay^(n-1-i), the last checkpoint having the largest weight
+    When the checkpoints can be memory-mapped, the tensors are averaged one key at a time over all
+    checkpoints; otherwise the checkpoints are loaded one after the other (without their optimizer state)
+    :return: the averaged state dict and the first checkpoint (without model and optimizer state)
+    """
+    n = len(paths)
+    if method in ['mean', 'gmean']:
+        weights = [1. / n] * n
+    elif method == 'ema':
+        weights = [ema_decay ** (n - 1 - i) for i in range(n)]
+        weights = [w / sum(weights) for w in weights]
+    else:
+        raise NotImplementedError("Unknown averaging method %s" % method)
+
+    def accumulate(acc, tensor, weight):
+        value = tensor.double()
+        if method == 'gmean':
+            if acc is None:
+                acc = (value.new(value.size()).zero_(), value.new(value.size()).zero_())
+            acc[0].add_(value.abs().log(), alpha=weight)
+            acc[1].add_(value.lt(0).double())
+            return acc
+        if acc is None:
+            return value.mul(weight)
+        return acc.add_(value, alpha=weight)
+
+    def finalize(acc, like):
+        if method == 'gmean':
+            log_abs, negatives = acc
+            # odd number of negative values: negative product
+            value = log_abs.exp_().mul_(1 - 2 * negatives.remainder(2))
+        else:
+            value = acc
+        return value.type_as(like)
+
+    print("Loading checkpoint %s ..." % paths[0])
+    first, mapped = load_checkpoint(paths[0], mmap=mmap)
+    first.pop('optim', None)
+    first_state = first.pop('model')
+    keys = list(first_state.keys())
+
+    def check_keys(state, path):
+        if set(state.keys()) != set(keys):
+            raise ValueError("The parameters of %s differ from those of %s" % (path, paths[0]))
+
+    averaged = dict()
+    if mapped:
+        # all checkpoints are mapped at once, the tensors are read key by key
+        states = [first_state]
+        for path in paths[1:]:
+            print("Mapping checkpoint %s ..." % path)
+            checkpoint = load_checkpoint(path, mmap=True)[0]
+            check_keys(checkpoint['model'], path)
+            states.append(checkpoint['model'])
+            del checkpoint
+
+        for key in keys:
+            like = first_state[key]
+            if not torch.is_floating_point(like):
+                averaged[key] = like.clone()
+                continue
+            acc = None
+            for state, weight in zip(states, weights):
+                acc = accumulate(acc, state[key], weight)
+            averaged[key] = finalize(acc, like)
+    else:
+        accs = dict()
+        for i, path in enumerate(paths):
+            if i == 0:
+                state = first_state
+            else:
+                print("Loading checkpoint %s ..." % path)
+                checkpoint = load_checkpoint(path, mmap=False)[0]
+                state = checkpoint['model']
+                del checkpoint
+                check_keys(state, path)
+
+            for key in keys:
+                if torch.is_floating_point(first_state[key]):
+                    accs[key] = accumulate(accs.get(key), state[key], weights[i])
+            del state
+
+        for key in keys:
+            like = first_state[key]
+            if torch.is_floating_point(like):
+                averaged[key] = finalize(accs.pop(key), like)
+            else:
+                averaged[key] = like.clone()
+
+    return averaged, first
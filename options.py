@@ -7,7 +7,7 @@ def make_parser(parser):
     parser.add_argument('-data', required=True,
                         help='Path to the *-train.pt file from preprocess.py')
     parser.add_argument('-data_format', required=True, default='bin',
-                        help='Default data format: raw')
+                        help='Data format: raw|bin. The bin data files are memory-mapped')
     parser.add_argument('-sort_by_target', action='store_true',
                         help='Training data sorted by target')                    
     parser.add_argument('-pad_count', action='store_true',
@@ -81,10 +81,10 @@ def make_parser(parser):
                         help='Maximum number of sentences in a batch')
     parser.add_argument('-ctc_loss', type=float, default=0.0,
                         help='CTC Loss as additional loss function with this weight')
-    parser.add_argument('-max_generator_batches', type=int, default=32,
-                        help="""Maximum batches of words in a sequence to run
-                        the generator on in parallel. Higher is faster, but uses
-                        more memory.""")
+    parser.add_argument('-max_generator_batches', type=int, default=0,
+                        help="""Maximum number of target words to run the generator
+                        and the loss on at once during training (0 for all the words of a batch).
+                        Lower uses less memory.""")
     parser.add_argument('-batch_size_update', type=int, default=2048,
                         help='Maximum number of words per update')                    
     parser.add_argument('-batch_size_multiplier', type=int, default=1,
@@ -152,6 +152,9 @@ def make_parser(parser):
                         help="""weight decay (L2 penalty)""")
     parser.add_argument('-amsgrad', action='store_true',
                         help='Using AMSGRad for adam')    
+    parser.add_argument('-flat_parameters', action='store_true',
+                        help="""Keep the parameters and the gradients in two flat buffers, so that
+                        the normalization, the clipping and the optimizer update are single operations""")
     parser.add_argument('-update_method', default='regular',
                         help="Type of update rule to use. Options are [regular|noam].")                                    
     # pretrained word vectors
@@ -171,12 +174,35 @@ def make_parser(parser):
     # GPU
     parser.add_argument('-gpus', default=[], nargs='+', type=int,
                         help="Use CUDA on the listed devices.")
+    parser.add_argument('-nprocs', type=int, default=1,
+                        help="""Number of data parallel training processes on this node, one per device
+                        of -gpus (or on the CPU without -gpus)""")
+    parser.add_argument('-nnodes', type=int, default=1,
+                        help="""Number of nodes of data parallel training (each running -nprocs processes)""")
+    parser.add_argument('-node_rank', type=int, default=0,
+                        help="""Index of this node among the -nnodes nodes""")
+    parser.add_argument('-dist_backend', default='',
+                        help="""Backend of torch.distributed for data parallel training
+                        (by default nccl on GPUs and gloo on CPUs)""")
+    parser.add_argument('-dist_url', default='tcp://127.0.0.1:23456',
+                        help="""Address of the first node, used to set up data parallel training.
+                        With env:// the processes are started by a launcher (e.g. torchrun)
+                        which sets RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT""")
+    parser.add_argument('-bucket_size', type=int, default=25,
+                        help="""Size (in MB) of the buckets of gradients reduced together during the
+                        backward pass in data parallel training""")
+    parser.add_argument('-reduce_after_backward', action='store_true',
+                        help="""Reduce the gradients once the backward pass is over, instead of
+                        during it (e.g. for models reusing their layers)""")
     parser.add_argument('-fp16', action='store_true',
                         help='Use half precision training')     
     parser.add_argument('-fp16_loss_scale', type=float, default=8,
                         help="""Loss scale for fp16 loss (to avoid overflowing in fp16).""")
     parser.add_argument('-seed', default=9999, type=int,
                         help="Seed for deterministic runs.")
+    parser.add_argument('-num_workers', type=int, default=0,
+                        help='Number of worker processes preparing the training batches in the background. '
+                             '0 means that the batches are prepared in the main process')
 
     parser.add_argument('-log_interval', type=int, default=100,
                         help="Print stats at this interval.")
@@ -184,6 +210,11 @@ def make_parser(parser):
                         help="Save every this interval.")
     parser.add_argument('-keep_save_files', type=int, default=5,
                         help="Save every this interval.")
+    parser.add_argument('-ema_decay', type=float, default=0.0,
+                        help="""Keep an exponential moving average of the parameters with this decay
+                        (0 to disable). It is used for validation and saved in the checkpoints""")
+    parser.add_argument('-ema_interval', type=int, default=1,
+                        help="""Update the moving average every this many updates""")
 
     # for FUSION
     parser.add_argument('-lm_checkpoint', default='', type=str,
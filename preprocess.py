@@ -1,9 +1,13 @@
 import onmt
 import onmt.Markdown
 import argparse
+import heapq
+import os
 import torch
+from collections import Counter
+from multiprocessing import Pool
 
-from onmt.data_utils.IndexedDataset import IndexedDatasetBuilder
+from onmt.data_utils.IndexedDataset import IndexedDatasetBuilder, MMapIndexedDataset, merge_indexed_datasets
 
 import h5py as h5
 import numpy as np
@@ -88,6 +92,15 @@ parser.add_argument('-sort_by_target', action='store_true', help='lowercase data
 parser.add_argument('-join_vocab', action='store_true', help='Using one dictionary for both source and target')
 
 
+parser.add_argument('-stream', action='store_true',
+                    help="Process the text data shard by shard and write the shards directly as indexed "
+                         "data files, so that the memory usage does not grow with the corpus size. "
+                         "Requires -format bin")
+parser.add_argument('-num_threads', type=int, default=1,
+                    help="Number of processes used to count the vocabulary and to prepare the shards in -stream mode")
+parser.add_argument('-shard_size', type=int, default=1000000,
+                    help="Number of lines in each shard in -stream mode")
+
 parser.add_argument('-report_every', type=int, default=100000,
                     help="Report status every this many sentences")
 parser.add_argument('-reshape_speech', type=int, default=1,
@@ -121,57 +134,80 @@ def split_line_by_char(line, word_list=["<unk>"]):
 
     return chars
 
-def make_join_vocab(filenames, size, input_type="word"):
-    
-    vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
-                       onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD],
-                      lower=opt.lower)
-    
-    for filename in filenames:
-        print("Reading file %s ... " % filename)
-        with open(filename) as f:
-            for sent in f.readlines():
+def read_chunk(filename, start, end):
+    """
+    Read the lines starting between the byte offsets start and end of a file
+    """
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # move to the beginning of the first line starting at or after start
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8')
+
+
+def count_tokens(job):
+    """
+    Count the tokens in one chunk of a file
+    """
+    filename, start, end, input_type = job
+    counter = Counter()
+
+    for sent in read_chunk(filename, start, end):
+        if input_type == "word":
+            counter.update(sent.split())
+        elif input_type == "char":
+            counter.update(split_line_by_char(sent))
+        else:
+            raise NotImplementedError("Input type not implemented")
 
-                if input_type == "word":
-                    for word in sent.split():
-                        vocab.add(word)
-                elif input_type == "char":
-                    chars = split_line_by_char(sent)
-                    for char in chars:
-                        vocab.add(char)
-                else:
-                    raise NotImplementedError("Input type not implemented")
+    return counter
 
 
-    original_size = vocab.size()
-    vocab = vocab.prune(size)
-    print('Created dictionary of size %d (pruned from %d)' %
-          (vocab.size(), original_size))
+def count_vocab(filenames, input_type="word", num_threads=1):
+    """
+    Count the tokens of the files with num_threads processes, each working on a byte range of a file.
+    The counters are merged in file order, so the tokens keep the order of their first occurrence
+    """
+    jobs = []
+    n_chunks = num_threads * 4 if num_threads > 1 else 1
 
-    return vocab
+    for filename in filenames:
+        print("Reading file %s ... " % filename)
+        file_size = os.path.getsize(filename)
+        bounds = [file_size * i // n_chunks for i in range(n_chunks + 1)]
+        jobs += [(filename, bounds[i], bounds[i + 1], input_type) for i in range(n_chunks)]
+
+    counts = Counter()
+
+    if num_threads > 1:
+        pool = Pool(num_threads)
+        for counter in pool.imap(count_tokens, jobs):
+            counts.update(counter)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            counts.update(count_tokens(job))
+
+    return counts
 
 
-def make_vocab(filename, size, input_type='word'):
+def make_join_vocab(filenames, size, input_type="word", num_threads=1):
+    
     vocab = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
                        onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD],
                       lower=opt.lower)
 
-    unk_count = 0
-
-    with open(filename) as f:
-        for sent in f.readlines():
-            if input_type == "word":
-                for word in sent.split():
-                    idx = vocab.add(word)
-            elif input_type == "char":
-                chars = split_line_by_char(sent)
-                for char in chars:
-                    idx = vocab.add(char)
-            else:
-                raise NotImplementedError("Input type not implemented")
-
-            if idx == 'onmt.Constants.UNK':
-                unk_count += 1
+    for word, count in count_vocab(filenames, input_type=input_type, num_threads=num_threads).items():
+        vocab.add(word, count=count)
 
     original_size = vocab.size()
     vocab = vocab.prune(size)
@@ -181,6 +217,11 @@ def make_vocab(filename, size, input_type='word'):
     return vocab
 
 
+def make_vocab(filename, size, input_type='word', num_threads=1):
+
+    return make_join_vocab([filename], size, input_type=input_type, num_threads=num_threads)
+
+
 def init_vocab(name, dataFile, vocabFile, vocabSize, join=False, input_type='word'):
 
     vocab = None
@@ -197,10 +238,12 @@ def init_vocab(name, dataFile, vocabFile, vocabSize, join=False, input_type='wor
         if join:
             
             print('Building ' + 'shared' + ' vocabulary...')
-            gen_word_vocab = make_join_vocab(dataFile, vocabSize, input_type=input_type)
+            gen_word_vocab = make_join_vocab(dataFile, vocabSize, input_type=input_type,
+                                             num_threads=opt.num_threads)
         else:
             print('Building ' + name + ' vocabulary...')
-            gen_word_vocab = make_vocab(dataFile, vocabSize, input_type=input_type)
+            gen_word_vocab = make_vocab(dataFile, vocabSize, input_type=input_type,
+                                        num_threads=opt.num_threads)
 
         vocab = gen_word_vocab
 
@@ -371,6 +414,222 @@ def make_translation_data(src_file, tgt_file, srcDicts, tgt_dicts, max_src_lengt
     return src, tgt
 
 
+def find_shard_offsets(filename, shard_size):
+    """
+    :return: the byte offsets of the first line of every shard of shard_size lines, and the number of lines
+    """
+    offsets = []
+    n_lines, offset = 0, 0
+
+    with open(filename, 'rb') as f:
+        for line in f:
+            if n_lines % shard_size == 0:
+                offsets.append(offset)
+            offset += len(line)
+            n_lines += 1
+
+    return offsets, n_lines
+
+
+def read_lines(filename, offset, n_lines):
+
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for _ in range(n_lines):
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode('utf-8')
+
+
+_shard_dicts = dict()
+
+
+def init_shard_worker(dicts):
+    # the dictionaries are sent once to every worker instead of once per shard
+    _shard_dicts.update(dicts)
+
+
+def binarize_shard(job):
+    """
+    Filter, index and sort one shard of the (parallel) corpus and write it as indexed data files
+    (out_prefix.src.bin/idx and out_prefix.tgt.bin/idx). The source side is skipped for LM data
+    """
+    shard_id, src_file, tgt_file, src_offset, tgt_offset, n_lines, out_prefix, \
+        max_src_length, max_tgt_length, input_type = job
+
+    src, tgt = [], []
+    count, ignored = 0, 0
+
+    tgt_lines = read_lines(tgt_file, tgt_offset, n_lines)
+    if src_file is not None:
+        lines = zip(read_lines(src_file, src_offset, n_lines), tgt_lines)
+    else:
+        lines = ((tline, tline) for tline in tgt_lines)
+
+    for sline, tline in lines:
+
+        sline = sline.strip()
+        tline = tline.strip()
+
+        # source and/or target are empty
+        if sline == "" or tline == "":
+            print('WARNING: ignoring an empty line (shard %d, line %d)' % (shard_id, count + 1))
+            continue
+
+        if input_type == 'word':
+            src_words = sline.split()
+            tgt_words = tline.split()
+        elif input_type == 'char':
+            src_words = split_line_by_char(sline)
+            tgt_words = split_line_by_char(tline)
+
+        if (src_file is None or len(src_words) <= max_src_length) \
+                and len(tgt_words) <= max_tgt_length - 2:
+
+            # Check truncation condition.
+            if opt.src_seq_length_trunc != 0:
+                src_words = src_words[:opt.src_seq_length_trunc]
+            if opt.tgt_seq_length_trunc != 0:
+                tgt_words = tgt_words[:opt.tgt_seq_length_trunc]
+
+            if src_file is not None:
+                src += [_shard_dicts['src'].convertToIdx(src_words,
+                                                         onmt.Constants.UNK_WORD)]
+
+            tgt += [_shard_dicts['tgt'].convertToIdx(tgt_words,
+                                                     onmt.Constants.UNK_WORD,
+                                                     onmt.Constants.BOS_WORD,
+                                                     onmt.Constants.EOS_WORD)]
+        else:
+            ignored += 1
+
+        count += 1
+
+    # the ties are broken by a random number per sentence, which is kept for the merge:
+    # the sentences of the same length are shuffled across all the shards
+    if opt.shuffle == 1:
+        tie_break = np.random.RandomState(opt.seed + shard_id).random_sample(len(tgt))
+    else:
+        tie_break = np.zeros(len(tgt))
+
+    # sort by target size, then by source size (the shards are merged with the same keys)
+    if src_file is not None:
+        order = sorted(range(len(tgt)), key=lambda i: (tgt[i].size(0), src[i].size(0), tie_break[i]))
+    else:
+        sign = -1 if opt.sort_type == 'descending' else 1
+        order = sorted(range(len(tgt)), key=lambda i: (sign * tgt[i].size(0), tie_break[i]))
+
+    np.save(out_prefix + ".tie_break.npy", tie_break[order])
+
+    for set, data in [('src', src), ('tgt', tgt)]:
+        if set == 'src' and src_file is None:
+            continue
+
+        builder = IndexedDatasetBuilder(out_prefix + ".%s.bin" % set, dtype=np.int32)
+        for i in order:
+            builder.add_item(data[i])
+        builder.finalize(out_prefix + ".%s.idx" % set)
+
+    print('... shard %d: %d sentences prepared' % (shard_id, len(order)))
+
+    return len(order), ignored
+
+
+def sorted_shard_items(shard_id, tie_break, tgt_shard, src_shard=None, chunk_size=100000, descending=False):
+    """
+    Yield the sort keys of the items in a sorted shard, reading the lengths from its index chunk by chunk.
+    tie_break is the random number of every item (in the order of the shard)
+    """
+    for start in range(0, tgt_shard.size, chunk_size):
+        end = min(start + chunk_size, tgt_shard.size)
+        tgt_sizes = tgt_shard.sizes[tgt_shard.dim_offsets[start:end]].tolist()
+        ties = tie_break[start:end].tolist()
+
+        if src_shard is not None:
+            src_sizes = src_shard.sizes[src_shard.dim_offsets[start:end]].tolist()
+            for j in range(end - start):
+                yield (tgt_sizes[j], src_sizes[j], ties[j], shard_id, start + j)
+        else:
+            sign = -1 if descending else 1
+            for j in range(end - start):
+                yield (sign * tgt_sizes[j], ties[j], shard_id, start + j)
+
+
+def make_stream_data(src_file, tgt_file, dicts, out_prefix, max_src_length=64, max_tgt_length=64,
+                     input_type='word', num_threads=1, shard_size=1000000):
+    """
+    Prepare the indexed data files out_prefix.src.bin/idx and out_prefix.tgt.bin/idx shard by shard.
+    The shards are processed in parallel, then merged (sorted by length) into the final files.
+    The length of every sentence is available in the index (sizes) of the data files.
+    src_file is None for LM data
+    """
+    print('Processing %s & %s ...' % (src_file, tgt_file))
+
+    tgt_offsets, n_lines = find_shard_offsets(tgt_file, shard_size)
+    if src_file is not None:
+        src_offsets, n_src_lines = find_shard_offsets(src_file, shard_size)
+        if n_src_lines != n_lines:
+            print('WARNING: src and tgt do not have the same # of sentences')
+            n_lines = min(n_lines, n_src_lines)
+    else:
+        src_offsets = tgt_offsets
+
+    n_shards = (n_lines + shard_size - 1) // shard_size
+    shard_prefixes = [out_prefix + ".shard%d" % i for i in range(n_shards)]
+    jobs = [(i, src_file, tgt_file, src_offsets[i], tgt_offsets[i],
+             min(shard_size, n_lines - i * shard_size), shard_prefixes[i],
+             max_src_length, max_tgt_length, input_type) for i in range(n_shards)]
+    sets = ['tgt'] if src_file is None else ['src', 'tgt']
+
+    # the shard files are removed even if the preparation fails
+    try:
+        if num_threads > 1:
+            pool = Pool(num_threads, initializer=init_shard_worker, initargs=(dicts,))
+            results = pool.map(binarize_shard, jobs, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            init_shard_worker(dicts)
+            results = [binarize_shard(job) for job in jobs]
+
+        count = sum(r[0] for r in results)
+        ignored = sum(r[1] for r in results)
+
+        # the shards whose lines were all filtered out are left out of the merge
+        # (the first one is kept when there is no sentence at all: the merged files are then empty)
+        merged_prefixes = [prefix for prefix, r in zip(shard_prefixes, results) if r[0] > 0] or shard_prefixes[:1]
+        n_merged = len(merged_prefixes)
+
+        # merge the sorted shards into one sorted dataset
+        print('... merging %d shards' % n_merged)
+
+        for set in sets:
+            tgt_shards = [MMapIndexedDataset(prefix + ".tgt") for prefix in merged_prefixes]
+            src_shards = [MMapIndexedDataset(prefix + ".src") for prefix in merged_prefixes] \
+                if src_file is not None else [None] * n_merged
+
+            tie_breaks = [np.load(prefix + ".tie_break.npy", mmap_mode='r') for prefix in merged_prefixes]
+
+            keys = heapq.merge(*[sorted_shard_items(i, tie_breaks[i], tgt_shards[i], src_shards[i],
+                                                    descending=(opt.sort_type == 'descending'))
+                                 for i in range(n_merged)])
+            order = (key[-2:] for key in keys)
+
+            merge_indexed_datasets([prefix + "." + set for prefix in merged_prefixes],
+                                   out_prefix + ".%s" % set, order=order)
+    finally:
+        for prefix in shard_prefixes:
+            paths = [prefix + ".%s.%s" % (set, ext) for set in sets for ext in ['bin', 'idx']]
+            for path in paths + [prefix + ".tie_break.npy"]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    print(('Prepared %d sentences ' +
+           '(%d ignored due to length == 0 or src len > %d or tgt len > %d)') %
+          (count, ignored, max_src_length, max_tgt_length))
+
+
 def make_asr_data(src_file, tgt_file, tgt_dicts, max_src_length=64, max_tgt_length=64,
                   input_type='word', stride=1, concat=1, prev_context = 0, fp16=False, reshape=True):
     src, tgt = [], []
@@ -541,6 +800,34 @@ def main():
                                       opt.tgt_vocab_size, input_type=opt.input_type)
 
 
+    if opt.stream:
+        if opt.format != 'bin' or opt.asr:
+            print("Streaming is only available for text data in the binary format")
+            raise AssertionError
+
+        if opt.src_vocab is None and opt.lm == False:
+            save_vocabulary('source', dicts['src'], opt.save_data + '.src.dict')
+        if opt.tgt_vocab is None:
+            save_vocabulary('target', dicts['tgt'], opt.save_data + '.tgt.dict')
+
+        torch.save(dicts, opt.save_data + '.dict.pt')
+
+        print('Preparing training data ...')
+        make_stream_data(None if opt.lm else opt.train_src, opt.train_tgt, dicts, opt.save_data + ".train",
+                         max_src_length=opt.src_seq_length,
+                         max_tgt_length=opt.tgt_seq_length,
+                         input_type=opt.input_type,
+                         num_threads=opt.num_threads, shard_size=opt.shard_size)
+
+        print('Preparing validation ...')
+        make_stream_data(None if opt.lm else opt.valid_src, opt.valid_tgt, dicts, opt.save_data + ".valid",
+                         max_src_length=max(1024, opt.src_seq_length),
+                         max_tgt_length=max(1024, opt.tgt_seq_length),
+                         input_type=opt.input_type,
+                         num_threads=opt.num_threads, shard_size=opt.shard_size)
+        print("Done")
+        return
+
     if opt.lm:
         print('Preparing training language model ...')
         train = dict()
@@ -0,0 +1,57 @@
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+from onmt.ModelConstructor import build_model, quantize_model
+
+
+parser = argparse.ArgumentParser(description='quantize_model.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.quantized.pt',
+                    help="""Path to output quantized model""")
+parser.add_argument('-quantize', default='int8',
+                    help="""Quantization of the linear layers: int8""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = torch.load(opt.model, map_location=lambda storage, loc: storage)
+
+    if checkpoint.get('quantize') is not None:
+        print("The model is already quantized (%s)" % checkpoint['quantize'])
+        return
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+
+    model = quantize_model(model, opt.quantize)
+
+    # the optimizer state is not needed for decoding
+    quantized_checkpoint = {
+        'model': model.state_dict(),
+        'dicts': dicts,
+        'opt': model_opt,
+        'epoch': checkpoint.get('epoch', -1),
+        'iteration': -1,
+        'batch_order': None,
+        'optim': None,
+        'quantize': opt.quantize
+    }
+
+    print("Saving quantized model to %s" % opt.output)
+    torch.save(quantized_checkpoint, opt.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+from __future__ import division
+
+import argparse
+import onmt
+import onmt.Markdown
+from onmt.OnlineTranslator import TranslatorParameter
+from onmt.TranslationServer import TranslationServer, serve_http
+
+parser = argparse.ArgumentParser(description='server.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-config', default="/model/model.conf",
+                    help='Model configuration file (same format as for online.py)')
+parser.add_argument('-host', default='localhost',
+                    help='Host name to listen on')
+parser.add_argument('-port', type=int, default=8000,
+                    help='Port to listen on')
+parser.add_argument('-max_batch_size', type=int, default=32,
+                    help='Maximum number of sentences translated together')
+parser.add_argument('-max_latency', type=float, default=10,
+                    help='Maximum time (in milliseconds) a request waits for others to form a batch')
+
+
+def main():
+    opt = parser.parse_args()
+
+    translator = onmt.EnsembleTranslator(TranslatorParameter(opt.config))
+    server = TranslationServer(translator, max_batch_size=opt.max_batch_size,
+                               max_latency=opt.max_latency / 1000.)
+    print("NMT initialized")
+
+    serve_http(server, host=opt.host, port=opt.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+from onmt.ModelConstructor import build_model
+from onmt.SlimModel import save_slim_model
+from onmt.utils import load_checkpoint
+
+
+parser = argparse.ArgumentParser(description='strip_model.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.slim',
+                    help="""Prefix of the inference files (.bin, .json and the vocabularies).
+                    The prefix is given to translate.py as -model""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = load_checkpoint(opt.model)[0]
+
+    if checkpoint.get('quantize') is not None:
+        raise NotImplementedError("Quantized models can not be stripped, strip the original model")
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    # the model is built to get the parameters under their current names (and shared only once)
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+
+    print("Writing the inference files to %s.* ..." % opt.output)
+    save_slim_model(model, model_opt, dicts, opt.output)
+
+
+if __name__ == "__main__":
+    main()
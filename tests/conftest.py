@@ -0,0 +1,87 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import pytest
+import torch
+
+import onmt
+import options
+from onmt.ModelConstructor import build_model
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Batch(object):
+    """The part of onmt.Dataset.Batch used by the models at decoding"""
+
+    def __init__(self, **tensors):
+        self.tensors = tensors
+
+    def get(self, name):
+        return self.tensors.get(name)
+
+
+def make_dict(n_words):
+    words = [onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD, onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD]
+    dictionary = onmt.Dict(words)
+    for i in range(n_words - len(words)):
+        dictionary.add("w%d" % i)
+    return dictionary
+
+
+def model_options(**kwargs):
+    opt = options.make_parser(argparse.ArgumentParser()).parse_args(['-data', 'unused', '-data_format', 'raw'])
+    opt.model = 'transformer'
+    opt.layers = 2
+    opt.model_size = 16
+    opt.inner_size = 32
+    opt.n_heads = 2
+    opt.dropout = opt.attn_dropout = opt.emb_dropout = opt.word_dropout = 0.0
+    for key, value in kwargs.items():
+        setattr(opt, key, value)
+    return opt
+
+
+@pytest.fixture
+def transformer():
+    """A small Transformer in eval mode and its dictionaries"""
+    torch.manual_seed(0)
+    dicts = {'src': make_dict(20), 'tgt': make_dict(24)}
+    model = build_model(model_options(), dicts)
+    model.eval()
+    return model, dicts
+
+
+@pytest.fixture
+def checkpoint(transformer, tmpdir):
+    """The small Transformer saved as a training checkpoint, and its dictionaries"""
+    model, dicts = transformer
+    path = str(tmpdir.join('model.pt'))
+    torch.save({'model': model.state_dict(), 'dicts': dicts, 'opt': model_options(),
+                'epoch': 1, 'iteration': -1, 'optim': None}, path)
+    return path, dicts
+
+
+def translator_options(model_path, *args):
+    """The options of translate.py (on the CPU)"""
+    import translate
+    opt = translate.parser.parse_args(['-model', model_path, '-src', 'unused'] + list(args))
+    opt.cuda = False
+    return opt
+
+
+def write_lines(path, sentences):
+    with open(path, 'w') as f:
+        for tokens in sentences:
+            f.write(" ".join(tokens) + "\n")
+
+
+def run_translate(model, src, output, *args):
+    """Run translate.py and return the lines of the output"""
+    command = [sys.executable, os.path.join(ROOT, 'translate.py'), '-model', model, '-src', src, '-output', output,
+               '-beam_size', '2', '-max_sent_length', '10'] + list(args)
+    subprocess.check_call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+    with open(output) as f:
+        return f.read().splitlines()
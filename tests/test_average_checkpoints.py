@@ -0,0 +1,88 @@
+import argparse
+
+import pytest
+import torch
+
+from conftest import make_dict
+from onmt.utils import average_checkpoints, load_checkpoint
+
+
+def make_checkpoints(tmpdir, n=3):
+    torch.manual_seed(0)
+    paths, states = [], []
+    for i in range(n):
+        state = {'weight': torch.randn(4, 5),
+                 'bias': torch.randn(5).double(),
+                 'half': torch.rand(3).half() + 0.5,
+                 # not averaged: taken from the first checkpoint
+                 'steps': torch.LongTensor([i, 10 * i]),
+                 'mask': torch.rand(6).gt(0.5)}
+        # as written by the trainer: with the options and the dictionaries
+        checkpoint = {'model': state, 'optim': {'step': i}, 'epoch': i,
+                      'opt': argparse.Namespace(model='transformer'), 'dicts': {'tgt': make_dict(8)}}
+        path = str(tmpdir.join('model_e%d.pt' % i))
+        torch.save(checkpoint, path)
+        paths.append(path)
+        states.append(state)
+    return paths, states
+
+
+def reference(tensors, method, ema_decay):
+    """The average in float64, from the stacked tensors"""
+    values = torch.stack([t.double() for t in tensors], 0)
+    n = len(tensors)
+    if method == 'mean':
+        return values.mean(0)
+    if method == 'gmean':
+        return values.abs().log().mean(0).exp() * values.sign().prod(0)
+    weights = torch.DoubleTensor([ema_decay ** (n - 1 - i) for i in range(n)])
+    weights = weights / weights.sum()
+    return (values * weights.view(-1, *[1] * (values.dim() - 1))).sum(0)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_load_checkpoint_with_options(tmpdir, mmap):
+    paths, _ = make_checkpoints(tmpdir, n=1)
+    checkpoint, mapped = load_checkpoint(paths[0], mmap=mmap)
+
+    assert mapped == mmap
+    assert checkpoint['opt'].model == 'transformer'
+    assert checkpoint['dicts']['tgt'].size() == 8
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("method", ["mean", "gmean", "ema"])
+def test_average_checkpoints_matches_reference(tmpdir, method, mmap):
+    paths, states = make_checkpoints(tmpdir)
+    averaged, first = average_checkpoints(paths, method=method, ema_decay=0.7, mmap=mmap)
+
+    assert set(averaged.keys()) == set(states[0].keys())
+    for key in ['weight', 'bias', 'half']:
+        expected = reference([state[key] for state in states], method, 0.7)
+        assert averaged[key].dtype == states[0][key].dtype
+        tolerance = 1e-3 if key == 'half' else 1e-6
+        assert torch.allclose(averaged[key].double(), expected, rtol=tolerance, atol=tolerance)
+
+    for key in ['steps', 'mask']:
+        assert torch.equal(averaged[key], states[0][key])
+
+    # the rest of the first checkpoint, without its model and optimizer state
+    assert first['epoch'] == 0 and 'model' not in first and 'optim' not in first
+    assert first['opt'].model == 'transformer'
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_average_checkpoints_different_parameters(tmpdir, mmap):
+    paths, states = make_checkpoints(tmpdir)
+    checkpoint = torch.load(paths[2], weights_only=False)
+    checkpoint['model']['extra'] = torch.zeros(2)
+    torch.save(checkpoint, paths[2])
+
+    with pytest.raises(ValueError):
+        average_checkpoints(paths, mmap=mmap)
+
+
+def test_average_checkpoints_unknown_method(tmpdir):
+    paths, _ = make_checkpoints(tmpdir, n=2)
+    with pytest.raises(NotImplementedError):
+        average_checkpoints(paths, method='median')
@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+import onmt
+from onmt.data_utils.BatchLoader import BatchLoader
+
+
+def make_dataset():
+    torch.manual_seed(0)
+    src = [torch.randint(onmt.Constants.EOS + 1, 20, (int(n),)) for n in torch.randint(1, 12, (80,))]
+    tgt = [torch.randint(onmt.Constants.EOS + 1, 20, (int(n),)) for n in torch.randint(3, 12, (80,))]
+    return onmt.Dataset(src, tgt, 40, batch_size_sents=6)
+
+
+def tensors(batch):
+    return [batch.get(name) for name in ['source', 'target_input', 'target_output']]
+
+
+def assert_same_batches(batches, expected):
+    assert len(batches) == len(expected)
+    for batch, expected_batch in zip(batches, expected):
+        for tensor, expected_tensor in zip(tensors(batch), tensors(expected_batch)):
+            assert torch.equal(tensor, expected_tensor)
+
+
+def reference_batches(dataset, start=0):
+    """The batches returned by Dataset.next from the given index"""
+    dataset.set_index(start)
+    return [dataset.next()[0] for _ in range(start, len(dataset))]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_batch_loader_follows_the_batch_order(num_workers):
+    dataset = make_dataset()
+    order = dataset.create_order()
+    assert not torch.equal(order, torch.arange(len(dataset)))
+    expected = reference_batches(dataset)
+
+    dataset.set_index(0)
+    loader = BatchLoader(dataset, num_workers=num_workers)
+    assert len(loader) == len(dataset)
+
+    batches = []
+    for i, batch in enumerate(loader):
+        batches.append(batch)
+        # the iterator of the dataset is kept in sync (it is saved in the checkpoints)
+        assert dataset.cur_index == i + 1
+    assert_same_batches(batches, expected)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_batch_loader_resumes_from_the_index(num_workers):
+    dataset = make_dataset()
+    dataset.create_order()
+    start = 5
+    expected = reference_batches(dataset, start)
+
+    dataset.set_index(start)
+    loader = BatchLoader(dataset, num_workers=num_workers)
+    assert len(loader) == len(dataset) - start
+
+    batches = []
+    for i, batch in enumerate(loader):
+        batches.append(batch)
+        assert dataset.cur_index == start + i + 1
+    assert_same_batches(batches, expected)
+
+
+def test_batch_loader_curriculum_ignores_the_order():
+    dataset = make_dataset()
+    dataset.create_order()
+    expected = [dataset[i] for i in range(len(dataset))]
+
+    dataset.set_index(0)
+    batches = list(BatchLoader(dataset, num_workers=2, curriculum=True))
+    assert_same_batches(batches, expected)
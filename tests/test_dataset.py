@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import torch
+
+import onmt
+from onmt.Dataset import allocate_batch
+
+
+def allocate_batch_loop(lengths, batch_size_words, batch_size_sents, multiplier=1, pad_count=True):
+    """The sentence by sentence allocation that allocate_batch replaces"""
+    batches = []
+    cur_batch = []
+    cur_batch_size = 0
+    cur_batch_sizes = [0]
+
+    def oversize_(cur_batch):
+        if len(cur_batch) == batch_size_sents:
+            return True
+        if not pad_count:
+            if cur_batch_size + sentence_length > batch_size_words:
+                return True
+        else:
+            if (max(max(cur_batch_sizes), sentence_length)) * (len(cur_batch) + 1) > batch_size_words:
+                return True
+        return False
+
+    for i, sentence_length in enumerate(lengths.tolist()):
+        if oversize_(cur_batch):
+            current_size = len(cur_batch)
+            scaled_size = max(multiplier * (current_size // multiplier), current_size % multiplier)
+
+            batches.append(cur_batch[:scaled_size])
+
+            cur_batch = cur_batch[scaled_size:]
+            cur_batch_sizes = cur_batch_sizes[:-scaled_size]
+            cur_batch_size = sum(cur_batch_sizes)
+
+        cur_batch.append(i)
+        cur_batch_size += sentence_length
+        cur_batch_sizes.append(sentence_length)
+
+    if len(cur_batch) > 0:
+        batches.append(cur_batch)
+
+    # the loop produced an empty batch before a sentence longer than batch_size_words
+    return [batch for batch in batches if len(batch) > 0]
+
+
+@pytest.mark.parametrize("pad_count", [True, False])
+@pytest.mark.parametrize("multiplier", [1, 3, 8])
+@pytest.mark.parametrize("sort", [True, False])
+def test_allocate_batch_matches_the_loop(pad_count, multiplier, sort):
+    rng = np.random.RandomState(multiplier)
+    lengths = rng.randint(1, 60, size=3000)
+    # a few sentences longer than batch_size_words
+    lengths[rng.randint(0, 3000, size=5)] = 700
+    if sort:
+        lengths = np.sort(lengths)
+
+    for batch_size_words, batch_size_sents in [(600, 128), (2048, 16), (650, 1000)]:
+        batches = allocate_batch(lengths, batch_size_words, batch_size_sents,
+                                 multiplier=multiplier, pad_count=pad_count)
+        expected = allocate_batch_loop(lengths, batch_size_words, batch_size_sents,
+                                       multiplier=multiplier, pad_count=pad_count)
+
+        assert batches == expected
+
+
+def test_dataset_batches_cover_the_data():
+    rng = np.random.RandomState(0)
+    src = [torch.LongTensor(int(n)).fill_(5) for n in rng.randint(1, 30, size=200)]
+    tgt = [torch.LongTensor(int(n)).fill_(5) for n in rng.randint(3, 30, size=200)]
+
+    dataset = onmt.Dataset(src, tgt, 256, batch_size_sents=32)
+    lengths = np.maximum(np.array([t.size(0) for t in tgt]) - 1, np.array([s.size(0) for s in src]))
+
+    assert dataset.batches == allocate_batch_loop(lengths, 256, 32)
+    assert sorted(i for batch in dataset.batches for i in batch) == list(range(200))
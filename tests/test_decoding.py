@@ -0,0 +1,203 @@
+import argparse
+
+import pytest
+import torch
+
+import onmt
+from conftest import Batch
+from onmt.EnsembleTranslator import EnsembleTranslator
+
+
+def full_recompute(model, src, seqs):
+    """Log probabilities of the last position of seqs (N x T, batch first), running the whole decoder"""
+    context = model.encoder(src)['context']
+    hidden = model.decoder(seqs, context, src)['hidden']
+    return model.generator[0](hidden[-1])
+
+
+def test_incremental_decoding_matches_full_recompute(transformer):
+    model, dicts = transformer
+    torch.manual_seed(1)
+    batch_size, beam_size, len_src = 3, 2, 7
+
+    src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (batch_size, len_src))
+    src[2, -3:] = onmt.Constants.PAD
+    # the hypotheses are in beam-major order: hypothesis k * batch_size + b translates sentence b
+    hyp_src = src.repeat(beam_size, 1)
+
+    with torch.no_grad():
+        state = model.create_decoder_state(Batch(source=src.t()), beam_size=beam_size)
+        seqs = torch.LongTensor(beam_size * batch_size, 1).fill_(onmt.Constants.BOS)
+
+        # more steps than the initial capacity of the buffers (16): they are grown on the way
+        for t in range(20):
+            log_prob = model.step(seqs[:, -1:].t().contiguous(), state)['log_prob']
+            assert torch.allclose(log_prob, full_recompute(model, hyp_src, seqs), atol=1e-5)
+
+            words = torch.randint(onmt.Constants.EOS + 1, dicts['tgt'].size(), (seqs.size(0), 1))
+            seqs = torch.cat([seqs, words], 1)
+
+            if t == 5:
+                # the hypotheses of every sentence are swapped
+                remaining = seqs.size(0) // beam_size
+                reorder_idx = torch.arange(seqs.size(0)).view(beam_size, remaining).flip(0).contiguous().view(-1)
+                state.reorder_beam(reorder_idx)
+                seqs = seqs.index_select(0, reorder_idx)
+
+            if t == 10:
+                # sentence 1 is finished: it is removed from the states
+                keep = torch.LongTensor([0, 2])
+                reorder_idx = (torch.arange(beam_size).unsqueeze(1) * batch_size + keep.unsqueeze(0)).view(-1)
+                state.reorder_beam(reorder_idx, keep)
+                seqs = seqs.index_select(0, reorder_idx)
+                hyp_src = src.index_select(0, keep).repeat(beam_size, 1)
+
+
+class TranslationBatch(Batch):
+
+    def __init__(self, src):
+        super(TranslationBatch, self).__init__(source=src.t().contiguous(),
+                                               src_length=src.ne(onmt.Constants.PAD).sum(1))
+        self.size = src.size(0)
+        self.has_target = False
+
+
+def make_translator(model, beam_size, n_best=1, max_sent_length=8, max_len_a=0, max_len_b=0):
+    opt = argparse.Namespace(beam_size=beam_size, n_best=n_best, normalize=False,
+                             max_len_a=max_len_a, max_len_b=max_len_b,
+                             max_sent_length=max_sent_length, encoder_type='text', lm=None)
+    translator = EnsembleTranslator.__new__(EnsembleTranslator)
+    translator.opt, translator.tt, translator.alpha = opt, torch, 1.0
+    translator.models, translator.n_models, translator.executors = [model], 1, None
+    translator.shortlist_table, translator.beam_accum = None, None
+    return translator
+
+
+def sequence_score(model, src, hyp):
+    """Sum of the log probabilities of hyp (ending with EOS) given src (1 x len_src)"""
+    seqs = torch.LongTensor([[onmt.Constants.BOS] + hyp])
+    context = model.encoder(src)['context']
+    hidden = model.decoder(seqs[:, :-1], context, src)['hidden']
+    log_probs = model.generator[0](hidden.squeeze(1))
+    return log_probs.gather(1, seqs[0, 1:].unsqueeze(1)).sum().item()
+
+
+def random_sources(dicts, batch_size=3, len_src=6):
+    torch.manual_seed(2)
+    src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (batch_size, len_src))
+    src[1, -2:] = onmt.Constants.PAD
+    return src
+
+
+def test_greedy_search_matches_argmax_decoding(transformer):
+    model, dicts = transformer
+    src = random_sources(dicts)
+    max_sent_length = 8
+
+    hyps, scores = make_translator(model, beam_size=1, max_sent_length=max_sent_length) \
+        .translate_batch(TranslationBatch(src))[:2]
+
+    with torch.no_grad():
+        for b in range(src.size(0)):
+            sent_src = src[b:b + 1, :int(src[b].ne(onmt.Constants.PAD).sum())]
+            seqs = torch.LongTensor([[onmt.Constants.BOS]])
+            for t in range(max_sent_length):
+                log_probs = full_recompute(model, sent_src, seqs)
+                log_probs[:, onmt.Constants.PAD] = -float('inf')
+                if t == max_sent_length - 1:
+                    word = onmt.Constants.EOS
+                else:
+                    word = log_probs.argmax(-1).item()
+                seqs = torch.cat([seqs, torch.LongTensor([[word]])], 1)
+                if word == onmt.Constants.EOS:
+                    break
+
+            assert list(hyps[b][0]) == seqs[0, 1:].tolist()
+            assert scores[b][0].item() == pytest.approx(sequence_score(model, sent_src, list(hyps[b][0])), abs=1e-4)
+
+
+def test_beam_search_does_not_depend_on_the_batch(transformer):
+    model, dicts = transformer
+    src = random_sources(dicts)
+    translator = make_translator(model, beam_size=4, n_best=2)
+
+    hyps, scores = translator.translate_batch(TranslationBatch(src))[:2]
+
+    with torch.no_grad():
+        for b in range(src.size(0)):
+            sent_src = src[b:b + 1, :int(src[b].ne(onmt.Constants.PAD).sum())]
+            sent_hyps, sent_scores = translator.translate_batch(TranslationBatch(sent_src))[:2]
+
+            assert [list(h) for h in sent_hyps[0]] == [list(h) for h in hyps[b]]
+            assert torch.allclose(sent_scores[0], scores[b], atol=1e-4)
+            # the scores are the log probabilities of the hypotheses, best first
+            assert scores[b][0] >= scores[b][1]
+            for hyp, score in zip(hyps[b], scores[b].tolist()):
+                assert hyp[-1] == onmt.Constants.EOS
+                assert score == pytest.approx(sequence_score(model, sent_src, list(hyp)), abs=1e-4)
+
+
+@pytest.mark.parametrize("max_len_a,max_len_b", [(0.5, 2), (0, 3), (1.5, 0)])
+def test_output_length_limited_by_the_source_length(transformer, max_len_a, max_len_b):
+    model, dicts = transformer
+    torch.manual_seed(4)
+    src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (4, 8))
+    src[1, -5:] = onmt.Constants.PAD
+    src[2, -2:] = onmt.Constants.PAD
+    src[3, -7:] = onmt.Constants.PAD
+    # the untrained model does not produce EOS by itself: the hypotheses are cut at the maximum length
+    model.generator[0].linear.bias.data[onmt.Constants.EOS] = -100
+
+    translator = make_translator(model, beam_size=3, n_best=2, max_sent_length=20,
+                                 max_len_a=max_len_a, max_len_b=max_len_b)
+    hyps, scores, _, lengths = translator.translate_batch(TranslationBatch(src))[:4]
+
+    for b, src_length in enumerate(src.ne(onmt.Constants.PAD).sum(1).tolist()):
+        max_length = max(1, int(max_len_a * src_length + max_len_b))
+        for hyp, length in zip(hyps[b], lengths[b]):
+            # ended with the forced EOS
+            assert len(hyp) == length == max_length
+            assert hyp[-1] == onmt.Constants.EOS
+        assert torch.isfinite(scores[b]).all()
+
+
+class ExcludedWords(object):
+    """A model whose output probability of the given words is 0 (as outside of a shortlist)"""
+
+    def __init__(self, model, words):
+        self.model = model
+        self.words = torch.LongTensor(words)
+
+    def create_decoder_state(self, batch, beam_size=1):
+        return self.model.create_decoder_state(batch, beam_size)
+
+    def step(self, input_t, decoder_state):
+        output = self.model.step(input_t, decoder_state)
+        output['log_prob'] = output['log_prob'].index_fill(1, self.words, -float('inf'))
+        return output
+
+
+def test_every_word_excluded(transformer):
+    model, dicts = transformer
+    src = random_sources(dicts)
+    model = ExcludedWords(model, list(range(dicts['tgt'].size())))
+
+    hyps, scores = make_translator(model, beam_size=2, n_best=2).translate_batch(TranslationBatch(src))[:2]
+
+    # no hypothesis can be finished: empty translations
+    for b in range(src.size(0)):
+        assert [list(h) for h in hyps[b]] == [[onmt.Constants.EOS]] * 2
+        assert scores[b].eq(-float('inf')).all()
+
+
+def test_fewer_hypotheses_than_n_best(transformer):
+    model, dicts = transformer
+    src = random_sources(dicts)
+    # only EOS can be produced: a single hypothesis per sentence
+    model = ExcludedWords(model, [w for w in range(dicts['tgt'].size()) if w != onmt.Constants.EOS])
+
+    hyps, scores = make_translator(model, beam_size=3, n_best=2).translate_batch(TranslationBatch(src))[:2]
+
+    for b in range(src.size(0)):
+        assert [list(h) for h in hyps[b]] == [[onmt.Constants.EOS]] * 2
+        assert torch.isfinite(scores[b]).all()
@@ -0,0 +1,90 @@
+import pickle
+
+import pytest
+import torch
+
+import onmt
+from conftest import make_dict
+
+
+def make_cased_dict(lower):
+    dictionary = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
+                            onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD], lower=lower)
+    for word in ["a", "b", "C", "été", "漢字"]:
+        dictionary.add(word)
+    return dictionary
+
+
+SENTS = [["a", "b", "C"], ["c", "A", "unknown", "été"], [], ["漢字", "x", "y", "b"]]
+
+
+@pytest.mark.parametrize("lower", [False, True])
+@pytest.mark.parametrize("bos,eos", [(None, None), (None, onmt.Constants.EOS_WORD),
+                                     (onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD)])
+def test_convert_to_idx_batch_matches_convert_to_idx(lower, bos, eos):
+    dictionary = make_cased_dict(lower)
+    unk = onmt.Constants.UNK_WORD
+
+    data, offsets, n_unk = dictionary.convertToIdxBatch(SENTS, unk, bos, eos)
+
+    assert data.dtype.name == 'int32'
+    assert len(offsets) == len(SENTS) + 1
+    for i, sent in enumerate(SENTS):
+        expected = dictionary.convertToIdx(sent, unk, bos, eos)
+        assert data[offsets[i]:offsets[i + 1]].tolist() == expected.tolist()
+
+    unknown = [word for sent in SENTS for word in sent if dictionary.lookup(word) is None]
+    assert n_unk == len(unknown)
+    # "c" and "A" are only known when lower-casing
+    assert n_unk == (3 if lower else 5)
+
+
+def test_convert_to_idx_batch_after_adding_words():
+    dictionary = make_cased_dict(False)
+    data, _, n_unk = dictionary.convertToIdxBatch([["new"]], onmt.Constants.UNK_WORD)
+    assert n_unk == 1
+
+    # the lookup cache is cleared by add
+    index = dictionary.add("new")
+    data, _, n_unk = dictionary.convertToIdxBatch([["new"]], onmt.Constants.UNK_WORD)
+    assert n_unk == 0 and data.tolist() == [index]
+
+
+def test_convert_to_labels_batch_matches_convert_to_labels():
+    dictionary = make_dict(12)
+    eos = onmt.Constants.EOS
+    torch.manual_seed(0)
+    preds = torch.randint(0, dictionary.size(), (6, 8))
+    preds[1, 3] = eos
+    preds[2, 0] = eos
+    preds[4, 7] = eos
+
+    expected = [dictionary.convertToLabels(pred, eos) for pred in preds]
+
+    # 2-d tensor, rows of tensors (as the hypotheses of the beam search), lists of indices
+    assert dictionary.convertToLabelsBatch(preds, eos) == expected
+    assert dictionary.convertToLabelsBatch(list(preds), eos) == expected
+    assert dictionary.convertToLabelsBatch(preds.tolist(), eos) == expected
+    assert dictionary.convertToLabelsBatch([[4, 5], []], eos) == [dictionary.convertToLabels([4, 5], eos), []]
+
+    # without stop
+    assert dictionary.convertToLabelsBatch(preds) == [dictionary.convertToLabels(pred, None) for pred in preds]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+def test_convert_to_labels_batch_cuda_rows():
+    dictionary = make_dict(12)
+    preds = torch.randint(0, dictionary.size(), (3, 5))
+    expected = dictionary.convertToLabelsBatch(preds, onmt.Constants.EOS)
+    assert dictionary.convertToLabelsBatch(list(preds.cuda()), onmt.Constants.EOS) == expected
+
+
+def test_pickled_dict_rebuilds_its_caches():
+    dictionary = make_cased_dict(True)
+    dictionary.convertToIdxBatch(SENTS, onmt.Constants.UNK_WORD)
+    dictionary.convertToLabelsBatch([[4, 5]])
+
+    loaded = pickle.loads(pickle.dumps(dictionary))
+    assert '_lookup_cache' not in loaded.__dict__ and '_label_table' not in loaded.__dict__
+    assert loaded.convertToIdxBatch(SENTS, onmt.Constants.UNK_WORD)[0].tolist() == \
+        dictionary.convertToIdxBatch(SENTS, onmt.Constants.UNK_WORD)[0].tolist()
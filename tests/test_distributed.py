@@ -0,0 +1,166 @@
+import argparse
+import copy
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+import onmt
+import options
+from conftest import Batch, make_dict, model_options
+from onmt.ModelConstructor import build_model
+from onmt.modules.Loss import NMTLossFunc
+from onmt.multiprocessing.distributed import GradientReducer, init_distributed, world_size
+from onmt.train_utils.distributed_trainer import DistributedXETrainer
+
+WORLD_SIZE = 2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    dicts = {'src': make_dict(20), 'tgt': make_dict(24)}
+    model = build_model(model_options(), dicts)
+    # the output embedding is shared: it receives its gradient twice per backward pass
+    model.tie_weights()
+    # and a parameter which never receives a gradient
+    model.unused = nn.Parameter(torch.zeros(3))
+    model.train()
+    return model, dicts
+
+
+def make_batches(dicts, n_batches):
+    torch.manual_seed(5)
+    batches = []
+    for _ in range(n_batches):
+        src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (7, 3))
+        tgt = torch.randint(onmt.Constants.EOS + 1, dicts['tgt'].size(), (6, 3))
+        tgt[-2:, 1] = onmt.Constants.PAD
+        batches.append((src, tgt))
+    return batches
+
+
+def backward(model, loss_function, batch):
+    src, tgt = batch
+    outputs = model(Batch(source=src, target_input=tgt[:-1]))
+    outputs['tgt_mask'] = tgt[1:].ne(onmt.Constants.PAD)
+    loss_function(outputs, tgt[1:], model=model, backward=True)
+
+
+def reduce_gradients(rank, init_file, overlap, shard_size):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=WORLD_SIZE)
+
+    model, dicts = make_model()
+    reference = copy.deepcopy(model)
+    loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=0.1, shard_size=shard_size)
+
+    # small buckets: the early buckets are reduced during the backward pass
+    late_params = model.generator.parameters() if shard_size > 0 else None
+    reducer = GradientReducer(model, bucket_size=4096, late_params=late_params, overlap=overlap)
+    assert len(reducer.buckets) > reducer.num_early_buckets > 1 or not overlap
+
+    # 2 updates, each one accumulating 2 batches per worker
+    batches = make_batches(dicts, 2 * 2 * WORLD_SIZE)
+    for update in range(2):
+        update_batches = batches[update * 2 * WORLD_SIZE:(update + 1) * 2 * WORLD_SIZE]
+        model.zero_grad()
+        reference.zero_grad()
+
+        own_batches = update_batches[rank::WORLD_SIZE]
+        for j, batch in enumerate(own_batches):
+            reducer.require_sync = j == len(own_batches) - 1
+            backward(model, loss_function, batch)
+        reducer.synchronize()
+
+        # the single process run over all the batches of the update
+        for batch in update_batches:
+            backward(reference, loss_function, batch)
+
+        for (name, p), ref_p in zip(model.named_parameters(), reference.parameters()):
+            if ref_p.grad is None:
+                assert p.grad is None or p.grad.abs().sum().item() == 0, name
+            else:
+                assert torch.allclose(p.grad, ref_p.grad, atol=1e-5), name
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("overlap,shard_size", [(True, 0), (True, 4), (False, 0)])
+def test_gradient_reducer_matches_a_single_process(tmpdir, overlap, shard_size):
+    init_file = str(tmpdir.join('init'))
+    mp.spawn(reduce_gradients, args=(init_file, overlap, shard_size), nprocs=WORLD_SIZE)
+
+
+def train(rank, dist_url, save_dir):
+    # as two nodes of one process each
+    args = ['-data', 'unused', '-data_format', 'raw', '-nnodes', str(WORLD_SIZE), '-node_rank', str(rank),
+            '-nprocs', '1', '-dist_url', dist_url, '-save_model', os.path.join(save_dir, 'rank%d' % rank, 'model'),
+            '-epochs', '2', '-batch_size_update', '30', '-optim', 'adam', '-learning_rate', '0.01',
+            '-bucket_size', '1']
+    opt = options.make_parser(argparse.ArgumentParser()).parse_args(args)
+
+    if dist_url == 'env://':
+        os.environ.update(RANK=str(rank), WORLD_SIZE=str(WORLD_SIZE), LOCAL_WORLD_SIZE='1')
+
+    assert world_size(opt) == WORLD_SIZE
+    init_distributed(opt, 0)
+    assert dist.get_rank() == rank
+
+    # the workers start from different parameters and numbers of updates (as if only one had loaded a checkpoint)
+    model, dicts = make_model(seed=rank)
+    del model.unused
+    torch.manual_seed(5)
+    src = [torch.randint(onmt.Constants.EOS + 1, 20, (int(n),)) for n in torch.randint(2, 9, (60,))]
+    tgt = [torch.randint(onmt.Constants.EOS + 1, 24, (int(n),)) for n in torch.randint(3, 10, (60,))]
+    train_data = onmt.Dataset(src, tgt, 40, batch_size_sents=4)
+    valid_data = onmt.Dataset(src[:12], tgt[:12], 40, batch_size_sents=4)
+    loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=0.1)
+
+    trainer = DistributedXETrainer(model, loss_function, train_data, valid_data, dicts, opt)
+    trainer.optim._step = 5 if rank == 0 else 0
+    trainer.run()
+
+    # the shards of the last epoch are disjoint and of the same size
+    orders = [None] * WORLD_SIZE
+    dist.all_gather_object(orders, train_data.batchOrder.tolist())
+    assert len(orders[0]) == len(orders[1]) == train_data.num_batches // WORLD_SIZE
+    assert not set(orders[0]) & set(orders[1])
+
+    # the same number of updates (from the first worker) and the same parameters on all of the workers
+    steps = [None] * WORLD_SIZE
+    dist.all_gather_object(steps, trainer.optim._step)
+    assert steps[0] == steps[1] > 5
+
+    params = torch.cat([p.data.view(-1) for p in model.parameters()])
+    all_params = [torch.zeros_like(params) for _ in range(WORLD_SIZE)]
+    dist.all_gather(all_params, params)
+    assert torch.equal(all_params[0], all_params[1])
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("dist_url", ["tcp", "env://"])
+def test_distributed_training(tmpdir, monkeypatch, dist_url):
+    port = free_port()
+    if dist_url == 'env://':
+        monkeypatch.setenv('MASTER_ADDR', '127.0.0.1')
+        monkeypatch.setenv('MASTER_PORT', str(port))
+    else:
+        dist_url = 'tcp://127.0.0.1:%d' % port
+    for rank in range(WORLD_SIZE):
+        tmpdir.mkdir('rank%d' % rank)
+
+    mp.spawn(train, args=(dist_url, str(tmpdir)), nprocs=WORLD_SIZE)
+
+    # only the first worker writes the checkpoints
+    assert len(tmpdir.join('rank0').listdir()) == 2
+    assert tmpdir.join('rank1').listdir() == []
@@ -0,0 +1,130 @@
+import pytest
+import torch
+import torch.nn as nn
+
+import onmt
+from conftest import translator_options
+from onmt.train_utils.ema import ExponentialMovingAverage
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4, 3), nn.Linear(3, 2))
+    # not averaged
+    model[0].bias.requires_grad = False
+    return model
+
+
+def flat(params):
+    return torch.cat([p.data.view(-1) for p in params])
+
+
+def averaged_params(model):
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+@pytest.mark.parametrize("interval", [1, 3])
+def test_update(interval):
+    model = make_model()
+    params = averaged_params(model)
+    ema = ExponentialMovingAverage(model, decay=0.9, interval=interval)
+
+    expected = flat(params).double()
+    for step in range(1, 8):
+        for p in model.parameters():
+            p.data.add_(torch.randn(p.size()))
+        ema.update()
+        if step % interval == 0:
+            expected = 0.9 * expected + 0.1 * flat(params).double()
+
+    assert ema.num_steps == 7
+    assert torch.allclose(ema.shadow.double(), expected, atol=1e-6)
+
+
+def test_update_from_flat_parameters():
+    model = make_model()
+    ema = ExponentialMovingAverage(model, decay=0.5)
+    shadow = ema.shadow.clone()
+
+    # e.g. the fp32 master copy of fp16 training
+    flat_params = torch.randn(shadow.size())
+    ema.update(flat_params=flat_params)
+    assert torch.allclose(ema.shadow, 0.5 * shadow + 0.5 * flat_params)
+
+
+def test_average_parameters_swaps_and_restores():
+    model = make_model()
+    ema = ExponentialMovingAverage(model, decay=0.5)
+    for p in model.parameters():
+        p.data.add_(1)
+    ema.update()
+    params = flat(model.parameters()).clone()
+
+    with ema.average_parameters():
+        assert torch.equal(flat(averaged_params(model)), ema.shadow)
+        # the parameters which are not averaged are left alone
+        assert torch.equal(model[0].bias.data, params[12:15])
+    assert torch.equal(flat(model.parameters()), params)
+
+    # restored after an exception as well
+    with pytest.raises(RuntimeError):
+        with ema.average_parameters():
+            raise RuntimeError
+    assert torch.equal(flat(model.parameters()), params)
+
+    ema.copy_to_model()
+    assert torch.equal(flat(averaged_params(model)), ema.shadow)
+
+
+def test_state_dict_round_trip(tmpdir, capsys):
+    model = make_model()
+    ema = ExponentialMovingAverage(model, decay=0.9, interval=2)
+    for _ in range(4):
+        for p in model.parameters():
+            p.data.add_(torch.randn(p.size()))
+        ema.update()
+
+    path = str(tmpdir.join('ema.pt'))
+    torch.save(ema.state_dict(), path)
+    state = torch.load(path)
+
+    loaded = ExponentialMovingAverage(make_model(), decay=0.9, interval=2)
+    loaded.load_state_dict(state)
+    assert torch.equal(loaded.shadow, ema.shadow)
+    assert loaded.num_steps == 4
+    assert 'WARNING' not in capsys.readouterr().out
+
+    # the options of the new run are kept, with a warning
+    loaded = ExponentialMovingAverage(make_model(), decay=0.99, interval=1)
+    loaded.load_state_dict(state)
+    assert (loaded.decay, loaded.interval) == (0.99, 1)
+    assert 'WARNING' in capsys.readouterr().out
+
+    with pytest.raises(ValueError):
+        ExponentialMovingAverage(nn.Linear(2, 2)).load_state_dict(state)
+
+
+def test_translate_with_the_moving_average(transformer, checkpoint):
+    model, dicts = transformer
+    path, _ = checkpoint
+    ema = ExponentialMovingAverage(model, decay=0.5)
+    for p in model.parameters():
+        p.data.add_(torch.randn(p.size()))
+    ema.update()
+    checkpoint = torch.load(path, weights_only=False)
+    checkpoint['ema'] = ema.state_dict()
+    torch.save(checkpoint, path)
+
+    translator = onmt.EnsembleTranslator(translator_options(path, '-ema'))
+    assert torch.equal(flat(translator.models[0].parameters()), ema.shadow)
+
+    translator = onmt.EnsembleTranslator(translator_options(path))
+    # (the buffers are renewed for the maximum length)
+    assert all(torch.equal(p.data, checkpoint['model'][name])
+               for name, p in translator.models[0].named_parameters())
+
+
+def test_translate_without_a_moving_average(checkpoint):
+    path, _ = checkpoint
+    with pytest.raises(ValueError):
+        onmt.EnsembleTranslator(translator_options(path, '-ema'))
@@ -0,0 +1,118 @@
+import math
+import os
+
+import pytest
+import torch
+
+import onmt
+
+from onmt.EnsembleTranslator import EnsembleTranslator
+
+
+def make_translator(ensemble_op):
+    # only the state used by _combine_outputs
+    translator = EnsembleTranslator.__new__(EnsembleTranslator)
+    translator.ensemble_op = ensemble_op
+    translator._stack_buffer = None
+    translator._output_buffer = None
+    translator._index_buffer = None
+    return translator
+
+
+def reference(outputs, ensemble_op):
+    """The combination in float64, in the probability domain"""
+    probs = torch.stack([output.double().exp() for output in outputs], dim=0)
+
+    if ensemble_op == "mean":
+        return probs.mean(0).log()
+    elif ensemble_op in ["gmean", "logSum"]:
+        gmean = probs.log().mean(0).exp()
+        return gmean.div(gmean.sum(-1, keepdim=True)).log()
+    elif ensemble_op == "max":
+        return probs.max(0)[0].log()
+    elif ensemble_op == "min":
+        return probs.min(0)[0].log()
+
+
+@pytest.mark.parametrize("ensemble_op", ["mean", "gmean", "logSum", "max", "min"])
+def test_combine_outputs_matches_reference(ensemble_op):
+    torch.manual_seed(0)
+    translator = make_translator(ensemble_op)
+
+    # the buffers are reused between the steps, with a shrinking batch
+    for rows in [12, 12, 7]:
+        outputs = [torch.log_softmax(torch.randn(rows, 50) * 4, dim=-1) for _ in range(3)]
+        output = translator._combine_outputs(outputs)
+
+        assert output.dtype == torch.float32
+        assert output.size() == outputs[0].size()
+        assert torch.allclose(output.double(), reference(outputs, ensemble_op), atol=1e-5)
+
+
+@pytest.mark.parametrize("ensemble_op", ["mean", "max"])
+def test_combine_outputs_very_unlikely_words(ensemble_op):
+    torch.manual_seed(0)
+    translator = make_translator(ensemble_op)
+
+    # the probabilities of these words underflow in float32 (below about exp(-104))
+    outputs = [-100 - 50 * torch.rand(6, 40) for _ in range(3)]
+    # a word excluded by one of the models only
+    outputs[0][:, 0] = -float('inf')
+    output = translator._combine_outputs(outputs)
+
+    assert torch.isfinite(output).all()
+    assert torch.allclose(output.double(), reference(outputs, ensemble_op), rtol=0, atol=1e-4)
+
+
+def test_combine_outputs_is_normalized():
+    torch.manual_seed(0)
+    outputs = [torch.log_softmax(torch.randn(4, 30), dim=-1) for _ in range(2)]
+
+    for ensemble_op in ["mean", "gmean"]:
+        output = make_translator(ensemble_op)._combine_outputs(outputs)
+        assert torch.allclose(output.exp().sum(-1), torch.ones(4), atol=1e-5)
+
+
+def test_combine_outputs_single_model():
+    output = torch.log_softmax(torch.randn(3, 10), dim=-1)
+    assert make_translator("mean")._combine_outputs([output]) is output
+
+
+def test_combine_outputs_unknown_operator():
+    outputs = [torch.zeros(2, 5).fill_(-math.log(5)) for _ in range(2)]
+    with pytest.raises(ValueError):
+        make_translator("median")._combine_outputs(outputs)
+
+
+def test_executors_split_the_threads():
+    translator = make_translator("mean")
+    translator.n_models = 2
+    n_threads = torch.get_num_threads()
+
+    executors = translator._create_executors()
+    try:
+        counts = [executor.submit(torch.get_num_threads).result() for executor in executors]
+    finally:
+        for executor in executors:
+            executor.shutdown()
+        torch.set_num_threads(n_threads)
+
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else n_threads
+    assert counts == [max(1, n_cores // 2)] * 2
+
+
+def test_build_target_tokens():
+    tgt_dict = onmt.Dict([onmt.Constants.PAD_WORD, onmt.Constants.UNK_WORD,
+                          onmt.Constants.BOS_WORD, onmt.Constants.EOS_WORD])
+    for word in ["a", "b", "c"]:
+        tgt_dict.add(word)
+    translator = make_translator("mean")
+    translator.tgt_dict = tgt_dict
+    eos = onmt.Constants.EOS
+
+    # ended with EOS, cut at the maximum length (no EOS) and empty
+    preds = [[4, 5, eos, 6], [4, 6], []]
+    expected = [["a", "b"], ["a", "c"], []]
+
+    assert translator.build_target_tokens(preds) == expected
+    assert [tgt_dict.convertToLabels(pred, eos) for pred in preds[:2]] == [["a", "b", "</s>"], ["a", "c"]]
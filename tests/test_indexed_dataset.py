@@ -0,0 +1,98 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from onmt.data_utils.IndexedDataset import IndexedDatasetBuilder, IndexedInMemoryDataset, MMapIndexedDataset, \
+    merge_indexed_datasets
+
+
+def build(prefix, items, dtype=np.int32):
+    builder = IndexedDatasetBuilder(prefix + '.bin', dtype=dtype)
+    for item in items:
+        builder.add_item(item)
+    builder.finalize(prefix + '.idx')
+    return prefix
+
+
+def make_items(n, seed=0):
+    torch.manual_seed(seed)
+    # including an empty item
+    return [torch.randint(0, 1000, (int(length),)) for length in torch.randint(0, 12, (n,))]
+
+
+def test_mmap_dataset_matches_in_memory_dataset(tmpdir):
+    items = make_items(50)
+    prefix = build(str(tmpdir.join('data')), items)
+
+    mapped = MMapIndexedDataset(prefix)
+    in_memory = IndexedInMemoryDataset(prefix)
+
+    assert len(mapped) == len(in_memory) == len(items)
+    assert np.array_equal(mapped.sizes, in_memory.sizes)
+    assert mapped.sizes.tolist() == [item.size(0) for item in items]
+    for i, item in enumerate(items):
+        assert torch.equal(mapped[i].long(), in_memory[i])
+        assert torch.equal(mapped[i].long(), item)
+
+    with pytest.raises(IndexError):
+        mapped[len(items)]
+
+
+def test_mmap_dataset_two_dimensional_items(tmpdir):
+    torch.manual_seed(0)
+    items = [torch.randn(n, 3) for n in [2, 5, 1]]
+    prefix = build(str(tmpdir.join('data')), items, dtype=np.float32)
+
+    mapped = MMapIndexedDataset(prefix)
+    for i, item in enumerate(items):
+        assert torch.equal(mapped[i], item)
+
+
+def test_empty_mmap_dataset(tmpdir):
+    prefix = build(str(tmpdir.join('empty')), [])
+    assert len(MMapIndexedDataset(prefix)) == 0
+
+    prefix = build(str(tmpdir.join('empty_items')), [torch.LongTensor(0)] * 3)
+    mapped = MMapIndexedDataset(prefix)
+    assert len(mapped) == 3
+    assert mapped[2].numel() == 0
+
+
+def test_pickled_mmap_dataset_maps_the_files_again(tmpdir):
+    items = make_items(20)
+    prefix = build(str(tmpdir.join('data')), items)
+    mapped = MMapIndexedDataset(prefix)
+
+    # (e.g. sent to the worker processes of a DataLoader) only the path is pickled
+    pickled = pickle.dumps(mapped)
+    assert len(pickled) < 200
+
+    unpickled = pickle.loads(pickled)
+    assert isinstance(unpickled.buffer, np.memmap)
+    assert len(unpickled) == len(items)
+    for i, item in enumerate(items):
+        assert torch.equal(unpickled[i].long(), item)
+
+
+def test_merge_indexed_datasets(tmpdir):
+    shards = [make_items(n, seed=n) for n in [7, 0, 12, 3]]
+    prefixes = [build(str(tmpdir.join('shard%d' % k)), items) for k, items in enumerate(shards)]
+
+    # concatenated
+    merge_indexed_datasets(prefixes, str(tmpdir.join('merged')))
+    merged = MMapIndexedDataset(str(tmpdir.join('merged')))
+    expected = [item for items in shards for item in items]
+    assert len(merged) == len(expected)
+    for i, item in enumerate(expected):
+        assert torch.equal(merged[i].long(), item)
+
+    # in a given order (interleaving the shards)
+    order = [(k, i) for i in range(12) for k in range(len(shards)) if i < len(shards[k])]
+    merge_indexed_datasets(prefixes, str(tmpdir.join('ordered')), order=iter(order))
+    merged = MMapIndexedDataset(str(tmpdir.join('ordered')))
+    assert len(merged) == len(order)
+    assert merged.sizes.tolist() == [shards[k][i].size(0) for k, i in order]
+    for j, (k, i) in enumerate(order):
+        assert torch.equal(merged[j].long(), shards[k][i])
@@ -0,0 +1,106 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import onmt
+from onmt.modules.Loss import NMTLossFunc, LabelSmoothedCrossEntropy
+
+
+class DoubleGenerator(nn.Module):
+    """Generator in float64 (onmt.modules.BaseModel.Generator casts its output to float)"""
+
+    def __init__(self, hidden_size, output_size):
+        super(DoubleGenerator, self).__init__()
+        self.linear = nn.Linear(hidden_size, output_size).double()
+
+    def forward(self, input, log_softmax=True):
+        logits = self.linear(input)
+        return F.log_softmax(logits, dim=-1) if log_softmax else logits
+
+
+class Model(nn.Module):
+
+    def __init__(self, hidden_size, output_size):
+        super(Model, self).__init__()
+        self.proj = nn.Linear(hidden_size, hidden_size).double()
+        self.generator = nn.ModuleList([DoubleGenerator(hidden_size, output_size)])
+
+
+def padded_targets(n_rows, vocab_size):
+    targets = torch.randint(onmt.Constants.EOS, vocab_size, (n_rows,))
+    targets[::3] = onmt.Constants.PAD
+    return targets
+
+
+@pytest.mark.parametrize("label_smoothing", [0.0, 0.1])
+def test_fused_loss_matches_log_softmax(label_smoothing):
+    torch.manual_seed(0)
+    vocab_size = 17
+    loss_function = NMTLossFunc(vocab_size, label_smoothing=label_smoothing)
+    targets = padded_targets(12, vocab_size)
+
+    logits = torch.randn(12, vocab_size, dtype=torch.float64, requires_grad=True)
+    loss, loss_data = loss_function._compute_loss_from_logits(logits, targets)
+    loss.backward()
+
+    ref_logits = logits.detach().clone().requires_grad_()
+    ref_loss, ref_loss_data = loss_function._compute_loss(F.log_softmax(ref_logits, dim=-1), targets)
+    ref_loss.backward()
+
+    assert torch.allclose(loss, ref_loss)
+    assert loss_data == pytest.approx(ref_loss_data)
+    assert torch.allclose(logits.grad, ref_logits.grad)
+    # the padded rows get no gradient
+    assert logits.grad[targets.eq(onmt.Constants.PAD)].abs().sum().item() == 0
+
+
+def test_fused_loss_gradcheck():
+    torch.manual_seed(0)
+    targets = padded_targets(6, 9)
+    logits = torch.randn(6, 9, dtype=torch.float64, requires_grad=True)
+
+    def loss(logits):
+        return LabelSmoothedCrossEntropy.apply(logits, targets, 0.9, 0.1 / 7, onmt.Constants.PAD)[0]
+
+    assert torch.autograd.gradcheck(loss, (logits,))
+
+
+@pytest.mark.parametrize("label_smoothing", [0.0, 0.1])
+def test_sharded_loss_matches_unsharded(label_smoothing):
+    torch.manual_seed(0)
+    hidden_size, vocab_size, n_rows, normalizer = 8, 23, 20, 7.0
+    model = Model(hidden_size, vocab_size)
+    inputs = torch.randn(n_rows, hidden_size, dtype=torch.float64)
+    targets = padded_targets(n_rows, vocab_size)
+
+    def run(shard_size):
+        model.zero_grad()
+        loss_function = NMTLossFunc(vocab_size, label_smoothing=label_smoothing, shard_size=shard_size)
+        outputs = {'hidden': model.proj(inputs), 'tgt_mask': None}
+        output_dict = loss_function(outputs, targets, model=model, backward=True, normalizer=normalizer)
+        grads = [p.grad.clone() for p in model.parameters()]
+        return output_dict['loss'].item(), output_dict['data'], grads
+
+    loss, loss_data, grads = run(shard_size=0)
+
+    # reference: the unfused log softmax on the unsharded outputs
+    model.zero_grad()
+    loss_function = NMTLossFunc(vocab_size, label_smoothing=label_smoothing)
+    ref_loss, ref_loss_data = loss_function._compute_loss(model.generator[0](model.proj(inputs)), targets)
+    ref_loss.div(normalizer).backward()
+    ref_grads = [p.grad.clone() for p in model.parameters()]
+
+    assert loss == pytest.approx(ref_loss.item())
+    assert loss_data == pytest.approx(ref_loss_data)
+    for grad, ref_grad in zip(grads, ref_grads):
+        assert torch.allclose(grad, ref_grad)
+
+    # the shards are backpropagated into the hidden states with hiddens.backward(hiddens_.grad)
+    shard_loss, shard_loss_data, shard_grads = run(shard_size=6)
+
+    assert shard_loss == pytest.approx(ref_loss.item())
+    assert shard_loss_data == pytest.approx(ref_loss_data)
+    for grad, ref_grad in zip(shard_grads, ref_grads):
+        assert torch.allclose(grad, ref_grad)
+    assert model.proj.weight.grad.abs().sum().item() > 0
@@ -0,0 +1,74 @@
+import argparse
+import copy
+
+import pytest
+import torch
+
+import onmt
+from conftest import Batch
+from onmt.modules.Loss import NMTLossFunc
+
+
+def make_optim(model, method, flat):
+    opt = argparse.Namespace(learning_rate=2, model_size=16, max_grad_norm=0.5, update_method='noam',
+                             optim=method, warmup_steps=4, beta1=0.9, beta2=0.98, weight_decay=0.01,
+                             amsgrad=False, flat_parameters=flat)
+    optim = onmt.Optim(opt)
+    optim.set_parameters(model.parameters())
+    return optim
+
+
+def train_steps(model, optim, dicts, n_steps=6):
+    """Run a few updates on random batches, return the gradient norms"""
+    torch.manual_seed(4)
+    loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=0.1)
+    model.train()
+    grad_norms = []
+
+    for step in range(n_steps):
+        src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (7, 3))
+        tgt = torch.randint(onmt.Constants.EOS + 1, dicts['tgt'].size(), (6, 3))
+        tgt[-2:, 0] = onmt.Constants.PAD
+
+        optim.zero_grad()
+        outputs = model(Batch(source=src, target_input=tgt[:-1]))
+        outputs['tgt_mask'] = tgt[1:].ne(onmt.Constants.PAD)
+        loss_function(outputs, tgt[1:], model=model, backward=True)
+        grad_norms.append(optim.step(grad_denom=3))
+
+    return grad_norms
+
+
+@pytest.mark.parametrize("method", ["adam", "sgd"])
+def test_flat_parameters_match_the_parameters(transformer, method):
+    model, dicts = transformer
+    # the output embedding is tied with the input one: the shared parameter appears once in the buffers
+    model.tie_weights()
+    flat_model = copy.deepcopy(model)
+
+    optim = make_optim(model, method, flat=False)
+    flat_optim = make_optim(flat_model, method, flat=True)
+
+    assert flat_optim.params == [flat_optim.flat_params]
+    assert flat_optim.flat_params.numel() == sum(p.numel() for p in model.parameters())
+    assert flat_model.generator[0].linear.weight is flat_model.decoder.word_lut.weight
+
+    grad_norms = train_steps(model, optim, dicts)
+    flat_grad_norms = train_steps(flat_model, flat_optim, dicts)
+
+    # the gradients are clipped at every step
+    assert min(grad_norms) > 0.5
+    assert flat_grad_norms == pytest.approx(grad_norms, rel=1e-5)
+    for p, flat_p in zip(model.parameters(), flat_model.parameters()):
+        # adam divides by sqrt(v): the rounding differences of the tiny gradients are amplified
+        assert torch.allclose(p, flat_p, atol=1e-5)
+        # the parameters of the flat model are views of the flat buffers
+        assert flat_p.data.storage().data_ptr() == flat_optim.flat_params.data.storage().data_ptr()
+
+    # the optimizer state of the flat buffers is saved and restored
+    state_dict = flat_optim.state_dict()
+    assert state_dict['flat']
+    restored = make_optim(copy.deepcopy(flat_model), method, flat=True)
+    restored.load_state_dict(copy.deepcopy(state_dict))
+    assert restored._step == flat_optim._step
+    assert restored.optimizer.state_dict()['state'].keys() == flat_optim.optimizer.state_dict()['state'].keys()
@@ -0,0 +1,152 @@
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+import torch
+
+from onmt.data_utils.IndexedDataset import MMapIndexedDataset
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_corpus(path, lines):
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def make_corpus(tmpdir, n_lines=20, seed=0):
+    random.seed(seed)
+    words = ['w%d' % i for i in range(30)] + [u'été', u'漢字']
+    src, tgt = [], []
+    for _ in range(n_lines):
+        # few different lengths: many ties in the sort
+        src.append(' '.join(random.choice(words) for _ in range(random.randint(1, 4))))
+        tgt.append(' '.join(random.choice(words) for _ in range(random.randint(1, 4))))
+    # an empty line and a sentence over the length limit, alone in the last shard of 10 lines
+    src[3], tgt[3] = '', 'w1 w2'
+    src.append(' '.join(['w1'] * 200))
+    tgt.append('w2 w3')
+
+    for name, lines in [('train.src', src), ('train.tgt', tgt), ('valid.src', src[:5]), ('valid.tgt', tgt[:5])]:
+        write_corpus(str(tmpdir.join(name)), lines)
+
+
+def preprocess(tmpdir, save_data, *args):
+    command = [sys.executable, os.path.join(ROOT, 'preprocess.py'), '-format', 'bin', '-save_data', save_data,
+               '-train_src', str(tmpdir.join('train.src')), '-train_tgt', str(tmpdir.join('train.tgt')),
+               '-valid_src', str(tmpdir.join('valid.src')), '-valid_tgt', str(tmpdir.join('valid.tgt')),
+               '-src_seq_length', '20', '-tgt_seq_length', '22'] + list(args)
+    subprocess.check_call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+def read_data(prefix):
+    return [[item.tolist() for item in MMapIndexedDataset(prefix + '.' + set)] for set in ['src', 'tgt']]
+
+
+@pytest.mark.parametrize("num_threads", [1, 2])
+def test_stream_data_matches_in_memory_data(tmpdir, num_threads):
+    make_corpus(tmpdir)
+    preprocess(tmpdir, str(tmpdir.join('memory')), '-shuffle', '0')
+    preprocess(tmpdir, str(tmpdir.join('stream')), '-shuffle', '0', '-stream',
+               '-shard_size', '10', '-num_threads', str(num_threads))
+
+    memory_dicts = torch.load(str(tmpdir.join('memory.dict.pt')), weights_only=False)
+    stream_dicts = torch.load(str(tmpdir.join('stream.dict.pt')), weights_only=False)
+    for set in ['src', 'tgt']:
+        assert memory_dicts[set].idxToLabel == stream_dicts[set].idxToLabel
+
+    for split in ['train', 'valid']:
+        assert read_data(str(tmpdir.join('stream.' + split))) == read_data(str(tmpdir.join('memory.' + split)))
+
+    # 21 lines, one empty and one too long
+    assert len(read_data(str(tmpdir.join('stream.train')))[0]) == 19
+    # the shard files are removed
+    assert not [name for name in os.listdir(str(tmpdir)) if '.shard' in name]
+
+
+def test_stream_data_shuffled_across_the_shards(tmpdir):
+    make_corpus(tmpdir, n_lines=40)
+    preprocess(tmpdir, str(tmpdir.join('memory')), '-shuffle', '0')
+    preprocess(tmpdir, str(tmpdir.join('stream')), '-stream', '-shard_size', '10')
+
+    memory_src, memory_tgt = read_data(str(tmpdir.join('memory.train')))
+    stream_src, stream_tgt = read_data(str(tmpdir.join('stream.train')))
+
+    # the same sentence pairs, sorted by target then source length
+    assert sorted(zip(stream_src, stream_tgt)) == sorted(zip(memory_src, memory_tgt))
+    lengths = [(len(tgt), len(src)) for src, tgt in zip(stream_src, stream_tgt)]
+    assert lengths == sorted(lengths)
+
+
+def test_stream_data_without_any_sentence(tmpdir):
+    # every line is over the length limit
+    write_corpus(str(tmpdir.join('train.src')), [' '.join(['w1'] * 30)] * 3)
+    write_corpus(str(tmpdir.join('train.tgt')), ['w2'] * 3)
+    write_corpus(str(tmpdir.join('valid.src')), ['w1'])
+    write_corpus(str(tmpdir.join('valid.tgt')), ['w2'])
+    preprocess(tmpdir, str(tmpdir.join('stream')), '-stream', '-shard_size', '2')
+
+    assert read_data(str(tmpdir.join('stream.train'))) == [[], []]
+    assert not [name for name in os.listdir(str(tmpdir)) if '.shard' in name]
+
+
+@pytest.fixture(scope='module')
+def preprocess_module():
+    # the options are parsed at import
+    argv = sys.argv
+    sys.argv = ['preprocess.py'] + [arg for name in ['train_src', 'train_tgt', 'valid_src', 'valid_tgt', 'save_data']
+                                    for arg in ['-' + name, 'unused']]
+    sys.path.insert(0, ROOT)
+    try:
+        import preprocess
+    finally:
+        sys.argv = argv
+        sys.path.remove(ROOT)
+    return preprocess
+
+
+def write_text(tmpdir):
+    random.seed(1)
+    words = ['w%d' % i for i in range(50)] + [u'été', u'漢字', u'ß', u'🙂']
+    lines = [' '.join(random.choice(words) for _ in range(random.randint(0, 12))) for _ in range(200)]
+    path = str(tmpdir.join('text'))
+    write_corpus(path, lines)
+    return path, lines
+
+
+def test_read_chunk_splits_lines_once(preprocess_module, tmpdir):
+    path, lines = write_text(tmpdir)
+    size = os.path.getsize(path)
+    expected = [line + '\n' for line in lines]
+
+    # every split, including inside the lines and inside the multi-byte characters
+    for split in range(size + 1):
+        read = list(preprocess_module.read_chunk(path, 0, split)) + \
+            list(preprocess_module.read_chunk(path, split, size))
+        assert read == expected
+
+
+@pytest.mark.parametrize("input_type", ["word", "char"])
+@pytest.mark.parametrize("num_threads", [2, 3])
+def test_count_vocab_parallel(preprocess_module, tmpdir, input_type, num_threads):
+    path, lines = write_text(tmpdir)
+    other = str(tmpdir.join('other'))
+    write_corpus(other, lines[::-1][:37])
+
+    sequential = preprocess_module.Counter()
+    for filename in [path, other]:
+        with open(filename) as f:
+            for line in f:
+                sequential.update(line.split() if input_type == 'word' else preprocess_module.split_line_by_char(line))
+
+    counts = preprocess_module.count_vocab([path, other], input_type=input_type, num_threads=num_threads)
+    # the same counts, the words in the order of their first occurrence
+    assert list(counts.items()) == list(sequential.items())
+
+    vocab = preprocess_module.make_join_vocab([path, other], 1000, input_type=input_type, num_threads=num_threads)
+    expected = preprocess_module.make_join_vocab([path, other], 1000, input_type=input_type, num_threads=1)
+    assert vocab.labelToIdx == expected.labelToIdx
+    assert vocab.frequencies == expected.frequencies
@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+import onmt
+from conftest import Batch, model_options
+from onmt.ModelConstructor import build_model, quantize_model
+
+
+def decode_steps(model, src, n_steps=5):
+    """Log probabilities of the first n_steps of a decoding with fixed inputs"""
+    state = model.create_decoder_state(Batch(source=src.t()), beam_size=1)
+    inputs = torch.LongTensor(n_steps, src.size(0)).fill_(onmt.Constants.EOS + 2)
+    inputs[0] = onmt.Constants.BOS
+    return torch.stack([model.step(inputs[t:t + 1], state)['log_prob'] for t in range(n_steps)])
+
+
+def test_quantized_model_is_close_to_the_float_model(transformer):
+    model, dicts = transformer
+    torch.manual_seed(3)
+    src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (2, 6))
+
+    with torch.no_grad():
+        expected = decode_steps(model, src)
+        quantized = quantize_model(model)
+        log_probs = decode_steps(quantized, src)
+
+    assert isinstance(quantized.generator[0].linear, torch.nn.quantized.dynamic.Linear)
+    # int8 weights: the distributions are close, not equal
+    assert (log_probs.exp() - expected.exp()).abs().max().item() < 0.05
+    assert torch.equal(log_probs.argmax(-1), expected.argmax(-1))
+
+
+def test_quantized_checkpoint_round_trip(transformer, tmpdir):
+    model, dicts = transformer
+    torch.manual_seed(3)
+    src = torch.randint(onmt.Constants.EOS + 1, dicts['src'].size(), (2, 6))
+
+    with torch.no_grad():
+        quantized = quantize_model(model)
+        expected = decode_steps(quantized, src)
+
+        # as EnsembleTranslator.build_model loads a checkpoint written by quantize_model.py
+        checkpoint = tmpdir.join('model.quantized.pt')
+        torch.save({'model': quantized.state_dict()}, str(checkpoint))
+
+        loaded = quantize_model(build_model(model_options(), dicts))
+        loaded.load_state_dict(torch.load(str(checkpoint), weights_only=False)['model'])
+        loaded.eval()
+
+        assert torch.equal(decode_steps(loaded, src), expected)
+
+
+def test_quantize_model_dtype(transformer):
+    model, _ = transformer
+    with pytest.raises(NotImplementedError):
+        quantize_model(model, 'int4')
@@ -0,0 +1,94 @@
+import pytest
+import torch
+
+import onmt
+from conftest import Batch
+from onmt.ScriptedModel import ScriptedModel
+from onmt.modules.Transformer.Export import export_model
+
+
+def make_model(max_len):
+    # only the state used before the traced modules are called
+    model = ScriptedModel.__new__(ScriptedModel)
+    model.max_len = max_len
+    model.encoder = None
+    return model
+
+
+def test_renew_buffer_beyond_the_exported_positions():
+    model = make_model(16)
+    model.renew_buffer(16)
+
+    with pytest.raises(ValueError):
+        model.renew_buffer(17)
+
+
+def test_source_longer_than_the_exported_positions():
+    model = make_model(16)
+    src = torch.LongTensor(17, 2).fill_(5)  # len_src x batch
+
+    with pytest.raises(ValueError):
+        model.create_decoder_state(Batch(source=src), beam_size=2)
+
+
+@pytest.fixture
+def exported(transformer, tmpdir):
+    model, dicts = transformer
+    path = str(tmpdir.join('model'))
+    export_model(model, path, dicts, None, max_len=64)
+    return model, ScriptedModel(path)
+
+
+def make_source(batch_size, len_src, n_pads, n_words):
+    src = torch.randint(onmt.Constants.EOS + 1, n_words, (batch_size, len_src))
+    for b, n in enumerate(n_pads):
+        if n > 0:
+            src[b, -n:] = onmt.Constants.PAD
+    return src
+
+
+# the traced modules were given 2 sentences of 5 words with the last word of the second one padded
+@pytest.mark.parametrize("batch_size,beam_size,len_src,n_pads", [
+    (2, 2, 5, [0, 1]),
+    (2, 2, 5, [3, 0]),
+    (1, 1, 3, [0]),
+    (3, 4, 7, [0, 2, 5]),
+    (5, 1, 11, [1, 0, 0, 4, 10]),
+])
+def test_exported_model_matches_the_model(exported, batch_size, beam_size, len_src, n_pads):
+    model, scripted = exported
+    torch.manual_seed(2)
+    src = make_source(batch_size, len_src, n_pads, model.encoder.word_lut.num_embeddings)
+    n_tgt_words = model.generator[0].output_size
+
+    with torch.no_grad():
+        # the context projected into the keys / values of the context attention of every decoder layer
+        context = model.encoder(src)['context']
+        memory = torch.stack([torch.cat([layer.multihead_src.fc_key(context), layer.multihead_src.fc_value(context)], -1)
+                              for layer in model.decoder.layer_modules], 0)
+
+        state = model.create_decoder_state(Batch(source=src.t()), beam_size=beam_size)
+        scripted_state = scripted.create_decoder_state(Batch(source=src.t()), beam_size=beam_size)
+        assert torch.allclose(scripted_state.memory, memory, atol=1e-5)
+
+        input_t = torch.LongTensor(1, batch_size * beam_size).fill_(onmt.Constants.BOS)
+        for t in range(6):
+            output = model.step(input_t, state)
+            scripted_output = scripted.step(input_t, scripted_state)
+            assert torch.allclose(scripted_output['log_prob'], output['log_prob'], atol=1e-5)
+            assert torch.allclose(scripted_output['coverage'], output['coverage'].squeeze(1), atol=1e-5)
+
+            input_t = torch.randint(onmt.Constants.EOS + 1, n_tgt_words, (1, batch_size * beam_size))
+            if t == 2:
+                # the hypotheses of every sentence are reversed
+                reorder_idx = torch.arange(batch_size * beam_size).view(beam_size, batch_size).flip(0).view(-1)
+                state.reorder_beam(reorder_idx)
+                scripted_state.reorder_beam(reorder_idx)
+            if t == 3 and batch_size > 1:
+                # the first sentence is finished
+                active_idx = torch.arange(1, batch_size)
+                reorder_idx = (torch.arange(beam_size).unsqueeze(1) * batch_size + active_idx).view(-1)
+                state.reorder_beam(reorder_idx, active_idx)
+                scripted_state.reorder_beam(reorder_idx, active_idx)
+                batch_size -= 1
+                input_t = input_t[:, :batch_size * beam_size]
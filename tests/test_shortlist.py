@@ -0,0 +1,45 @@
+import argparse
+
+import torch
+
+import onmt
+from build_shortlist import count_cooccurrences, build_table, most_frequent
+from onmt.EnsembleTranslator import EnsembleTranslator
+
+
+class Batch(object):
+
+    def __init__(self, source):
+        self.source = source
+
+    def get(self, name):
+        assert name == 'source'
+        return self.source
+
+
+def test_frequent_words_do_not_depend_on_the_dictionary_order():
+    # the target dictionary is in first occurrence order: word 4 is rare, word 7 the most frequent
+    tgt_data = [[4, 7, 7], [5, 7, 6], [7, 6, 6, 7], [onmt.Constants.EOS, 7]]
+    src_data = [[4, 5], [5, 6], [6], [4]]
+    opt = argparse.Namespace(chunk_size=4, report_every=100)
+
+    keys, counts, src_count, tgt_count, tgt_freq = count_cooccurrences(src_data, tgt_data, 8, 8, opt)
+
+    assert tgt_freq.tolist() == [0, 0, 0, 1, 1, 1, 3, 6]
+    assert most_frequent(tgt_freq)[:2].tolist() == [7, 6]
+
+    table = build_table(keys, counts, src_count, tgt_count, 2)
+    assert table.size() == (8, 2)
+    assert table[6, 0].item() == 6
+
+
+def test_build_shortlist_uses_the_stored_frequent_words():
+    translator = EnsembleTranslator.__new__(EnsembleTranslator)
+    translator.cuda = False
+    translator.shortlist_table = torch.LongTensor([[0, 0], [0, 0], [0, 0], [0, 0], [9, 0], [10, 11]])
+    translator.shortlist_frequent = torch.LongTensor([20, 6])
+
+    source = torch.LongTensor([[4, 5], [5, onmt.Constants.PAD]])
+    shortlist = translator._build_shortlist(Batch(source))
+
+    assert shortlist.tolist() == [0, 1, 2, 3, 6, 9, 10, 11, 20]
@@ -0,0 +1,52 @@
+import os
+import random
+import subprocess
+import sys
+
+import torch
+
+import onmt
+from conftest import ROOT, run_translate, write_lines
+from onmt.SlimModel import slim_model_exists, load_slim_model
+
+
+def strip(checkpoint, output):
+    command = [sys.executable, os.path.join(ROOT, 'strip_model.py'), '-model', checkpoint, '-output', output]
+    subprocess.check_call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+def test_strip_and_load(checkpoint, tmpdir):
+    path, dicts = checkpoint
+    slim = str(tmpdir.join('model.slim'))
+    strip(path, slim)
+    assert slim_model_exists(slim)
+
+    model, opt, slim_dicts = load_slim_model(slim)
+    assert opt.model_size == 16 and opt.layers == 2
+
+    for name in ['src', 'tgt']:
+        assert slim_dicts[name].idxToLabel == dicts[name].idxToLabel
+        assert slim_dicts[name].labelToIdx == dicts[name].labelToIdx
+        assert slim_dicts[name].lower == dicts[name].lower
+
+    # every parameter, shared ones included (the word embeddings and the generator may be tied)
+    state = torch.load(path, weights_only=False)['model']
+    for name, p in model.named_parameters():
+        assert torch.equal(p.data, state[name])
+
+
+def test_translate_with_the_slim_model(checkpoint, tmpdir):
+    path, dicts = checkpoint
+    slim = str(tmpdir.join('model.slim'))
+    strip(path, slim)
+
+    random.seed(0)
+    src_words = [dicts['src'].getLabel(i) for i in range(onmt.Constants.EOS + 1, dicts['src'].size())]
+    src = [[random.choice(src_words) for _ in range(random.randint(1, 8))] for _ in range(9)]
+    src_file = str(tmpdir.join('src.txt'))
+    write_lines(src_file, src)
+
+    expected = run_translate(path, src_file, str(tmpdir.join('full.txt')), '-n_best', '2')
+    output = run_translate(slim, src_file, str(tmpdir.join('slim.txt')), '-n_best', '2')
+    assert len(expected) == len(src)
+    assert output == expected
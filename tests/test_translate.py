@@ -0,0 +1,35 @@
+import random
+
+import onmt
+import translate
+from conftest import run_translate, write_lines
+
+
+def test_make_batches():
+    lengths = [1, 2, 2, 3, 5, 5, 9, 30]
+
+    assert translate.makeBatches(lengths, 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    # at most 12 source tokens x beam 2 (padding included): 30 words are alone
+    assert translate.makeBatches(lengths, 3, batch_size_words=12, beam_size=2) == \
+        [[0, 1, 2], [3], [4], [5], [6], [7]]
+    assert translate.makeBatches([], 3) == []
+
+
+def test_sort_window_keeps_the_input_order(checkpoint, tmpdir):
+    path, dicts = checkpoint
+    random.seed(0)
+    src_words = [dicts['src'].getLabel(i) for i in range(onmt.Constants.EOS + 1, dicts['src'].size())]
+    # 17 sentences: the last window (of 7) is not full, and is not a multiple of the batch size (3)
+    src = [[random.choice(src_words) for _ in range(random.randint(1, 8))] for _ in range(17)]
+    # longer than -batch_size_words on its own
+    src[4] = [random.choice(src_words) for _ in range(15)]
+
+    src_file = str(tmpdir.join('src.txt'))
+    write_lines(src_file, src)
+
+    expected = run_translate(path, src_file, str(tmpdir.join('unsorted.txt')), '-batch_size', '4')
+    sorted_output = run_translate(path, src_file, str(tmpdir.join('sorted.txt')),
+                                  '-batch_size', '3', '-sort_window', '7', '-batch_size_words', '20')
+
+    assert len(expected) == len(src)
+    assert sorted_output == expected
@@ -0,0 +1,88 @@
+import random
+import threading
+
+import pytest
+
+import onmt
+from conftest import translator_options
+from onmt.TranslationServer import TranslationServer
+
+
+def make_sentences(dicts, n, seed=0):
+    random.seed(seed)
+    words = [dicts['src'].getLabel(i) for i in range(onmt.Constants.EOS + 1, dicts['src'].size())]
+    return [[random.choice(words) for _ in range(random.randint(1, 9))] for _ in range(n)]
+
+
+@pytest.fixture
+def translator(checkpoint):
+    path, dicts = checkpoint
+    opt = translator_options(path, '-beam_size', '2', '-max_sent_length', '12', '-batch_size', '1')
+    return onmt.EnsembleTranslator(opt), dicts
+
+
+def test_concurrent_requests_match_direct_translation(translator):
+    translator, dicts = translator
+    sentences = make_sentences(dicts, 12)
+    expected = [translator.translate([tokens], [])[0][0][0] for tokens in sentences]
+
+    server = TranslationServer(translator, max_batch_size=4, max_latency=0.2)
+
+    futures = [None] * len(sentences)
+
+    def client(i):
+        futures[i] = server.submit(sentences[i])
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(sentences))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [future.result(timeout=60) for future in futures] == expected
+    assert server.translate(" ".join(sentences[0])) == " ".join(expected[0])
+    assert server.submit([]).result(timeout=1) == []
+
+    stats = server.stats()
+    assert stats['requests'] == len(sentences) + 1
+    # the concurrent requests were translated in batches
+    assert max(stats['batch_sizes']) > 1
+    assert max(stats['batch_sizes']) <= 4
+
+
+def test_failing_batch_sets_the_exception(translator):
+    translator, dicts = translator
+    translate = translator.translate
+
+    def failing_translate(src_batch, tgt_batch):
+        if any('fail' in tokens for tokens in src_batch):
+            raise RuntimeError("translation failed")
+        return translate(src_batch, tgt_batch)
+
+    translator.translate = failing_translate
+    server = TranslationServer(translator, max_batch_size=4, max_latency=0.)
+
+    with pytest.raises(RuntimeError):
+        server.submit(['fail']).result(timeout=60)
+
+    # the worker still serves the next requests
+    tokens = make_sentences(dicts, 1)[0]
+    assert server.submit(tokens).result(timeout=60) == translate([tokens], [])[0][0][0]
+
+
+def test_worker_survives_an_error_outside_the_translation(translator):
+    translator, dicts = translator
+    server = TranslationServer(translator, max_batch_size=4, max_latency=0.)
+
+    class BrokenTokens(list):
+        # the requests are sorted by length before they are batched
+        def __len__(self):
+            if threading.current_thread() is server.thread:
+                raise TypeError("no length")
+            return 1
+
+    with pytest.raises(TypeError):
+        server.submit(BrokenTokens(['w1'])).result(timeout=60)
+
+    tokens = make_sentences(dicts, 1)[0]
+    assert server.submit(tokens).result(timeout=60) == translator.translate([tokens], [])[0][0][0]
@@ -9,10 +9,13 @@ import torch.nn as nn
 from torch import cuda
 from torch.autograd import Variable
 import math
+import os, sys
 import time, datetime
 from onmt.train_utils.trainer import XETrainer
 from onmt.train_utils.fp16_trainer import FP16XETrainer
 from onmt.train_utils.multiGPUtrainer import MultiGPUXETrainer
+from onmt.train_utils.distributed_trainer import DistributedXETrainer
+from onmt.multiprocessing.distributed import init_distributed, world_size, local_size, is_master
 from onmt.modules.Loss import NMTLossFunc, NMTAndCTCLossFunc
 from onmt.ModelConstructor import build_model, init_model_parameters
 
@@ -39,11 +42,27 @@ if opt.checkpointing > 0:
 if torch.cuda.is_available() and not opt.gpus:
     print("WARNING: You have a CUDA device, should run with -gpus 0")
 
+# one process per GPU for data parallel training
+if len(opt.gpus) > 1:
+    opt.nprocs = len(opt.gpus)
+
 
 torch.manual_seed(opt.seed)
 
 
-def main():
+def main(local_rank=0):
+
+    distributed = world_size(opt) > 1
+    if distributed:
+        init_distributed(opt, local_rank)
+        if opt.gpus:
+            opt.gpus = [opt.gpus[local_rank]]
+        else:
+            # the processes of a node share its cores
+            torch.set_num_threads(max(1, os.cpu_count() // local_size(opt)))
+        if not is_master():
+            # only the first process reports
+            sys.stdout = open(os.devnull, 'w')
 
     if opt.data_format == 'raw':
         start = time.time()
@@ -84,14 +103,14 @@ def main():
 
     elif opt.data_format == 'bin':
 
-        from onmt.data_utils.IndexedDataset import IndexedInMemoryDataset
+        from onmt.data_utils.IndexedDataset import MMapIndexedDataset
 
         dicts = torch.load(opt.data + ".dict.pt")
 
         #~ train = {}
         train_path = opt.data + '.train'
-        train_src = IndexedInMemoryDataset(train_path + '.src')
-        train_tgt = IndexedInMemoryDataset(train_path + '.tgt')
+        train_src = MMapIndexedDataset(train_path + '.src')
+        train_tgt = MMapIndexedDataset(train_path + '.tgt')
 
         train_data = onmt.Dataset(train_src,
                                  train_tgt, opt.batch_size_words,
@@ -100,8 +119,8 @@ def main():
                                  multiplier = opt.batch_size_multiplier)
 
         valid_path = opt.data + '.valid'
-        valid_src = IndexedInMemoryDataset(valid_path + '.src')
-        valid_tgt = IndexedInMemoryDataset(valid_path + '.tgt')
+        valid_src = MMapIndexedDataset(valid_path + '.src')
+        valid_tgt = MMapIndexedDataset(valid_path + '.tgt')
 
         valid_data = onmt.Dataset(valid_src,
                                  valid_tgt, opt.batch_size_words,
@@ -120,7 +139,8 @@ def main():
         if opt.ctc_loss != 0:
             loss_function = NMTAndCTCLossFunc(dicts['tgt'].size(), label_smoothing=opt.label_smoothing,ctc_weight = opt.ctc_loss)
         else:
-            loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=opt.label_smoothing)
+            loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=opt.label_smoothing,
+                                        shard_size=opt.max_generator_batches)
     else:
         from onmt.ModelConstructor import build_fusion
         from onmt.modules.Loss import FusionLoss
@@ -133,8 +153,12 @@ def main():
     n_params = sum([p.nelement() for p in model.parameters()])
     print('* number of parameters: %d' % n_params)
 
-    if len(opt.gpus) > 1 or opt.virtual_gpu > 1:
+    if opt.virtual_gpu > 1:
             raise NotImplementedError("Warning! Multi-GPU training is not fully tested and potential bugs can happen.")
+    elif distributed:
+        if opt.fp16:
+            raise NotImplementedError("Half precision training is not supported with several processes")
+        trainer = DistributedXETrainer(model, loss_function, train_data, valid_data, dicts, opt)
     else:
         if opt.fp16:
             trainer = FP16XETrainer(model, loss_function, train_data, valid_data, dicts, opt)
@@ -145,4 +169,10 @@ def main():
     trainer.run(save_file=opt.load_from)
 
 if __name__ == "__main__":
-    main()
+    if opt.dist_url == 'env://':
+        # one process started by the launcher
+        main(int(os.environ.get('LOCAL_RANK', 0)))
+    elif opt.nprocs > 1:
+        torch.multiprocessing.spawn(main, nprocs=opt.nprocs)
+    else:
+        main()
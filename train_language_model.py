@@ -86,7 +86,8 @@ def main():
     
     """ Building the loss function """
 
-    loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=opt.label_smoothing)
+    loss_function = NMTLossFunc(dicts['tgt'].size(), label_smoothing=opt.label_smoothing,
+                                shard_size=opt.max_generator_batches)
 
     n_params = sum([p.nelement() for p in model.parameters()])
     print('* number of parameters: %d' % n_params)
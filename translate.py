@@ -16,7 +16,9 @@ parser = argparse.ArgumentParser(description='translate.py')
 onmt.Markdown.add_md_help_argument(parser)
 
 parser.add_argument('-model', required=True,
-                    help='Path to model .pt file')
+                    help='Path to model .pt file (or prefix of a model exported by export_model.py)')
+parser.add_argument('-ema', action='store_true',
+                    help='Use the moving average of the parameters saved in the checkpoint (see -ema_decay)')
 parser.add_argument('-lm', required=False,
                     help='Path to language model .pt file. Used for cold fusion')
 parser.add_argument('-autoencoder', required=False,
@@ -45,8 +47,20 @@ parser.add_argument('-beam_size',  type=int, default=5,
                     help='Beam size')
 parser.add_argument('-batch_size', type=int, default=30,
                     help='Batch size')
+parser.add_argument('-sort_window', type=int, default=0,
+                    help="""Read this many sentences at once, sort them by source length
+                    and translate them in batches of similar lengths (the output keeps the input order).
+                    0 translates the batches in the order of the input""")
+parser.add_argument('-batch_size_words', type=int, default=0,
+                    help="""With -sort_window, also limit the batches to this many
+                    source tokens (padding included) times the beam size. 0 means no limit""")
 parser.add_argument('-max_sent_length', type=int, default=2048,
                     help='Maximum sentence length.')
+parser.add_argument('-max_len_a', type=float, default=0,
+                    help="""Limit the output length to max_len_a * source length + max_len_b
+                    (and max_sent_length). Not used if both are 0""")
+parser.add_argument('-max_len_b', type=int, default=0,
+                    help="""See max_len_a""")
 parser.add_argument('-replace_unk', action="store_true",
                     help="""Replace the generated UNK tokens with the source
                     token that had highest attention weight. If phrase_table
@@ -73,9 +87,22 @@ parser.add_argument('-beta', type=float, default=0.0,
                     help="""Coverage penalty coefficient""")
 parser.add_argument('-print_nbest', action='store_true',
                     help='Output the n-best list instead of a single sentence')
-parser.add_argument('-ensemble_op', default='mean', help="""Ensembling operator""")
+parser.add_argument('-ensemble_op', default='mean',
+                    help="""Ensembling operator: mean, gmean (or logSum), max or min""")
+parser.add_argument('-parallel_ensemble', action='store_true',
+                    help="""Run the models of an ensemble in parallel, each in its own
+                    worker thread bound to its share of the CPU cores""")
+parser.add_argument('-shortlist', default=None,
+                    help="""Source to target word table (from build_shortlist.py): the output vocabulary
+                    of each batch is restricted to the candidates of its source words""")
+parser.add_argument('-shortlist_k', type=int, default=50,
+                    help="""Number of candidates per source word used from the shortlist table""")
+parser.add_argument('-shortlist_frequent', type=int, default=1000,
+                    help="""Number of most frequent target words always in the shortlist""")
 parser.add_argument('-normalize', action='store_true',
                     help='To normalize the scores based on output length')
+parser.add_argument('-quantize', default=None,
+                    help="""Quantize the linear layers of the models for CPU decoding: int8""")
 parser.add_argument('-fp16', action='store_true',
                     help='To use floating point 16 in decoding')
 parser.add_argument('-gpu', type=int, default=-1,
@@ -98,6 +125,63 @@ def lenPenalty(s, l, alpha):
     l_term = math.pow(l, alpha)
     return s / l_term
 
+def makeBatches(lengths, batch_size, batch_size_words=0, beam_size=1):
+    """
+    Split the sentences (in order of increasing length) into batches of at most batch_size
+    sentences and, if batch_size_words > 0, at most batch_size_words source tokens x beam size
+    """
+    batches, batch = [], []
+
+    for i, length in enumerate(lengths):
+        if len(batch) > 0 and (len(batch) == batch_size or
+                               (batch_size_words > 0 and (len(batch) + 1) * length * beam_size > batch_size_words)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+def translateWindow(opt,tgtF,count,outF,translator,srcWindow,tgtWindow):
+    """
+    Translate a window of sentences in batches of sentences with similar lengths,
+    then write the results in the original order
+    """
+    order = sorted(range(len(srcWindow)), key=lambda i: len(srcWindow[i]))
+    results = [None] * len(srcWindow)
+    goldWordsTotal = 0
+
+    for batch in makeBatches([len(srcWindow[i]) for i in order], opt.batch_size,
+                             opt.batch_size_words, opt.beam_size):
+        idx = [order[i] for i in batch]
+        srcBatch = [srcWindow[i] for i in idx]
+        tgtBatch = [tgtWindow[i] for i in idx] if tgtF else []
+
+        predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores  = translator.translate(srcBatch,
+                                                                                tgtBatch)
+        goldWordsTotal += numGoldWords
+
+        for b, i in enumerate(idx):
+            results[i] = (predBatch[b], predScore[b], predLength[b], goldScore[b:b+1],
+                          [scores[b:b+1] for scores in allGoldScores])
+
+    predScoreTotal, predWordsTotal, goldScoreTotal = 0, 0, 0
+
+    for i, (pred, score, length, gold, allGold) in enumerate(results):
+        tgtBatch = [tgtWindow[i]] if tgtF else []
+        count,predScore,predWords,goldScore,_ = translateBatch(opt,tgtF,count,outF,translator,
+                                                               [srcWindow[i]],tgtBatch,
+                                                               [pred], [score], [length],
+                                                               gold, 0,
+                                                               allGold,opt.input_type)
+        predScoreTotal += predScore
+        predWordsTotal += predWords
+        goldScoreTotal += goldScore
+
+    return count,predScoreTotal,predWordsTotal,goldScoreTotal,goldWordsTotal
+
 def getSentenceFromTokens(tokens, input_type):
 
     if input_type == 'word':
@@ -243,23 +327,28 @@ def main():
                         raise NotImplementedError("Input type unknown")
                     tgtBatch += [tgtTokens]
 
-                if len(srcBatch) < opt.batch_size:
+                if len(srcBatch) < (opt.sort_window if opt.sort_window > 0 else opt.batch_size):
                     continue
             else:
                 # at the end of file, check last batch
                 if len(srcBatch) == 0:
                     break
 
-            # actually done beam search from the model
-            predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores  = translator.translate(srcBatch,
-                                                                                    tgtBatch)
-
-            # convert output tensor to words
-            count,predScore,predWords,goldScore,goldWords = translateBatch(opt,tgtF,count,outF,translator,
-                                                                           srcBatch,tgtBatch,
-                                                                           predBatch, predScore, predLength,
-                                                                           goldScore, numGoldWords,
-                                                                           allGoldScores,opt.input_type)
+            if opt.sort_window > 0:
+                # the batch is a window of sentences, translated in batches sorted by length
+                count,predScore,predWords,goldScore,goldWords = translateWindow(opt,tgtF,count,outF,translator,
+                                                                                srcBatch,tgtBatch)
+            else:
+                # actually done beam search from the model
+                predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores  = translator.translate(srcBatch,
+                                                                                        tgtBatch)
+
+                # convert output tensor to words
+                count,predScore,predWords,goldScore,goldWords = translateBatch(opt,tgtF,count,outF,translator,
+                                                                               srcBatch,tgtBatch,
+                                                                               predBatch, predScore, predLength,
+                                                                               goldScore, numGoldWords,
+                                                                               allGoldScores,opt.input_type)
             predScoreTotal += predScore
             predWordsTotal += predWords
             goldScoreTotal += goldScore